@@ -1,4 +1,10 @@
 
+import sys
+if __name__ == "__main__" and sys.argv[1:2] == ["_server_mode"]:
+   # Fast path for the ssh server: no command modules nor argument parsing
+   from sarch.server import main as server_main
+   sys.exit( server_main( sys.argv[2:] ) )
+
 import argparse
 import os
 from typing import List, Set
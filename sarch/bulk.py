@@ -0,0 +1,61 @@
+import json
+import struct
+
+from typing import Iterable, Tuple
+
+from .exceptions import SA_Exception
+from .common import CONFIG
+from .database import Meta
+
+
+class SA_Bulk_Exception( SA_Exception ):
+   pass
+
+
+# The bulk stream is sequence of records, one per file:
+#   <uint32 meta length> <uint32 data length> <meta as json: [filename, checksum, modtime]> <data>
+# and ends to a record with zero meta length.
+_HEADER = struct.Struct(">II")
+
+
+def pack( items : Iterable[ Tuple[Meta, bytes] ] ) -> Iterable[bytes]:
+   """ Pack the files into one stream, in chunks of about CONFIG.DATA_BLOCK_SIZE """
+   out = bytearray()
+   for ( meta, data ) in items:
+      meta_raw = bytes( json.dumps( [ meta.filename, meta.checksum, meta.modtime ] ), "utf8" )
+      out += _HEADER.pack( len( meta_raw ), len( data ) ) + meta_raw + data
+      if len( out ) >= CONFIG.DATA_BLOCK_SIZE:
+         yield bytes( out )
+         out = bytearray()
+   out += _HEADER.pack( 0, 0 )
+   yield bytes( out )
+
+
+def unpack( data_source : Iterable[bytes] ) -> Iterable[ Tuple[Meta, bytes] ]:
+   """ Give the files of the bulk stream. The data is not checked here, Filesystem.file_create() does it """
+   source = iter( data_source )
+   buf = bytearray()
+
+   def fill( needed : int ) -> None:
+      while len( buf ) < needed:
+         try:
+            buf.extend( next( source ) )
+         except StopIteration:
+            raise SA_Bulk_Exception("Bulk stream ended unexpectedly")
+
+   while True:
+      fill( _HEADER.size )
+      ( meta_len, data_len ) = _HEADER.unpack_from( buf )
+      if meta_len == 0:
+         for _ in source: # Let the underlying stream reach its end
+            pass
+         return
+      end = _HEADER.size + meta_len + data_len
+      fill( end )
+      values = json.loads( buf[ _HEADER.size : _HEADER.size + meta_len ].decode("utf8") )
+      meta = Meta( values[0] )
+      meta.checksum = values[1]
+      meta.modtime  = values[2]
+      data = bytes( buf[ _HEADER.size + meta_len : end ] )
+      del buf[ 0 : end ]
+      yield ( meta, data )
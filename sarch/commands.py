@@ -4,7 +4,7 @@ import time
 import datetime
 from pathlib import Path
 
-from typing import Dict, Set, Iterable, TypeVar, Any, Union, Tuple, Callable, Sequence, cast, IO
+from typing import Dict, Set, List, Iterable, TypeVar, Any, Union, Tuple, Callable, Sequence, cast, IO
 from collections import OrderedDict
 
 from .filesystem import Filesystem, PathType, SA_FS_Exception_Exists, SA_FS_Exception_NotFound
@@ -12,8 +12,11 @@ from .database import DatabaseBase, DatabaseStatus, SA_DB_Exception_NotFound, Op
 from .database_json import DatabaseJson
 from .exceptions import SA_Exception
 from .common import *
-from .remote import remote_sync, remote_open, Remote
+from .remote import remote_sync, remote_open, execute_sync_both, check_for_mods, check_for_mods_serving, FileCheckStats, Remote, SyncTable
 from .remote_localfs import RemoteLocalFS
+from .hash_cache import HashCache
+from .sync_state import SyncState
+from .sync_rules import SyncRules
 
 class SA_Cmd_Exception(SA_Exception):
    pass
@@ -66,60 +69,130 @@ def _staging_exists( db : DatabaseBase , filename : str ):
 
 def add( database : DatabaseBase, filesystem : Filesystem, filenames: Iterable[str] ) -> int:
    """ Add file or directory to database """
-   had_trouble = 0 
+   candidates = {} # type: Dict[ str, os.stat_result ]
    for abstract_filename in filenames:
-      for real_filename in filesystem.recursive_walk_files( abstract_filename ):
-         if _staging_exists( database,  real_filename ):
-            had_trouble = 1
-            print_error("Adding '%s' failed: Operation already pending " % (real_filename) )
-            continue
-
-         database.staging_add( Operation(real_filename, Operation.OP_ADD ) )
+      candidates.update( filesystem.scan_files( abstract_filename ) )
+   
+   # Reverted files count as pending operation, same as the ones on the staging list
+   conflicts = [ meta.filename for meta in database.meta_get_many( list( candidates.keys() ) ) 
+                               if meta.checksum == Meta.CHECKSUM_REVERTED ]
+   for filename in conflicts:
+      del candidates[ filename ]
+   
+   conflicts += database.staging_add_many( Operation( fn, Operation.OP_ADD ) for fn in sorted( candidates.keys() ) )
+   for real_filename in sorted( conflicts ):
+      print_error("Adding '%s' failed: Operation already pending " % (real_filename) )
+   
    database.save()
-   return had_trouble
+   if len(conflicts) > 0:
+      return 1
+   return 0
 
 _register_command( add , { "filenames" : {"nargs" : "+", "help" : "Filenames to be added to database", CommandFlags.ARG_IS_PATH : True } },
                          { } ) 
 
-def add_from( database : DatabaseBase, filesystem : Filesystem, filename: str ) -> int:
+def add_from( database : DatabaseBase, filesystem : Filesystem, filename: str, jobs : int = None, move : bool = False ) -> int:
    """ Add files from given external folder and sort them on current folder based on their modification timestamp """
-   target_dir = filesystem.make_relative(".")
+   if jobs == None:
+      jobs = CONFIG.HASH_JOBS
    
    fs_other = Filesystem( filename )
-   for real_filename in fs_other.recursive_walk_files( "." ):
-      modtime = fs_other.get_modtime( real_filename )
-      time_prefix = datetime.datetime.fromtimestamp( modtime ).strftime( CONFIG.ADD_FROM_DATE_FORMAT )
-      target_file = str( filesystem.make_relative( "%s" % ( Path(time_prefix) / Path(real_filename).name ), no_resolve=True ) )
-      target_file_noclash = target_file 
-      
-      meta_old = Meta( real_filename )
-      fs_other.meta_update( meta_old )
-      
-      loop = 0
-      if filesystem.file_exists( target_file_noclash ):
-         meta_new  = Meta(target_file_noclash )
-         filesystem.meta_update( meta_new )
-         if meta_old.check_fs_equal( meta_new ):
-            print_info("Files '%s' and '%s' identical, skipping" % (meta_old.filename, meta_new.filename ) )
-            fs_other.file_del( real_filename )
+   time_start = time.time()
+   
+   # Hash all the source files first, in parallel
+   def hash_single( item : Tuple[ str, os.stat_result ] ) -> Tuple[ Meta, os.stat_result, int ]:
+      ( real_filename, stat ) = item
+      meta = Meta( real_filename )
+      return ( meta, stat, fs_other.meta_update( meta, stat ) )
+   
+   same_device = os.stat( filesystem.make_absolute(".") ).st_dev
+   checksums_done = {} # type: Dict[str,str]
+   to_stage = [] # type: List[Operation]
+   n_skipped  = 0
+   n_imported = 0
+   progress = Progress( "Importing" )
+   
+   def skip_source( meta_old : Meta, reason : str ) -> None:
+      print_info("File '%s' %s, skipping" % ( meta_old.filename, reason ) )
+      if move == True:
+         fs_other.file_del( meta_old.filename )
+   
+   # Checksum index of the repository, built once for the whole import
+   checksums_db = {} # type: Dict[ str, List[str] ]
+   for meta in database.meta_list():
+      if meta.checksum_normal():
+         checksums_db.setdefault( meta.checksum, [] ).append( meta.filename )
+   
+   def find_in_db( checksum : str ) -> str:
+      """ File in the repository with the checksum, that is not staged for change and is still on disk, or None """
+      for filename in checksums_db.get( checksum, [] ):
+         if _staging_exists( database, filename ) == False and filesystem.file_exists( filename ):
+            return filename
+      return None
+   
+   try:
+      for ( meta_old, stat, n_bytes ) in map_parallel( hash_single, sorted( fs_other.scan_files( "." ) ), jobs ):
+         progress.update( n_bytes )
+         
+         # Dedup against this import and against the database checksum index
+         if meta_old.checksum in checksums_done:
+            skip_source( meta_old, "identical to imported '%s'" % checksums_done[ meta_old.checksum ] )
+            n_skipped += 1
+            continue
+         filename_db = find_in_db( meta_old.checksum )
+         if filename_db != None:
+            skip_source( meta_old, "already in repository as '%s'" % filename_db )
+            n_skipped += 1
             continue
-         # Same file exists and different checksum
-         while filesystem.file_exists( target_file_noclash ):
-           target_file_noclash = "%s-%03d" % ( target_file, loop )
-           loop += 1
-
-      # Now, move the file to proper place
-      data_stream = fs_other.file_read( real_filename )
-      meta_new = meta_old.copy()
-      meta_new.filename = target_file_noclash
-      filesystem.file_create( meta_new, data_stream )
-      database.staging_add( Operation(meta_new.filename, Operation.OP_ADD ) )
+         
+         time_prefix = datetime.datetime.fromtimestamp( meta_old.modtime ).strftime( CONFIG.ADD_FROM_DATE_FORMAT )
+         target_file = str( filesystem.make_relative( "%s" % ( Path(time_prefix) / Path(meta_old.filename).name ), no_resolve=True ) )
+         target_file_noclash = target_file 
+         
+         loop = 0
+         if filesystem.file_exists( target_file_noclash ):
+            meta_new  = Meta(target_file_noclash )
+            filesystem.meta_update( meta_new )
+            if meta_old.check_fs_equal( meta_new ):
+               skip_source( meta_old, "identical to '%s'" % meta_new.filename )
+               checksums_done[ meta_old.checksum ] = meta_new.filename
+               to_stage.append( Operation(meta_new.filename, Operation.OP_ADD ) )
+               n_skipped += 1
+               continue
+            # Same file exists and different checksum
+            while filesystem.file_exists( target_file_noclash ):
+               target_file_noclash = "%s-%03d" % ( target_file, loop )
+               loop += 1
+         
+         # Now, move the file to proper place
+         meta_new = meta_old.copy()
+         meta_new.filename = target_file_noclash
+         if move == True and stat.st_dev == same_device:
+            filesystem.move_from( fs_other.make_absolute( meta_old.filename ), meta_new.filename )
+         else:
+            filesystem.file_create( meta_new, fs_other.file_read( meta_old.filename ) )
+            if move == True:
+               fs_other.file_del( meta_old.filename )
+         
+         checksums_done[ meta_old.checksum ] = meta_new.filename
+         to_stage.append( Operation(meta_new.filename, Operation.OP_ADD ) )
+         n_imported += 1
+         print_info("%s -> %s" % ( meta_old.filename, meta_new.filename ))
+   finally:
+      # Files that are already on their place are staged also when import fails half way
+      for conflict in database.staging_add_many( to_stage ):
+         print_debug("File '%s' already staged" % conflict )
       database.save()
-      print_info("%s -> %s" % ( meta_old.filename, meta_new.filename ))
+   
+   elapsed = max( time.time() - time_start, 1e-6 )
+   print_info("Imported %d files, %d duplicates skipped, %s in %.1fs (%s/s)" % ( n_imported, n_skipped,
+               Progress.size_string( progress.n_bytes ), elapsed, Progress.size_string( progress.n_bytes / elapsed ) ) )
    return 0
 
    
-_register_command( add_from , { "filename" : {"help" : "Path to be imported to database", CommandFlags.ARG_IS_NOT_RELATIVE_PATH : True } },
+_register_command( add_from , { "filename" : {"help" : "Path to be imported to database", CommandFlags.ARG_IS_NOT_RELATIVE_PATH : True },
+                                "--jobs" : {"type" : int, "help" : "How many files to hash in parallel", "default" : None },
+                                "--move" : {"help" : "Remove imported files from the source, rename when on same device", "action" : "store_true" } },
                          { } ) 
    
 def rm( database : DatabaseBase, filesystem : Filesystem, filenames: Iterable[str] ) -> int:
@@ -148,6 +221,42 @@ def rm( database : DatabaseBase, filesystem : Filesystem, filenames: Iterable[st
 _register_command( rm,   { "filenames" : {"nargs" : "+", "help" : "Filenames to be removed", CommandFlags.ARG_IS_PATH : True, CommandFlags.ARG_PATH_MAYBE : True } },
                          { } ) 
 
+
+def mv( database : DatabaseBase, filesystem : Filesystem, source : str, target : str ) -> int:
+   """ Move or rename file or directory, the move is recorded without rehashing """
+   
+   metas = list( database.recursive_walk_files( source ) )
+   target_final = filesystem.move( source, target, dry_run = True )
+   if target_final.startswith( source + CONFIG.PATH_SEPARATOR ):
+      raise SA_Cmd_Exception("Cannot move '%s' into itself" % source )
+   
+   operations = [] # type: List[Operation]
+   for meta in metas:
+      if meta.checksum_normal() == False:
+         raise SA_Cmd_Exception("File '%s' has no valid checksum, commit or sync it first" % meta.filename )
+      filename_new = target_final + meta.filename[ len(source): ]
+      for filename in ( meta.filename, filename_new ):
+         if _staging_exists( database, filename ):
+            raise SA_Cmd_Exception("Moving '%s' failed: Operation already pending on '%s'" % ( meta.filename, filename ) )
+      try:
+         if database.meta_get( filename_new ).checksum != Meta.CHECKSUM_REMOVED:
+            raise SA_Cmd_Exception("Moving '%s' failed: '%s' is tracked file" % ( meta.filename, filename_new ) )
+      except SA_DB_Exception_NotFound:
+         pass
+      operations.append( Operation( filename_new, Operation.OP_MOVE, extra = meta.filename ) )
+      operations.append( Operation( meta.filename, Operation.OP_DEL, extra = filename_new ) )
+   
+   # Whole directory goes with single rename
+   filesystem.move( source, target_final, create_dirs = True )
+   database.staging_add_many( operations )
+   database.save()
+   print_info("%s -> %s (%d files)" % ( source, target_final, len(metas) ) )
+   return 0
+
+_register_command( mv,   { "source" : {"help" : "File or directory to be moved", CommandFlags.ARG_IS_PATH : True },
+                           "target" : {"help" : "New name, or existing directory to move into", CommandFlags.ARG_IS_PATH : True, CommandFlags.ARG_PATH_MAYBE : True } },
+                         { } ) 
+
    
 def init( database: DatabaseBase, filesystem : Filesystem, name : str ) -> int:
    """ Initialize new database on this path """   
@@ -193,6 +302,8 @@ def revert( database: DatabaseBase, filesystem : Filesystem, filenames: Iterable
    to_revert = [] # type: List[str]
    filenames_set  = set() # type: Set[str]
    filenames_done = set() # type: Set[str]
+   moves_reverted = set() # type: Set[str]
+   paths_affected = set() # type: Set[str]
    
    # Build list of filenames to be reverted
    for abstract_filename in filenames:   
@@ -205,6 +316,16 @@ def revert( database: DatabaseBase, filesystem : Filesystem, filenames: Iterable
          if op.operation == Operation.OP_ADD:
             if revert_if_modified( database, filesystem, op.filename ) == True:
                  to_revert.append( op.filename )
+         elif op.operation == Operation.OP_MOVE or ( op.operation == Operation.OP_DEL and op.extra != None ):
+            # Both ends of the move have operation, move the file back once
+            if op.operation == Operation.OP_MOVE:
+               ( moved_from, moved_to ) = ( op.extra, op.filename )
+            else:
+               ( moved_from, moved_to ) = ( op.filename, op.extra )
+            if moved_to not in moves_reverted:
+               filesystem.move( moved_to, moved_from, create_dirs = True )
+               moves_reverted.add( moved_to )
+               paths_affected.add( filesystem.get_basename( moved_to ) )
          elif op.operation == Operation.OP_DEL:
             try:
                filesystem.trash_revert( op.filename )
@@ -224,6 +345,7 @@ def revert( database: DatabaseBase, filesystem : Filesystem, filenames: Iterable
       
    # Clear current staging list      
    database.staging_clear()
+   filesystem.remove_empty_dirs( paths_affected )
    
    # And mark to reverts that require sync
    for fn in to_revert:
@@ -365,48 +487,45 @@ def find_dups( database: DatabaseBase, filesystem : Filesystem ) -> int:
 _register_command( find_dups, {}, {} )         
 
    
-def log( database: DatabaseBase, filesystem : Filesystem,  filenames: Sequence[str] , count : int ) -> int:
+def log( database: DatabaseBase, filesystem : Filesystem,  filenames: Sequence[str] , count : int, since : str = None ) -> int:
    """ Show registered database events on given files """
-   def print_commit_info( commit_list, filename_list ):
+   
+   def print_commit_info( commit : Commit ):
+      full_str = " Commit %s at %s " % ( commit.uid, Commit.time_string( commit.timestamp ) )
+      if commit.message:
+         full_str += " : %s " % commit.message
+      full_str  += "-------------"
+      print_info( full_str )
       
-      if len(filename_list) == 0:
-         all_files_ok = True
+      # The affected list is stored sorted by the filename
+      if len(filenames) == 0:
+         affected = commit.affected
       else:
-         all_files_ok = False
-         
-      for commit in commit_list:
-         full_str = " Commit %s at %s " % ( commit.uid, Commit.time_string( commit.timestamp ) )
-         if commit.message:
-            full_str += " : %s " % commit.message
-         full_str  += "-------------"
-            
-         print_info( full_str )
-         for af in sorted(commit.affected, key=lambda x: x[1] ):
-            if all_files_ok or af[1] in filename_list:
-               print_info("   %s - %s" % (af[1], af[0]))
-      
-   commits_affected = set() # type: Set[str]
-   files_listed = set()
-   
-   for abstract_filename in filenames:
-      try:
-         for meta in database.recursive_walk_files( abstract_filename, only_existing = False):
-            for com in meta.last_commits:
-               commits_affected.add( com  )
-            files_listed.add( abstract_filename )
-         
-      except SA_DB_Exception_NotFound:
-         continue
+         affected = []
+         for filename in filenames:
+            affected += commit.affected_under( filename )
             
-   if len(filenames) == 0:
-      commits_affected = None
-   
-   commit_list = database.commit_list( sort_by = "timestamp", limit=count, keys=commits_affected )
-   print_commit_info ( commit_list, files_listed  )
+      for af in affected:
+         if af[2]:
+            print_info("   %s - %s (%s)" % (af[1], af[0], af[2]))
+         else:
+            print_info("   %s - %s" % (af[1], af[0]))
+   
+   since_timestamp = None
+   if since:
+      since_timestamp = Commit.time_parse( since )
+   
+   n_commits = 0
+   for commit in database.commit_history( filenames, since = since_timestamp ):
+      if count > 0 and n_commits >= count:
+         break
+      print_commit_info( commit )
+      n_commits += 1
    return 0
 
 _register_command( log, {"filenames" : {"nargs" : "*", "help" : "Check only specific files" },
-                         "--count" : {"type" : int, "help" : "How many entries to show", "default" : 16 } } ,
+                         "--count" : {"type" : int, "help" : "How many entries to show", "default" : 16 },
+                         "--since" : {"help" : "Show only entries after given time (YYYY-MM-DD)", "default" : None } } ,
                    { CommandFlags.COMMAND_WITH_DIRTY_SYNC : True } ) 
                     
 
@@ -459,45 +578,60 @@ _register_command( verify, { "filenames" : {"nargs" : "*", "help" : "Check only
                          { } ) 
               
 
-def _fast_check_for_mods( database: DatabaseBase, filesystem : Filesystem ):
-   errors  = 0
-   for meta in database.meta_list():
-      if meta.checksum_normal() == False and meta.checksum != Meta.CHECKSUM_NONE: 
-         continue
-      try:
-         fs_modtime = filesystem.get_modtime( meta.filename )
-      except SA_FS_Exception_NotFound:
-         print_error("File '%s' is deleted " % meta.filename )
-         continue
-         
-      if fs_modtime != meta.modtime:
-         print_error("File '%s' has modifications" % meta.filename )
-         errors += 1
-         
-   return errors
-
-   
-def sync( database: DatabaseBase, filesystem : Filesystem,  url: str ) -> int:
+def sync( database: DatabaseBase, filesystem : Filesystem,  url: str = None, compress : str = None, jobs : int = None, bootstrap : bool = False,
+          concurrent : bool = False, resume : bool = False ) -> int:
    """ Syncronize this database with given database """
+   state = SyncState( filesystem.make_absolute( CONFIG.PATH ) )
+   if resume:
+      saved = state.load()
+      if saved == None:
+         raise SA_Cmd_Exception("No interrupted sync to resume")
+      if url == None:
+         url = saved[0]
+   if url == None:
+      raise SA_Cmd_Exception("Url of the other repository is required")
    if "://" not in url:
       url = "file://" + url
+   if resume and url != saved[0]:
+      raise SA_Cmd_Exception("The interrupted sync was with '%s'" % saved[0] )
+   if jobs == None:
+      jobs = CONFIG.SYNC_JOBS
+   if bootstrap:
+      CONFIG.SSH_BOOTSTRAP = True
+   concurrent = concurrent or CONFIG.SYNC_CONCURRENT
    
    # First check that our local database is clean
    local = RemoteLocalFS( "Local" )
    local.open_local( database, filesystem )
    
-   if _fast_check_for_mods( database, filesystem ) > 0 :
+   n_done = 0
+   if resume:
+      # Files written after the last checkpoint are newer than the database, they are recorded before the check
+      n_done = saved[1].remove_done( local.db, filesystem )
+   
+   if check_for_mods( database, filesystem ) > 0 :
       print_error("File(s) modified. Commit changes first.")
       return -1
    
    # On local disk we do Additional check that the files are not modified
    
-   other = remote_open( url, "Other" )
+   rules = SyncRules.load( filesystem.make_absolute( CONFIG.PATH ), url )
+   other = remote_open( url, "Other", filesystem.make_absolute( CONFIG.PATH_PEERS ), rules, compress )
    
-   print_info("Checking and pushing updates .. ")
-   remote_sync( local, other )
+   if resume:
+      ( _, xtable_local, xtable_other ) = saved
+      n_done += xtable_other.remove_done( other.db )
+      local._xtable_set( xtable_local )
+      other._xtable_set( xtable_other )
+      print_info("Resuming the interrupted sync, %d operations were done already .. " % n_done )
+   else:
+      print_info("Checking and pushing updates .. ")
+      remote_sync( local, other )
    
    if local.xtable.done() and other.xtable.done():
+      other.close()
+      local.close()
+      state.clear()
       print_info("Everything up to date.. ")
       return 0
    
@@ -508,82 +642,291 @@ def sync( database: DatabaseBase, filesystem : Filesystem,  url: str ) -> int:
       remote.database_save()
       
    
+   # All connections are opened before anything is changed on either side. Concurrently both directions have their own
+   n_connections = 2 * jobs if concurrent else jobs
+   local.channels_open( n_connections - 1 )
+   other.channels_open( n_connections - 1 )
+   
    # Ok we have something to do, first, save the current xtables
    database_store( local, DatabaseBase.STATUS_SYNC )
    database_store( other, DatabaseBase.STATUS_SYNC )
+   state.save( url, local.xtable, other.xtable )
       
    print_info("Transferring & syncing files .. ")
-   local.execute_sync( other )
-   other.execute_sync( local )
+   execute_sync_both( local, other, jobs, concurrent )
    
    # Then save the database changes, and clear the xtable
    database_store( local, DatabaseBase.STATUS_CLEAR )
    database_store( other, DatabaseBase.STATUS_CLEAR )
+   state.clear()
+   summary = other.transfer_summary()
    other.close()
+   local.close()
    
    print_info("Sync completed! ")
+   if summary != None:
+      print_info( summary )
+   stats = FileCheckStats()
+   for remote in ( local, other ):
+      stats.merge( remote.file_check_stats )
+   print_debug( stats.summary() )
    return 0
-_register_command( sync, {"url" : {"help" : "Url to other repository" } } , { CommandFlags.COMMAND_WITH_DIRTY_SYNC : True } ) 
+_register_command( sync, {"url" : {"help" : "Url to other repository, with --resume the one of the interrupted sync", "nargs" : "?", "default" : None },
+                          "--compress" : {"help" : "Compression of the data exchanged with ssh remote", "choices" : [ "none", "zlib", "lzma" ], "default" : None },
+                          "--jobs" : {"type" : int, "help" : "How many files to transfer in parallel, each over own connection", "default" : None },
+                          "--bootstrap" : {"help" : "Send the server to ssh remote that does not have sarch installed", "action" : "store_true" },
+                          "--concurrent" : {"help" : "Transfer both directions at the same time", "action" : "store_true" },
+                          "--resume" : {"help" : "Continue the interrupted sync with its plan", "action" : "store_true" } },
+                  { CommandFlags.COMMAND_WITH_DIRTY_SYNC : True } ) 
                     
 
+def subset( database: DatabaseBase, filesystem : Filesystem, url : str, include : List[str] = None, exclude : List[str] = None, 
+            clear : bool = False ) -> int:
+   """ Select the directories synced with given repository, the rest are left out of sync both ways """
+   if "://" not in url:
+      url = "file://" + url
+   path = filesystem.make_absolute( CONFIG.PATH )
+   rules = SyncRules() if clear else SyncRules.load( path, url )
+   if include != None or exclude != None:
+      rules = SyncRules( rules.include + ( include or [] ), rules.exclude + ( exclude or [] ) )
+   if clear or include != None or exclude != None:
+      rules.save( path, url )
+   print_info("Sync with %s: %s" % ( url, rules ) )
+   return 0
+_register_command( subset, {"url" : {"help" : "Url to other repository, as given to sync" },
+                            "--include" : {"help" : "Sync files under this path, relative to the repository root", "action" : "append", "default" : None },
+                            "--exclude" : {"help" : "Do not sync files under this path, relative to the repository root", "action" : "append", "default" : None },
+                            "--clear" : {"help" : "Remove the earlier rules, to sync everything", "action" : "store_true" } },
+                  { } )
+
+
+def clone( database: DatabaseBase, filesystem : Filesystem, url : str, path : str, name : str = None, jobs : int = None, no_verify : bool = False ) -> int:
+   """ Create new repository to given path, with the content of given repository """
+   if "://" not in url:
+      url = "file://" + url
+   if jobs == None:
+      jobs = CONFIG.SYNC_JOBS
+   path = os.path.abspath( path )
+   if os.path.exists( path ) and len( os.listdir( path ) ) > 0:
+      raise SA_Cmd_Exception("Target path '%s' is not empty" % path )
+   
+   os.makedirs( path, exist_ok = True )
+   target_fs = Filesystem( path )
+   other = remote_open( url, "Other", target_fs.make_absolute( CONFIG.PATH_PEERS ) )
+   
+   os.makedirs( target_fs.make_absolute( CONFIG.PATH ), exist_ok = True )
+   target_db = DatabaseJson()
+   target_db.create_to_path( target_fs.make_absolute( CONFIG.PATH ), name or os.path.basename( path ) )
+   for commit in other.db.commit_list():
+      target_db.commit_add( commit )
+   
+   # Every file is missing here, no need to plan anything. Files are recorded as they are written, 
+   # so that interrupted clone can be completed with sync
+   local = RemoteLocalFS( "Local" )
+   local.open_local( target_db, target_fs )
+   local.verify_writes = ( no_verify == False )
+   xtable = SyncTable( "Local" )
+   xtable.append_missing_files( set( other.db.meta_list_keys() ), other.db )
+   local._xtable_set( xtable )
+   
+   local.channels_open( jobs - 1 )
+   other.channels_open( jobs - 1 )
+   target_db.set_status( DatabaseBase.STATUS_SYNC )
+   target_db.save()
+   
+   print_info("Transferring %d files .. " % len( xtable.copy ) )
+   local.execute_sync( other, jobs )
+   
+   target_db.set_status( DatabaseBase.STATUS_CLEAR )
+   target_db.save()
+   summary = other.transfer_summary()
+   other.close()
+   local.close()
+   
+   print_info("Clone completed! ")
+   if summary != None:
+      print_info( summary )
+   if no_verify:
+      print_info("Checksums of the files were not checked. Run 'sarch verify' in the new repository to check them.")
+   return 0
+_register_command( clone, {"url" : {"help" : "Url to the repository to be cloned" },
+                           "path" : {"help" : "Path for the new repository, must be empty or not existing" },
+                           "--name" : {"help" : "Name for the new database, by default the name of the path", "default" : None },
+                           "--jobs" : {"type" : int, "help" : "How many files to transfer in parallel", "default" : None },
+                           "--no_verify" : {"action" : "store_true", "help" : "Do not check the checksums while writing, leave it for verify" } },
+                  { CommandFlags.COMMAND_NO_DB : True } ) 
+
+
+def bundle( database: DatabaseBase, filesystem : Filesystem, action : str, filename : str, since : str = None ) -> int:
+   """ Carry changes to offline repository: create bundle file against its state, or apply such bundle """
+   from .remote_bundle import RemoteBundle, bundle_apply
+   
+   if action == "apply":
+      n_files = bundle_apply( database, filesystem, filename )
+      print_info("Bundle applied, %d files written. " % n_files )
+      return 0
+   
+   if since == None:
+      raise SA_Cmd_Exception("The state of the peer is required: copy of its %s" % DatabaseJson.get_database_file( CONFIG.PATH ) )
+   if database.get_status() == DatabaseBase.STATUS_SYNC:
+      raise SA_Cmd_Exception("Repository is in sync mode. Run the interrupted sync or bundle apply again first")
+   if check_for_mods( database, filesystem ) > 0 :
+      print_error("File(s) modified. Commit changes first.")
+      return -1
+   
+   local = RemoteLocalFS( "Local" )
+   local.open_local( database, filesystem )
+   peer = RemoteBundle( "Peer" )
+   peer.open_bundle( filename, since )
+   
+   # This repository is not changed, the bundle carries only the changes to the peer
+   remote_sync( local, peer )
+   if local.xtable.done() == False:
+      print_info("The peer has changes not in this repository. Make a bundle there to get them here.")
+   peer.execute_sync( local )
+   peer.close()
+   local.close()
+   print_info("Bundle created: %s" % peer.transfer_summary() )
+   return 0
+_register_command( bundle, {"action" : {"help" : "Create or apply bundle", "choices" : [ "create", "apply" ] },
+                            "filename" : {"help" : "The bundle file" },
+                            "--since" : {"help" : "Peer state for create: copy of the database file of the peer", "default" : None } },
+                  { CommandFlags.COMMAND_WITH_DIRTY_SYNC : True } ) # Failed apply is run again
 
-def _commit_scan_for_auto( database: DatabaseBase, filesystem : Filesystem ):
+
+def _commit_scan_for_auto( database: DatabaseBase, filesystem : Filesystem ) -> Dict[ str, os.stat_result ]:
+   """ Single stat walk over the repository: stage modified, deleted and new files. Returns the stat results by filename """
+   
+   stats = { fn : stat for (fn, stat) in filesystem.scan_files( "." ) }
+   staged = { op.filename for op in database.staging_list() }
+   
+   def stage( filename : str, operation : str ) -> None:
+      if filename not in staged:
+         database.staging_add( Operation( filename, operation ) )
    
    for meta in database.meta_list():
-      if meta.checksum == Meta.CHECKSUM_REMOVED or meta.checksum == Meta.CHECKSUM_REVERTED:
+      if meta.checksum == Meta.CHECKSUM_REVERTED:
          continue
       
-      try:
-        fs_modtime = filesystem.get_modtime( meta.filename )
-      except SA_FS_Exception_NotFound:
-        fs_modtime = None
-      
-      if fs_modtime == None:
-        database.staging_add( Operation(meta.filename, Operation.OP_DEL ) )
-      else:
-        if fs_modtime != meta.modtime or meta.checksum == Meta.CHECKSUM_NONE:
-          database.staging_add( Operation(meta.filename, Operation.OP_ADD ) )
+      stat = stats.get( meta.filename )
+      if meta.checksum == Meta.CHECKSUM_REMOVED:
+         if stat != None:
+            stage( meta.filename, Operation.OP_ADD ) # Removed file that has been created again
+      elif stat == None:
+         stage( meta.filename, Operation.OP_DEL )
+      elif filesystem.make_time( stat.st_mtime ) != meta.modtime or meta.checksum == Meta.CHECKSUM_NONE:
+         stage( meta.filename, Operation.OP_ADD )
+   
+   # And the untracked files
+   tracked = database.meta_list_keys()
+   for filename in stats:
+      if filename not in tracked:
+         stage( filename, Operation.OP_ADD )
+   return stats
    
               
-def commit( database: DatabaseBase, filesystem : Filesystem, msg : str = None, auto : bool = False ) -> int:
+def commit( database: DatabaseBase, filesystem : Filesystem, msg : str = None, auto : bool = False, jobs : int = None ) -> int:
    """ Commit changes (add, del, move) to database and filesystem """
    
+   if jobs == None:
+      jobs = CONFIG.HASH_JOBS
+   
+   stats = {} # type: Dict[ str, os.stat_result ]
+   if auto == True:
+      stats = _commit_scan_for_auto( database, filesystem )
    
-   # Then seek for all modified files
-   pending_ops = database.staging_list()
-      
    # Generate new commit UID
    commit = Commit( msg )
+   pending_ops  = list( database.staging_list() )
    pending_adds = []
+   to_hash      = [] # type: List[ Tuple[ Meta, os.stat_result ] ]
+   checksums_orig = {} # type: Dict[ str, str ]
+   
+   # First pass: find out what needs to be hashed, using the stats from the scan when available
+   moved = {} # type: Dict[ str, Meta ]
+   for op in pending_ops :
+     if op.operation == Operation.OP_MOVE:
+        # Moved file keeps the checksum and history of the source, unless its modified after the move
+        meta = database.meta_get( op.extra )
+        meta.filename = op.filename
+        moved[ op.filename ] = meta
+        stat = stats.get( op.filename )
+        if stat == None:
+           stat = filesystem.stat( op.filename )
+        if meta.modtime != filesystem.make_time( stat.st_mtime ):
+           to_hash.append( ( meta, stat ) )
+        continue
+     
+     if op.operation != Operation.OP_ADD:
+        continue
+     stat = stats.get( op.filename )
+     if stat == None:
+        stat = filesystem.stat( op.filename )
+     try:
+        meta = database.meta_get( op.filename )
+        if meta.modtime == filesystem.make_time( stat.st_mtime ) and meta.checksum != Meta.CHECKSUM_REMOVED:
+           # No update, nothing to do for this file
+           continue
+        checksums_orig[ op.filename ] = meta.checksum
+     # File is not found from database, make new      
+     except SA_DB_Exception_NotFound:
+        meta = Meta( op.filename )
+     to_hash.append( ( meta, stat ) )
+   
+   # Checksums from interrupted earlier run can be used as long as the files have not changed since
+   cache = HashCache( filesystem.make_absolute( CONFIG.PATH ) )
+   cache.open()
+   hashed = {} # type: Dict[ str, Meta ]
+   to_hash_new = [] # type: List[ Tuple[ Meta, os.stat_result ] ]
+   for ( meta, stat ) in to_hash:
+      checksum = cache.get( meta.filename, stat )
+      if checksum == None:
+         to_hash_new.append( ( meta, stat ) )
+         continue
+      meta.modtime  = filesystem.make_time( stat.st_mtime )
+      meta.checksum = checksum
+      hashed[ meta.filename ] = meta
+   if len(hashed) > 0:
+      print_info("Resuming: %d checksums known from interrupted commit" % len(hashed) )
+   
+   # Then hash the rest of the files in parallel
+   def hash_single( item : Tuple[ Meta, os.stat_result ] ) -> Tuple[ Meta, os.stat_result, int ]:
+      ( meta, stat ) = item
+      return ( meta, stat, filesystem.meta_update( meta, stat ) )
+   
+   progress = Progress( "Hashing", len(to_hash_new) )
+   try:
+      for ( meta, stat, n_bytes ) in map_parallel( hash_single, to_hash_new, jobs ):
+         progress.update( n_bytes )
+         hashed[ meta.filename ] = meta
+         cache.set( meta.filename, stat, meta.checksum )
+         cache.checkpoint()
+   except BaseException:
+      # Keep what we got so far, the next commit continues from here
+      cache.save()
+      raise
+   progress.done()
    
-   if auto == True:
-      _commit_scan_for_auto( database, filesystem )
-      
    for op in pending_ops :
      if op.operation == Operation.OP_ADD:
-        try:
-           meta = database.meta_get( op.filename )
-           meta_cs_orig = meta.checksum
-           
-           fs_modtime = filesystem.get_modtime( op.filename)
-           if meta.modtime == fs_modtime and meta_cs_orig != Meta.CHECKSUM_REMOVED:
-              # No update, nothing to do for this file
-              continue
-           
-           filesystem.meta_update( meta ) 
-           if meta_cs_orig != Meta.CHECKSUM_REMOVED:
-              op.operation = Operation.OP_MODIFY
-           # Else this is removed file that is re-added, marke as add
-           
-        # File is not found from database, make new      
-        except SA_DB_Exception_NotFound:
-           meta = Meta( op.filename )
+        if op.filename not in hashed:
+           continue
+        meta = hashed[ op.filename ]
+        if op.filename not in checksums_orig:
            pending_adds.append( op.filename )
-           filesystem.meta_update( meta )
+        elif checksums_orig[ op.filename ] != Meta.CHECKSUM_REMOVED:
+           op.operation = Operation.OP_MODIFY
+        # Else this is removed file that is re-added, marke as add
            
         print_info("Added %s with checksum %s" % ( meta.filename, meta.checksum ))   
         meta.add_commit( commit )
         database.meta_set( meta )
+     
+     elif op.operation == Operation.OP_MOVE:
+        meta = hashed.get( op.filename, moved[ op.filename ] )
+        print_info("Moved %s to %s" % ( op.extra, meta.filename ))
+        meta.add_commit( commit )
+        database.meta_set( meta )
         
      elif op.operation == Operation.OP_DEL:
         meta = database.meta_get( op.filename )
@@ -604,48 +947,57 @@ def commit( database: DatabaseBase, filesystem : Filesystem, msg : str = None, a
       filesystem.file_make_readonly( fn )  
 
    database.staging_clear()
-   
-   # And remove all files that were marked for deletion   
-   filesystem.trash_clear( )
 
    if commit.operation_count() == 0:
       print_info("No operations to be done.")
    else:
       print_info("%d changes commited ok." % commit.operation_count() )
       database.commit_add( commit )
-      
+   
+   # The database save is the commit point, only after it the checkpoint and deleted files can go
    database.save()
+   cache.clear()
+   filesystem.trash_clear( )
    return 0
 
 _register_command( commit, { "--msg" : {"help" : "Additional message for this commit", "default" : "" },
-                             "--auto" : {"help" : "Automatically add modified files and deleted files", "action" : "store_true" }},
+                             "--auto" : {"help" : "Automatically add modified, deleted and new files", "action" : "store_true" },
+                             "--jobs" : {"type" : int, "help" : "How many files to hash in parallel", "default" : None }},
                          { } ) 
 
 
 def _server_mode( database: DatabaseBase, filesystem : Filesystem, path:str ) -> int:
-   """ Runs the server mode for remote connections """
-   from .remote_ssh import remote_ssh_server
-   import sys
-   
-   
-   # Drop the none arguments 
-   filesystem = Filesystem( path )
-   database = open_database( filesystem.make_absolute(CONFIG.PATH) )
+   """ Runs the server mode for remote connections. The ssh remote starts this through sarch/__main__.py
+       without going through the command line parsing, see sarch/server.py """
+   from .server import server_mode
+   return server_mode( path )
    
-   set_output_to( sys.stderr )
-   sys.stdout.flush()
-   sys.stdin.flush()
+_register_command( _server_mode, {"path" : { "help" : "The basepath for the repository"}}, {CommandFlags.COMMAND_NO_DB : True } )
+
+
+def serve( database: DatabaseBase, filesystem : Filesystem, listen : str ) -> int:
+   """ Serve this repository to sync clients over socket, until interrupted. There is no authentication: anyone who can
+       connect can read and change the repository. Tcp listeners should bind to localhost only, and be reached over ssh """
+   from .remote_daemon import RemoteDaemon, ADDRESS_TCP, address_parse
    
-   if _fast_check_for_mods( database, filesystem ) > 0 :
-      print_error("Remote has local modifications. Please commit changes there and try again.")
+   daemon = RemoteDaemon( database, filesystem, lambda: check_for_mods_serving( database, filesystem ) )
+   error = daemon.refresh()
+   if error != None:
+      print_error( error )
       return -1
-   
-   pipe_in  = open( sys.stdin.fileno(), 'rb', closefd=False )
-   pipe_out = open( sys.stdout.fileno(), 'wb', closefd=False )
-   remote_ssh_server( database, filesystem, pipe_in, pipe_out ) 
+   ( family, address ) = address_parse( listen )
+   if family == ADDRESS_TCP and address[0] not in ( "localhost", "127.0.0.1", "::1" ):
+      print_info("Warning: no authentication, anyone who can connect to %s:%d can change this repository" % address )
+   daemon.listen( listen )
+   print_info("Serving at %s" % listen )
+   try:
+      daemon.serve_forever()
+   except KeyboardInterrupt:
+      print_info("Stopped")
+   finally:
+      daemon.close()
    return 0
-   
-_register_command( _server_mode, {"path" : { "help" : "The basepath for the repository"}}, {CommandFlags.COMMAND_NO_DB : True } )
+_register_command( serve, {"--listen" : { "help" : "Address to listen: unix:<path> or tcp:<host>:<port>. No authentication, bind tcp to localhost only", "required" : True }}, {} )
                                   
    
    
@@ -1,17 +1,40 @@
 
 import os
-from typing import Sequence, TextIO
+import time
+from typing import Sequence, TextIO, Callable, Iterable, TypeVar
+from collections import deque
 import sys
 
 class CONFIG:
    PATH=".sarch"
    VERBOSE=0
    PATH_TRASH=os.path.join( ".sarch", "trash" )
+   PATH_PARTIAL=os.path.join( ".sarch", "partial" )
+   PATH_PEERS=os.path.join( ".sarch", "peers" )
    PATH_SEPARATOR = "/"
    DATA_BLOCK_SIZE = (2**20)
    SSH_COMMAND = "ssh"
+   SSH_PYTHON = "python3"        # Interpreter on the remote host, used with SSH_BOOTSTRAP
+   SSH_BOOTSTRAP = False         # Send the server as zipapp over ssh, instead of running installed sarch
    ADD_FROM_DATE_FORMAT = "%Y-%m"
    VERSION = "1.0.0"
+   HASH_JOBS = 4
+   PROGRESS_INTERVAL = 5.0
+   CHECKPOINT_FILES = 1000
+   CHECKPOINT_SECONDS = 60.0
+   DELTA_MIN_SIZE  = (2**16) # Smaller files are always sent whole
+   DELTA_BLOCK_MIN = (2**11)
+   DELTA_BLOCK_MAX = (2**20)
+   DELTA_MISS_MAX  = (2**22) # After this many bytes without a matching block, only block boundaries are matched
+   COMPRESSION = "none"          # Method for data exchanged over ssh: none, zlib or lzma. The client decides for both ends
+   COMPRESSION_LEVEL = 6
+   COMPRESSION_MIN_RATIO = 0.9   # Streams that do not compress better than this are sent raw
+   SSH_WINDOW = 256              # Max commands in flight without response
+   SSH_HAVE_BATCH = 1000         # Files checked with one query before the transfers
+   BULK_MAX_SIZE = (2**16)       # Smaller files are sent many in one stream. Zero to disable
+   SYNC_JOBS = 1                 # Parallel file transfers in sync
+   SYNC_CONCURRENT = False       # Run both directions of sync at the same time
+   SERVE_RECHECK_SECONDS = 600.0 # 'sarch serve' checks the files for modifications at most this often
    
    
 output = print
@@ -47,7 +70,66 @@ def read_input( options : Sequence[str] , explain : str ):
       if response not in options:
          continue
       return response
-      
+
+
+
+MapIn  = TypeVar('MapIn')
+MapOut = TypeVar('MapOut')
+
+def map_parallel( fun : Callable[ [MapIn], MapOut ], items : Iterable[MapIn], jobs : int ) -> Iterable[MapOut]:
+   """ Like map(), but run on given number of threads. Results are yielded in the input order and
+       only limited amount of work is queued at once, so the input may be long generator """
+   if jobs <= 1:
+      yield from map( fun, items )
+      return
+   
+   from concurrent.futures import ThreadPoolExecutor # Not at top, the ssh server starts faster without it
+   with ThreadPoolExecutor( max_workers = jobs ) as executor:
+      pending = deque() # type: deque
+      for item in items:
+         pending.append( executor.submit( fun, item ) )
+         if len(pending) >= jobs * 4:
+            yield pending.popleft().result()
+      while len(pending) > 0:
+         yield pending.popleft().result()
+
+
+class Progress:
+   """ Print progress and throughput of long operation, at most once per CONFIG.PROGRESS_INTERVAL """
+   
+   def __init__( self, title : str, n_total : int = 0 ) -> None:
+      self.title   = title
+      self.n_total = n_total
+      self.n_items = 0
+      self.n_bytes = 0
+      self.time_start  = time.time()
+      self.time_output = self.time_start
+   
+   @staticmethod
+   def size_string( n_bytes : float ) -> str:
+      for unit in ("B", "KB", "MB", "GB"):
+         if n_bytes < 1024:
+            return "%.1f %s" % (n_bytes, unit )
+         n_bytes /= 1024
+      return "%.1f TB" % n_bytes
+   
+   def _status( self ) -> str:
+      elapsed = max( time.time() - self.time_start, 1e-6 )
+      if self.n_total > 0:
+         items = "%d/%d" % ( self.n_items, self.n_total )
+      else:
+         items = "%d" % self.n_items
+      return "%s: %s files, %s in %.1fs (%s/s)" % ( self.title, items, self.size_string( self.n_bytes ), 
+                                                    elapsed, self.size_string( self.n_bytes / elapsed ) )
    
+   def update( self, n_bytes : int, n_items : int = 1 ) -> None:
+      self.n_bytes += n_bytes
+      self.n_items += n_items
+      now = time.time()
+      if now - self.time_output >= CONFIG.PROGRESS_INTERVAL:
+         self.time_output = now
+         print_info( self._status() )
    
-   
\ No newline at end of file
+   def done( self ) -> None:
+      if self.n_items > 0:
+         print_info( self._status() )
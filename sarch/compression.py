@@ -0,0 +1,98 @@
+import zlib
+
+from typing import Iterable, List, Any
+
+try:
+   import lzma
+except ImportError: # Python built without liblzma
+   lzma = None # type: ignore
+
+from .exceptions import SA_Exception
+from .common import CONFIG, Progress
+
+
+class SA_Compression_Exception( SA_Exception ):
+   pass
+
+
+METHOD_NONE = "none"
+METHOD_ZLIB = "zlib"
+METHOD_LZMA = "lzma"
+
+PROBE_SIZE = (2**16)
+
+_DECOMPRESS_ERRORS = ( zlib.error, EOFError ) + ( ( lzma.LZMAError, ) if lzma != None else () )
+
+
+def methods_supported() -> List[str]:
+   """ Compression methods available on this end, in order of preference """
+   methods = [ METHOD_ZLIB ]
+   if lzma != None:
+      methods.append( METHOD_LZMA )
+   return methods
+
+
+def compressor_create( method : str, level : int ) -> Any:
+   if method == METHOD_ZLIB:
+      return zlib.compressobj( level )
+   if method == METHOD_LZMA and lzma != None:
+      return lzma.LZMACompressor( preset = max( 0, min( 9, level ) ) )
+   raise SA_Compression_Exception("Unsupported compression method '%s'" % method )
+
+
+class Decompressor:
+   """ Streaming decompression, that gives the output in blocks of at most CONFIG.DATA_BLOCK_SIZE """
+
+   def __init__( self, method : str ) -> None:
+      self.method = method
+      if method == METHOD_ZLIB:
+         self.obj = zlib.decompressobj()
+      elif method == METHOD_LZMA and lzma != None:
+         self.obj = lzma.LZMADecompressor()
+      else:
+         raise SA_Compression_Exception("Unsupported compression method '%s'" % method )
+
+   def _has_more( self ) -> bool:
+      if self.method == METHOD_ZLIB:
+         return len( self.obj.unconsumed_tail ) > 0
+      return self.obj.needs_input == False and self.obj.eof == False
+
+   def feed( self, data : bytes ) -> Iterable[bytes]:
+      try:
+         out = self.obj.decompress( bytes( data ), CONFIG.DATA_BLOCK_SIZE )
+         while True:
+            if len(out) > 0:
+               yield out
+            if self._has_more() == False:
+               return
+            tail = self.obj.unconsumed_tail if self.method == METHOD_ZLIB else b""
+            out = self.obj.decompress( tail, CONFIG.DATA_BLOCK_SIZE )
+      except _DECOMPRESS_ERRORS as err:
+         raise SA_Compression_Exception("Corrupted compressed stream: %s" % err )
+
+
+def is_compressible( data : bytes ) -> bool:
+   """ Quick probe with the fastest zlib level: already compressed data (jpeg, zip, video) does not shrink """
+   sample = bytes( data[ 0 : PROBE_SIZE ] )
+   if len( sample ) == 0:
+      return False
+   return len( zlib.compress( sample, 1 ) ) < len( sample ) * CONFIG.COMPRESSION_MIN_RATIO
+
+
+class TransferStats:
+   """ Byte counts of the payload data, before and after compression """
+
+   def __init__( self ) -> None:
+      self.bytes_raw  = 0
+      self.bytes_wire = 0
+
+   def add( self, n_raw : int, n_wire : int ) -> None:
+      self.bytes_raw  += n_raw
+      self.bytes_wire += n_wire
+
+   def summary( self ) -> str:
+      if self.bytes_raw == 0:
+         return "no data transferred"
+      return "%s of data as %s on wire, compression ratio %.1f%%, saved %s" % (
+               Progress.size_string( self.bytes_raw ), Progress.size_string( self.bytes_wire ),
+               100.0 * self.bytes_wire / self.bytes_raw, Progress.size_string( max( 0, self.bytes_raw - self.bytes_wire ) ) )
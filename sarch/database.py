@@ -1,5 +1,5 @@
 from abc import abstractmethod, ABCMeta
-from typing import TypeVar, List, Tuple, Type, Iterable, Set, Union, NewType
+from typing import TypeVar, List, Tuple, Type, Iterable, Set, Union, NewType, Sequence
 from uuid import uuid1 as make_uid
 import datetime
 import time
@@ -7,6 +7,7 @@ from copy import deepcopy
 
 from .exceptions import SA_Exception
 from .common import CONFIG, print_info, print_error
+from .sync_rules import SyncRules
 
 
 class SA_DB_Exception( SA_Exception ):
@@ -24,7 +25,9 @@ class DatabaseObjectBase:
    
    def json_from( self, dobj : List[DBValue] ):
      for loop,attr in enumerate(self.JSON_MAPPING):
-        setattr( self, attr, dobj[loop])
+        value = dobj[loop]
+        # Lists are copied, so that modifying the object does not modify the database entry behind the back
+        setattr( self, attr, list( value ) if isinstance( value, list ) else value )
         
    #def check_all_properties( self ) -> bool:
      #for loop,attr in enumerate(self.JSON_MAPPING):
@@ -35,6 +38,16 @@ class DatabaseObjectBase:
    @staticmethod
    def time_string( timestamp: Union[int, float] ) -> str:
       return datetime.datetime.fromtimestamp( timestamp ).strftime('%Y-%m-%d %H:%M:%S')   
+   
+   @staticmethod
+   def time_parse( value : str ) -> float:
+      """ Parse time given in the time_string format, or just the date part of it """
+      for time_format in ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d'):
+         try:
+            return time.mktime( datetime.datetime.strptime( value, time_format ).timetuple() )
+         except ValueError:
+            continue
+      raise SA_DB_Exception("Invalid time '%s', use format YYYY-MM-DD or 'YYYY-MM-DD HH:MM:SS'" % value )
                    
    def copy( self ):
       return deepcopy( self )
@@ -115,6 +128,28 @@ class Commit( DatabaseObjectBase ):
    def operation_count( self ) -> int:
       return len ( self.affected )
    
+   def affected_sort( self ) -> None:
+      self.affected.sort( key=lambda x: x[0] )
+   
+   def affected_under( self, filename : str ) -> List[ Tuple [str, str, str] ]:
+      """ Return the operations on given file, or on files under it if its directory. Requires the affected list sorted """
+      low  = 0
+      high = len( self.affected )
+      while low < high:
+         middle = (low + high) // 2
+         if self.affected[middle][0] < filename:
+            low = middle + 1
+         else:
+            high = middle
+      
+      found = []
+      for af in self.affected[low:]:
+         if not af[0].startswith( filename ):
+            break
+         if len(af[0]) == len(filename) or filename[-1] == CONFIG.PATH_SEPARATOR or af[0][len(filename)] == CONFIG.PATH_SEPARATOR:
+            found.append( af )
+      return found
+   
    
    
    
@@ -125,8 +160,9 @@ class Operation( DatabaseObjectBase ):
    OP_DEL = "del"
    OP_MODIFY = "mod"
    OP_REVERT    = "rev"
+   OP_MOVE   = "mov" # Extra is the source filename. The source has OP_DEL with the target as extra.
    
-   OPERATIONS = (OP_ADD, OP_DEL, OP_MODIFY, OP_REVERT, )
+   OPERATIONS = (OP_ADD, OP_DEL, OP_MODIFY, OP_REVERT, OP_MOVE, )
    
    def __init__(self, filename : str, operation : str = None, extra : str = None ) -> None:
       
@@ -177,6 +213,54 @@ class DatabaseBase( metaclass=ABCMeta ):
        """ Load given json into database """
        pass
    
+    @abstractmethod
+    def replica_uid( self ) -> str:
+       """ Unique id of this replica of the repository """
+       pass
+   
+    @abstractmethod
+    def generation( self ) -> int:
+       """ Counter that grows on every change to the stored files or commits """
+       pass
+   
+    @abstractmethod
+    def generation_set( self, generation : int ) -> None:
+       """ Set the counter, and make the entries changed after it look like changed at it """
+       pass
+   
+    @abstractmethod
+    def tree_hash( self, dirname : str ) -> str:
+       """ Hash over the (filename, checksum, last commit) of all files under the directory ("" for the root), 
+           or None if there are no files under it. Equal hashes mean that the subtrees are in sync """
+       pass
+   
+    @abstractmethod
+    def tree_list( self, dirname : str ) -> Tuple[ List[str], List[str] ]:
+       """ Return the subdirectories and files directly under the directory, both as full paths """
+       pass
+   
+    @abstractmethod
+    def tree_files( self, dirname : str ) -> Iterable[ str ]:
+       """ Return all files under the directory, at any depth, as full paths """
+       pass
+   
+    @abstractmethod
+    def changes_dumps( self, since : int ) -> str:
+       """ Give the entries changed after given generation as json """
+       pass
+   
+    @abstractmethod
+    def select_dumps( self, rules : 'SyncRules', since : int = None ) -> str:
+       """ Give the files selected by the rules as json, all or the ones changed after given generation as in changes_dumps().
+           The commits are given all the same, as they are not tied to the subtrees """
+       pass
+   
+    @abstractmethod
+    def changes_loads( self, json_str : str, mirror : bool ) -> None:
+       """ Apply changes from changes_dumps(). With mirror the generations are taken as they are, 
+           otherwise the changes are counted as new ones made to this database """
+       pass
+   
     @abstractmethod
     def open_from_path( self, path : str ):
       """ Open the datase file from given path. """
@@ -206,6 +290,11 @@ class DatabaseBase( metaclass=ABCMeta ):
        """ Return metadata from the filename """
        pass
     
+    @abstractmethod  
+    def meta_get_many( self, filenames : Iterable[str] ) -> Iterable[ Meta ]:
+       """ Return metadata of given files, files not in database are skipped """
+       pass
+    
     @abstractmethod  
     def meta_set( self, meta : Meta ):
        pass
@@ -223,6 +312,11 @@ class DatabaseBase( metaclass=ABCMeta ):
        """ Add filename with given operation to db """
        pass
     
+    @abstractmethod  
+    def staging_add_many( self, operations : Iterable[ Operation ] ) -> List[ str ]:
+       """ Add operations in one batch. Returns filenames that had operation already pending, those are not added """
+       pass
+    
     @abstractmethod  
     def staging_list( self ) -> Iterable[ Operation ]:
        pass
@@ -252,6 +346,11 @@ class DatabaseBase( metaclass=ABCMeta ):
     def commit_list( self, sort_by : str = None, limit : int = 0, keys : Set[str] = None ) -> Iterable[ Commit ]:
        pass
     
+    @abstractmethod
+    def commit_history( self, filenames : Sequence[str] = None, since : float = None ) -> Iterable[ Commit ]:
+       """ Iterate commits affecting given files or directories (or all commits), newest first """
+       pass
+    
     def _prepare_search_key( self, key_starts_with ):
        if key_starts_with == None:
           return None
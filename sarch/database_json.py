@@ -1,8 +1,10 @@
 import json
 import os
+import bisect
+import hashlib
 from pathlib import Path
 
-from typing import Iterable, Set
+from typing import Iterable, Set, List, Tuple, Sequence, Any, Dict
 
 
 from .database import *
@@ -10,14 +12,173 @@ from .database import *
 
 class DatabaseJson( DatabaseBase ):
    
-   DEFAULT_DATABASE = { 'version_major' : 0, 'version_minor' : 1, 'stor' : {}, 'stag' : {}, 'commit' : {}, "status" : DatabaseBase.STATUS_CLEAR }
+   DEFAULT_DATABASE = { 'version_major' : 0, 'version_minor' : 4, 'stor' : {}, 'stag' : {}, 'commit' : {}, "status" : DatabaseBase.STATUS_CLEAR,
+                        'gen' : 0, 'gen_stor' : {}, 'gen_commit' : {}, 'tree' : {} }
+   GENERATION_TABLES = { 'stor' : 'gen_stor', 'commit' : 'gen_commit' }
+   DERIVED_KEYS = ( 'tree', ) # Maintained by each end itself, never exchanged as changes
+   TREE_MODULO = (2**128)
    
    def __init__(self):
        self.db = {} # type: Dict[ str, Any ]
        self.db_file = None # type: str
        self._find_table_name = None
        self._find_table = None
-       
+       self._index_clear()
+   
+   def _index_clear( self ) -> None:
+       self._key_index    = None # type: List[str]
+       self._commit_index = None # type: List[Tuple[float,str]]
+   
+   def _key_index_get( self ) -> List[str]:
+       """ Sorted list of the stor keys, used for the prefix searches """
+       if self._key_index == None:
+          self._key_index = sorted( self.db["stor"].keys() )
+       return self._key_index
+   
+   def _commit_index_get( self ) -> List[Tuple[float,str]]:
+       """ List of (timestamp, uid) sorted by the commit timestamp """
+       if self._commit_index == None:
+          idx_time = Commit.JSON_MAPPING.index("timestamp")
+          self._commit_index = sorted( (item[idx_time], uid) for (uid, item) in self.db["commit"].items() )
+       return self._commit_index
+   
+   def _upgrade( self ) -> None:
+       # Version 0.2: the commit affected lists are stored sorted by filename
+       if self.db["version_minor"] < 2:
+          for item in self.db["commit"].values():
+             item[ Commit.JSON_MAPPING.index("affected") ].sort( key=lambda x: x[0] )
+          self.db["version_minor"] = 2
+       # Version 0.3: replica uid and the generation of the last change for each entry
+       if self.db["version_minor"] < 3:
+          self.db["uid"] = str( make_uid() )
+          self.db["gen"] = 0
+          self.db["gen_stor"]   = { key : 0 for key in self.db["stor"] }
+          self.db["gen_commit"] = { key : 0 for key in self.db["commit"] }
+          self.db["version_minor"] = 3
+       # Version 0.4: hashes of the directory trees
+       if self.db["version_minor"] < 4:
+          self.db["tree"] = {}
+          for ( filename, value ) in self.db["stor"].items():
+             self._tree_update( filename, None, value )
+          self.db["version_minor"] = 4
+   
+   @staticmethod
+   def _tree_entry_hash( filename : str, value : List[Any] ) -> int:
+       commits = value[ Meta.JSON_MAPPING.index("last_commits") ]
+       entry = "%s\0%s\0%s" % ( filename, value[ Meta.JSON_MAPPING.index("checksum") ], commits[-1] if len(commits) > 0 else "" )
+       return int( hashlib.md5( bytes( entry, "utf8" ) ).hexdigest(), 16 )
+   
+   def _tree_update( self, filename : str, value_old : List[Any], value_new : List[Any] ) -> None:
+       """ The directory hash is sum of its entry hashes, so one entry change updates just the directories above it """
+       change = self._tree_entry_hash( filename, value_new )
+       if value_old != None:
+          change -= self._tree_entry_hash( filename, value_old )
+       if change == 0:
+          return
+       tree  = self.db["tree"]
+       parts = filename.split( CONFIG.PATH_SEPARATOR )
+       for loop in range( len(parts) ):
+          dirname = CONFIG.PATH_SEPARATOR.join( parts[ 0 : loop ] )
+          value = int( tree.get( dirname, "0" ), 16 )
+          tree[ dirname ] = "%032x" % ( ( value + change ) % self.TREE_MODULO )
+   
+   def tree_hash( self, dirname : str ) -> str:
+       return self.db["tree"].get( dirname )
+   
+   def tree_list( self, dirname : str ) -> Tuple[ List[str], List[str] ]:
+       prefix = dirname + CONFIG.PATH_SEPARATOR if dirname != "" else ""
+       keys = self._key_index_get()
+       subdirs = [] # type: List[str]
+       files   = [] # type: List[str]
+       index = bisect.bisect_left( keys, prefix )
+       while index < len(keys) and keys[index].startswith( prefix ):
+          sep = keys[index].find( CONFIG.PATH_SEPARATOR, len(prefix) )
+          if sep < 0:
+             files.append( keys[index] )
+             index += 1
+             continue
+          # Jump over the whole subdirectory
+          subdirs.append( keys[index][ 0 : sep ] )
+          index = bisect.bisect_left( keys, keys[index][ 0 : sep ] + chr( ord( CONFIG.PATH_SEPARATOR ) + 1 ), index )
+       return ( subdirs, files )
+   
+   def tree_files( self, dirname : str ) -> Iterable[ str ]:
+       return self._key_list_prefix( dirname + CONFIG.PATH_SEPARATOR if dirname != "" else "" )
+   
+   def _generation_touch( self, table : str, key : str ) -> None:
+       self.db["gen"] += 1
+       self.db[ self.GENERATION_TABLES[ table ] ][ key ] = self.db["gen"]
+   
+   def replica_uid( self ) -> str:
+       return self.db["uid"]
+   
+   def generation( self ) -> int:
+       return self.db["gen"]
+   
+   def generation_set( self, generation : int ) -> None:
+       for gen_table in self.GENERATION_TABLES.values():
+          for ( key, gen ) in self.db[ gen_table ].items():
+             if gen > generation:
+                self.db[ gen_table ][ key ] = generation
+       self.db["gen"] = generation
+   
+   def changes_dumps( self, since : int ) -> str:
+       return json.dumps( self._changes( since ) )
+   
+   def _changes( self, since : int, stor_keys : Iterable[str] = None ) -> Dict[ str, Any ]:
+       """ The entries changed after the generation, of the stor table only the given keys if any """
+       changes = { key : value for ( key, value ) in self.db.items() 
+                   if key not in self.GENERATION_TABLES and key not in self.GENERATION_TABLES.values() and key not in self.DERIVED_KEYS }
+       for ( table, gen_table ) in self.GENERATION_TABLES.items():
+          gens = self.db[ gen_table ]
+          if table == "stor" and stor_keys != None:
+             changed = { key : gens[ key ] for key in stor_keys if gens[ key ] > since }
+          else:
+             changed = { key : gen for ( key, gen ) in gens.items() if gen > since }
+          changes[ table ]    = { key : self.db[ table ][ key ] for key in changed }
+          changes[ gen_table ] = changed
+       return changes
+   
+   def _select_keys( self, rules : SyncRules ) -> List[str]:
+       """ Files selected by the rules, found through the prefix index """
+       if len( rules.include ) == 0 or "" in rules.include:
+          candidates = self.db["stor"].keys() # type: Iterable[str]
+       else:
+          candidates = set( key for prefix in rules.include for key in self._key_list_prefix( prefix ) )
+       return [ key for key in candidates if rules.wanted( key ) ]
+   
+   def select_dumps( self, rules : SyncRules, since : int = None ) -> str:
+       if since != None:
+          return json.dumps( self._changes( since, self._select_keys( rules ) ) )
+       selected = dict( self.db )
+       keys = self._select_keys( rules )
+       selected["stor"]     = { key : self.db["stor"][key] for key in keys }
+       selected["gen_stor"] = { key : self.db["gen_stor"][key] for key in keys }
+       selected["tree"]     = { dirname : value for ( dirname, value ) in self.db["tree"].items() if rules.dir_wanted( dirname ) }
+       return json.dumps( selected )
+   
+   def changes_loads( self, json_str : str, mirror : bool ) -> None:
+       changes = json.loads( json_str )
+       for key in self.DERIVED_KEYS:
+          changes.pop( key, None )
+       for ( filename, value ) in changes["stor"].items():
+          self._tree_update( filename, self.db["stor"].get( filename ), value )
+       for ( table, gen_table ) in self.GENERATION_TABLES.items():
+          self.db[ table ].update( changes.pop( table ) )
+          gens = changes.pop( gen_table )
+          if mirror:
+             self.db[ gen_table ].update( gens )
+          else:
+             for key in sorted( gens, key=gens.get ):
+                self._generation_touch( table, key )
+       if mirror == False:
+          # The replica identity and counter stay our own
+          for key in ( "uid", "gen", "version_major", "version_minor" ):
+             changes.pop( key, None )
+       self.db.update( changes )
+       self._index_clear()
+       self._find_table = None
+   
    @staticmethod
    def get_database_file( path : str ) -> str:
       return os.path.join( path, "database.json" )
@@ -35,8 +196,9 @@ class DatabaseJson( DatabaseBase ):
    
    def create_to_path( self, path : str, name : str ) -> None:
       self.db_file = self.get_database_file(path)
-      self.db = dict( self.DEFAULT_DATABASE )
+      self.db = json.loads( json.dumps( self.DEFAULT_DATABASE ) ) # Deep copy
       self.db["name"] = name
+      self.db["uid"] = str( make_uid() )
       self.save()
 
    def json_dumps( self ) -> str:
@@ -44,6 +206,9 @@ class DatabaseJson( DatabaseBase ):
       
    def json_loads( self, json_str ) -> None:
        self.db = json.loads( json_str )
+       self._index_clear()
+       self._find_table = None
+       self._upgrade()
    
    def save( self ) -> None:
       real_target = Path( self.db_file )
@@ -65,9 +230,20 @@ class DatabaseJson( DatabaseBase ):
        except KeyError:
           raise SA_DB_Exception_NotFound( "File not found from database: '%s'" % filename )
 
+   def meta_get_many( self, filenames : Iterable[str] ) -> Iterable[ Meta ]:
+       stor = self.db["stor"]
+       for filename in filenames:
+          obj = stor.get( filename )
+          if obj == None:
+             continue
+          meta = Meta( filename )
+          meta.json_from( obj )
+          yield meta
+
    def meta_find( self, checksum : str ) -> Meta:
        if self._find_table == None or self._find_table_name != "meta_checksum" :
           self._find_table = {}
+          self._find_table_name = "meta_checksum"
           idx_find = Meta.JSON_MAPPING.index("checksum")
           for (filename,meta_list) in self.db["stor"].items() :
              cs = meta_list[idx_find]
@@ -85,22 +261,32 @@ class DatabaseJson( DatabaseBase ):
       return ( len( self.db["commit"]), len( self.db["stor"]), len( self.db["stag"]) )
          
    def meta_set( self, meta : Meta ) -> None:
-       self.db["stor"][meta.filename] = meta.json_to()
+       if self._key_index != None and meta.filename not in self.db["stor"]:
+          bisect.insort( self._key_index, meta.filename )
+       value = meta.json_to()
+       self._find_table = None
+       self._tree_update( meta.filename, self.db["stor"].get( meta.filename ), value )
+       self.db["stor"][meta.filename] = value
+       self._generation_touch( "stor", meta.filename )
 
    def meta_list( self, key_starts_with : str = None ) ->  Iterable[ Meta ]:
-      
-      key_starts_with = self._prepare_search_key(key_starts_with)
-         
-      for key, obj in self.db["stor"].items():
-         if key_starts_with != None:
-            if not key.startswith( key_starts_with ):
-               continue
+      for key in self.meta_list_keys( key_starts_with ):
          meta = Meta( key )
-         meta.json_from( obj )
+         meta.json_from( self.db["stor"][key] )
          yield meta
          
-   def meta_list_keys( self ) -> Iterable[ str ]:
-       return self.db["stor"].keys()
+   def meta_list_keys( self, key_starts_with : str = None ) -> Iterable[ str ]:
+       key_starts_with = self._prepare_search_key(key_starts_with)
+       if key_starts_with == None:
+          return self.db["stor"].keys()
+       return self._key_list_prefix( key_starts_with )
+   
+   def _key_list_prefix( self, key_starts_with : str ) -> Iterable[ str ]:
+       keys = self._key_index_get()
+       for index in range( bisect.bisect_left( keys, key_starts_with ), len(keys) ):
+          if not keys[index].startswith( key_starts_with ):
+             return
+          yield keys[index]
    
    def staging_add( self, operation : Operation ) -> None:
        if operation.filename in self.db["stag"]:
@@ -108,6 +294,14 @@ class DatabaseJson( DatabaseBase ):
        
        self.db["stag"][operation.filename] = operation.json_to()
 
+   def staging_add_many( self, operations : Iterable[ Operation ] ) -> List[ str ]:
+       to_add = { op.filename : op.json_to() for op in operations }
+       conflicts = sorted( to_add.keys() & self.db["stag"].keys() )
+       for filename in conflicts:
+          del to_add[ filename ]
+       self.db["stag"].update( to_add )
+       return conflicts
+       
    def staging_clear( self ) -> None:
        self.db["stag"] = {}
        
@@ -124,7 +318,11 @@ class DatabaseJson( DatabaseBase ):
           yield op
           
    def commit_add( self, commit : Commit ) -> None:
+       commit.affected_sort()
+       if self._commit_index != None and commit.uid not in self.db["commit"]:
+          bisect.insort( self._commit_index, (commit.timestamp, commit.uid) )
        self.db["commit"][ commit.uid ] = commit.json_to()
+       self._generation_touch( "commit", commit.uid )
        
    def commit_get( self, uid : str ) -> Commit:
       try:
@@ -156,8 +354,40 @@ class DatabaseJson( DatabaseBase ):
          commit = Commit()
          commit.json_from( item )
          yield commit 
-         if n_returns >= limit:
+         if limit > 0 and n_returns >= limit:
             return
+   
+   def commit_history( self, filenames : Sequence[str] = None, since : float = None ) -> Iterable[ Commit ]:
+      idx_commits = Meta.JSON_MAPPING.index("last_commits")
+      idx_time    = Commit.JSON_MAPPING.index("timestamp")
+      
+      uids_files = set() # type: Set[str]
+      match_all = (filenames == None or len(filenames) == 0)
+      
+      for filename in (filenames or ()):
+         key = self._prepare_search_key( filename )
+         if key != None:
+            key = key.rstrip( CONFIG.PATH_SEPARATOR )
+         if key == None or len(key) == 0:
+            match_all = True
+         elif key in self.db["stor"]:
+            uids_files.update( self.db["stor"][key][idx_commits] )
+         else:
+            # Directory: the commit lists of the files under it, found through the key index
+            for key_under in self._key_list_prefix( key + CONFIG.PATH_SEPARATOR ):
+               uids_files.update( self.db["stor"][key_under][idx_commits] )
+      
+      if match_all:
+         candidates = reversed( self._commit_index_get() ) # type: Iterable[ Tuple[ float, str ] ]
+      else:
+         candidates = sorted( ( (self.db["commit"][uid][idx_time], uid) for uid in uids_files if uid in self.db["commit"] ), reverse = True )
+      
+      for (timestamp, uid) in candidates:
+         if since != None and timestamp < since:
+            return
+         commit = Commit()
+         commit.json_from( self.db["commit"][uid] )
+         yield commit
     
 
 
@@ -0,0 +1,288 @@
+import hashlib
+import struct
+import math
+import os
+from itertools import accumulate
+
+from typing import Iterable, Dict, List, Any, Tuple
+
+from .exceptions import SA_Exception
+from .common import CONFIG
+
+
+class SA_Delta_Exception( SA_Exception ):
+   pass
+
+
+# The delta stream is sequence of records:
+#   'L' <uint32 length> <length bytes of literal data>
+#   'B' <uint32 block index> <uint32 block count>  -- data copied from the basis file
+RECORD_LITERAL = b"L"
+RECORD_BLOCKS  = b"B"
+_HEADER_LITERAL = struct.Struct(">I")
+_HEADER_BLOCKS  = struct.Struct(">II")
+
+Signature = Dict[ str, Any ]
+
+
+def block_size_for( file_size : int ) -> int:
+   """ Block size for signature of the basis file, around square root of the size like rsync does """
+   size = int( math.sqrt( file_size ) ) & ~0x3FF
+   return max( CONFIG.DELTA_BLOCK_MIN, min( CONFIG.DELTA_BLOCK_MAX, size ) )
+
+
+def _weak_checksum( window : bytes ) -> Tuple[int,int]:
+   # a = sum of bytes, b = sum of prefix sums == sum( (L-i) * x_i ). Both run in C.
+   return ( sum( window ) & 0xFFFF, sum( accumulate( window ) ) & 0xFFFF )
+
+
+def _strong_checksum( window : bytes ) -> str:
+   return hashlib.md5( window ).hexdigest()[0:16]
+
+
+def signature( data_source : Iterable[bytes], block_size : int ) -> Signature:
+   """ Calculate the block signatures (rolling weak checksum and strong checksum) of the basis file """
+   weak   = [] # type: List[int]
+   strong = [] # type: List[str]
+   buf = bytearray()
+
+   def add_block( block : bytes ) -> None:
+      ( a, b ) = _weak_checksum( block )
+      weak.append( a | (b << 16) )
+      strong.append( _strong_checksum( block ) )
+
+   for data in data_source:
+      buf += data
+      if len(buf) < block_size:
+         continue
+      n_full = len(buf) - ( len(buf) % block_size )
+      for offset in range( 0, n_full, block_size ):
+         add_block( bytes( buf[ offset : offset + block_size ] ) )
+      del buf[ 0 : n_full ]
+   # The last partial block is not added, its content will be sent as literal if needed
+   return { "block" : block_size, "weak" : weak, "strong" : strong }
+
+
+def signature_file( filename : str ) -> Signature:
+   """ Signature of the basis file on disk """
+   block_size = block_size_for( os.stat( filename ).st_size )
+
+   def read_blocks() -> Iterable[bytes]:
+      with open( filename, 'rb' ) as fid:
+         while True:
+            data = fid.read( CONFIG.DATA_BLOCK_SIZE )
+            if len(data) == 0:
+               return
+            yield data
+
+   return signature( read_blocks(), block_size )
+
+
+class _Encoder:
+   """ Collects records into chunks suitable for the data stream """
+
+   def __init__( self ) -> None:
+      self.out = bytearray()
+      self.run_start = -1
+      self.run_count = 0
+
+   def _flush_run( self ) -> None:
+      if self.run_count > 0:
+         self.out += RECORD_BLOCKS + _HEADER_BLOCKS.pack( self.run_start, self.run_count )
+         self.run_count = 0
+
+   def literal( self, data : bytes ) -> None:
+      if len(data) == 0:
+         return
+      self._flush_run()
+      self.out += RECORD_LITERAL + _HEADER_LITERAL.pack( len(data) ) + data
+
+   def block( self, index : int ) -> None:
+      if self.run_count > 0 and self.run_start + self.run_count == index:
+         self.run_count += 1
+         return
+      self._flush_run()
+      self.run_start = index
+      self.run_count = 1
+
+   def take( self, final : bool = False ) -> bytes:
+      if final:
+         self._flush_run()
+      if len(self.out) < CONFIG.DATA_BLOCK_SIZE and final == False:
+         return b""
+      to_ret = bytes( self.out )
+      self.out = bytearray()
+      return to_ret
+
+
+def delta( sig : Signature, data_source : Iterable[bytes] ) -> Iterable[bytes]:
+   """ Encode the data as delta against the basis file with given signature """
+   for chunk in _delta_chunks( sig, data_source ):
+      if len(chunk) > 0:
+         yield chunk
+
+
+def _delta_chunks( sig : Signature, data_source : Iterable[bytes] ) -> Iterable[bytes]:
+   block_size = int( sig["block"] )
+   strongs    = sig["strong"]
+   table = {} # type: Dict[int, List[int]]
+   for index, weak in enumerate( sig["weak"] ):
+      table.setdefault( weak, [] ).append( index )
+
+   encoder = _Encoder()
+   source  = iter( data_source )
+   buf = bytearray()
+   consumed = 0       # Bytes dropped from the start of buf, to know the offset of the window in the data
+   pos = 0            # Start of the current window
+   literal_start = 0  # Start of data not yet encoded
+   expected = -1      # Block that most likely comes next
+   missed = 0         # Bytes rolled over since the last match
+   eof = False
+
+   def fill( needed : int ) -> bool:
+      nonlocal eof
+      while len(buf) < needed and eof == False:
+         try:
+            buf.extend( next( source ) )
+         except StopIteration:
+            eof = True
+      return len(buf) >= needed
+
+   def drop( count : int ) -> None:
+      nonlocal pos, literal_start, consumed
+      del buf[ 0 : count ]
+      consumed += count
+      pos = 0
+      literal_start = 0
+
+   def match( index : int ) -> None:
+      nonlocal expected, missed
+      encoder.literal( bytes( buf[ literal_start : pos ] ) )
+      encoder.block( index )
+      drop( pos + block_size )
+      expected = index + 1
+      missed = 0
+
+   def lookup( a : int, b : int ) -> bool:
+      """ Match the current window by its weak checksum """
+      candidates = table.get( a | (b << 16) )
+      if candidates == None:
+         return False
+      strong = _strong_checksum( bytes( buf[ pos : pos + block_size ] ) )
+      for index in candidates:
+         if strongs[index] == strong:
+            match( index )
+            return True
+      return False
+
+   while fill( pos + block_size ):
+      window = bytes( buf[ pos : pos + block_size ] )
+
+      # Fast path: the next block continues the earlier match
+      if 0 <= expected < len(strongs) and _strong_checksum( window ) == strongs[ expected ]:
+         match( expected )
+         yield encoder.take()
+         continue
+
+      ( a, b ) = _weak_checksum( window )
+      if missed >= CONFIG.DELTA_MISS_MAX:
+         # Rolling is slow, and there has been nothing in common with the basis for a while. Only the windows at
+         # block boundaries are looked up, until one matches, as unchanged data after in-place edit is found there
+         if lookup( a, b ) == False:
+            pos += block_size - ( consumed + pos ) % block_size
+            missed += block_size
+            if pos - literal_start >= CONFIG.DATA_BLOCK_SIZE:
+               encoder.literal( bytes( buf[ literal_start : pos ] ) )
+               drop( pos )
+         yield encoder.take()
+         continue
+
+      while lookup( a, b ) == False:
+         # Roll the window one byte forward
+         if fill( pos + block_size + 1 ) == False:
+            break
+         byte_out = buf[pos]
+         a = ( a - byte_out + buf[ pos + block_size ] ) & 0xFFFF
+         b = ( b - block_size * byte_out + a ) & 0xFFFF
+         pos += 1
+         missed += 1
+
+         if pos - literal_start >= CONFIG.DATA_BLOCK_SIZE:
+            encoder.literal( bytes( buf[ literal_start : pos ] ) )
+            drop( pos )
+            yield encoder.take()
+
+         if missed >= CONFIG.DELTA_MISS_MAX:
+            break
+      else:
+         yield encoder.take()
+         continue
+      if missed < CONFIG.DELTA_MISS_MAX:
+         break # End of the data
+      yield encoder.take()
+
+   # Rest of the data is literal
+   encoder.literal( bytes( buf[ literal_start : ] ) )
+   yield encoder.take()
+   for data in source:
+      encoder.literal( bytes( data ) )
+      yield encoder.take()
+   yield encoder.take( final = True )
+
+
+class _Reader:
+   """ Read exact amounts of data from stream of arbitrary sized chunks """
+
+   def __init__( self, data_source : Iterable[bytes] ) -> None:
+      self.source = iter( data_source )
+      self.buf = bytearray()
+
+   def read_upto( self, count : int ) -> bytes:
+      """ Return at least one byte and at most count, or empty if at the end """
+      if len(self.buf) == 0:
+         for data in self.source:
+            if len(data) > 0:
+               self.buf += data
+               break
+      to_ret = bytes( self.buf[0:count] )
+      del self.buf[0:count]
+      return to_ret
+
+   def read( self, count : int ) -> bytes:
+      to_ret = bytearray()
+      while len(to_ret) < count:
+         data = self.read_upto( count - len(to_ret) )
+         if len(data) == 0:
+            raise SA_Delta_Exception("Delta stream ended unexpectedly")
+         to_ret += data
+      return bytes( to_ret )
+
+
+def patch( basis_filename : str, sig_block_size : int, delta_source : Iterable[bytes] ) -> Iterable[bytes]:
+   """ Rebuild the file from the basis file and the delta stream """
+   reader = _Reader( delta_source )
+   with open( basis_filename, 'rb' ) as basis:
+      while True:
+         record = reader.read_upto( 1 )
+         if len(record) == 0:
+            return
+         if record == RECORD_LITERAL:
+            ( length, ) = _HEADER_LITERAL.unpack( reader.read( _HEADER_LITERAL.size ) )
+            while length > 0:
+               data = reader.read_upto( min( length, CONFIG.DATA_BLOCK_SIZE ) )
+               if len(data) == 0:
+                  raise SA_Delta_Exception("Delta stream ended unexpectedly")
+               length -= len(data)
+               yield data
+         elif record == RECORD_BLOCKS:
+            ( index, count ) = _HEADER_BLOCKS.unpack( reader.read( _HEADER_BLOCKS.size ) )
+            basis.seek( index * sig_block_size )
+            length = count * sig_block_size
+            while length > 0:
+               data = basis.read( min( length, CONFIG.DATA_BLOCK_SIZE ) )
+               if len(data) == 0:
+                  raise SA_Delta_Exception("Basis file '%s' too short" % basis_filename )
+               length -= len(data)
+               yield data
+         else:
+            raise SA_Delta_Exception("Invalid delta record %r" % record )
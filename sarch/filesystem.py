@@ -2,9 +2,10 @@
 import os
 import hashlib
 import shutil
+from stat import S_ISREG, S_ISDIR
 
 from pathlib import Path
-from typing import Iterable, Tuple, Union, Dict, Set, Sequence
+from typing import Iterable, Tuple, Union, Dict, Set, Sequence, Any, List
 
 from .exceptions import SA_Exception
 from .database import Meta
@@ -25,6 +26,29 @@ class SA_FS_Exception_UnSupportedType( SA_FS_Exception ):
 class SA_FS_Exception_ChecksumError( SA_FS_Exception ):
    pass
 
+FICLONE = 0x40049409 # From linux/fs.h
+
+def _reflink( source : str, target : str ) -> bool:
+   """ Make target share the data blocks of source, returns False if not supported """
+   try:
+      import fcntl
+   except ImportError:
+      return False
+   with open( source, 'rb' ) as fid_source, open( target, 'wb' ) as fid_target:
+      try:
+         fcntl.ioctl( fid_target.fileno(), FICLONE, fid_source.fileno() )
+         return True
+      except OSError:
+         pass
+   os.unlink( target )
+   return False
+
+def stat_is_file( stat : os.stat_result ) -> bool:
+   return S_ISREG( stat.st_mode )
+
+def stat_is_dir( stat : os.stat_result ) -> bool:
+   return S_ISDIR( stat.st_mode )
+
 class PathType: 
    FILE   = "FILE"
    DIR    = "DIR"
@@ -100,12 +124,63 @@ class Filesystem:
       return int( timestamp )
                  
    def get_modtime( self, path: Union[ Path, str ] ) -> int:
+      return self.make_time( self.stat( path ).st_mtime )
+   
+   def stat( self, path: Union[ Path, str ] ) -> os.stat_result:
       target = self._make_absolute( path )
       try:
-         disk_time = target.stat().st_mtime 
+         return target.stat()
       except FileNotFoundError:
          raise SA_FS_Exception_NotFound("File not found %s" % path )
-      return self.make_time( disk_time )
+   
+   def disk_order( self, filenames : Iterable[str], max_size : int ) -> List[str]:
+      """ The existing files smaller than max_size, ordered by the inode number that roughly follows the placement on disk """
+      found = [] # type: List[ Tuple[ int, str ] ]
+      for filename in filenames:
+         try:
+            stat = self.stat( filename )
+         except SA_FS_Exception_NotFound:
+            continue
+         if stat.st_size < max_size:
+            found.append( ( stat.st_ino, filename ) )
+      return [ filename for ( ino, filename ) in sorted( found ) ]
+   
+   def scan_files( self, abstract_filename : str ) -> Iterable[ Tuple[ str, os.stat_result ] ]:
+      """ Walk files like recursive_walk_files, but with os.scandir and give the stat result along the filename """
+      target_absolute = self._make_absolute( abstract_filename )
+      target_relative = self._make_relative_single( str(target_absolute) )
+      
+      if self.is_blacklisted( target_relative ):
+         return
+      try:
+         stat = target_absolute.stat()
+      except FileNotFoundError:
+         raise SA_FS_Exception_NotFound( "File does not exists: %s" % target_relative )
+      
+      if stat_is_file( stat ):
+         yield ( target_relative, stat )
+         return
+      if not stat_is_dir( stat ):
+         raise SA_FS_Exception_UnSupportedType( target_relative )
+      
+      if target_relative == ".":
+         prefix = ""
+      else:
+         prefix = target_relative + CONFIG.PATH_SEPARATOR
+      
+      to_walk = [ (str(target_absolute), prefix) ]
+      while len(to_walk) > 0:
+         (path, prefix) = to_walk.pop()
+         for entry in os.scandir( path ):
+            relative = prefix + entry.name
+            if self.is_blacklisted( relative ):
+               continue
+            if entry.is_dir():
+               to_walk.append( ( entry.path, relative + CONFIG.PATH_SEPARATOR ) )
+            elif entry.is_file():
+               yield ( relative, entry.stat() )
+            else:
+               raise SA_FS_Exception_UnSupportedType( relative )
    
    def recursive_walk_files( self, abstract_filename : str ) -> Iterable[str]:
       target_absolute = self._make_absolute( abstract_filename )
@@ -127,20 +202,28 @@ class Filesystem:
    def _checksum_init( self ):
       return hashlib.md5()
    
-   def file_create( self, meta : Meta, data_source : Iterable[bytes] ):
+   def file_create( self, meta : Meta, data_source : Iterable[bytes], offset : int = None, verify : bool = True ):
+      """ Write the file through temporary file. If offset is given, the temporary file is kept in the partial directory
+          by the checksum, and data_source continues the partial file from the offset. So interrupted transfer can be resumed.
+          Without verify the checksum of the data is not checked """
       path = self._make_absolute( meta.filename )
       
       self.make_directories( path.parent )
       
-      if meta.checksum != Meta.CHECKSUM_NONE:
+      if meta.checksum != Meta.CHECKSUM_NONE and verify:
          cs_calc = self._checksum_init()
       else:
          cs_calc = None
       
       tlen = 0    
-      tmp_file = self._trash_prepare( meta.filename )
+      is_partial = offset != None and meta.checksum_normal()
+      if is_partial:
+         tmp_file = self._partial_prepare( meta.checksum )
+         tlen = self._partial_resume( tmp_file, offset, cs_calc )
+      else:
+         tmp_file = self._trash_prepare( meta.filename )
       
-      with open(  str(tmp_file) , 'wb' ) as fid:
+      with open(  str(tmp_file) , 'ab' if is_partial else 'wb' ) as fid:
          for data_in in data_source:
             if cs_calc:
                 cs_calc.update(data_in)
@@ -150,11 +233,28 @@ class Filesystem:
       self._file_set_modtime( str(tmp_file), meta.modtime )
       
       if cs_calc != None and cs_calc.hexdigest() != meta.checksum:
+            if is_partial:
+               tmp_file.unlink() # No point to resume from corrupted data
             raise SA_FS_Exception_ChecksumError("Checksum on file '%s' differs (calc: %s stored: %s), sized: %d" % (meta.filename, cs_calc.hexdigest(), meta.checksum, tlen ))
       
       tmp_file.rename( path )
       print_debug("Created file %s: %s" % (meta.filename, meta.checksum ))
    
+   def file_copy( self, source : Meta, target : Meta ) -> None:
+      """ Copy the file within this filesystem. Where the filesystem supports it, the copy is a reflink sharing the data 
+          with the source, and the data is not checked when the source has its modification time unchanged """
+      source_path = self._make_absolute( source.filename )
+      if self.get_modtime( source_path ) == source.modtime:
+         path = self._make_absolute( target.filename )
+         self.make_directories( path.parent )
+         tmp_file = self._trash_prepare( target.filename )
+         if _reflink( str(source_path), str(tmp_file) ):
+            self._file_set_modtime( str(tmp_file), target.modtime )
+            tmp_file.rename( path )
+            print_debug("Created file %s as reflink of %s" % ( target.filename, source.filename ) )
+            return
+      self.file_create( target, self.file_read( source.filename ) )
+   
    def file_exists( self, filename : str ):
       path = self._make_absolute( filename )
       return path.exists()
@@ -171,10 +271,12 @@ class Filesystem:
    def _file_set_modtime( self, filename : Union[ Path, str ], modtime : int ):
       os.utime( str(filename), (modtime, modtime ) )
       
-   def file_read( self, filename : str ):
+   def file_read( self, filename : str, offset : int = 0 ):
       path = self._make_absolute( filename )
       try:
          with open( str(path), 'rb' ) as fid:
+            if offset > 0:
+               fid.seek( offset )
             while True:
                data = fid.read( CONFIG.DATA_BLOCK_SIZE )
                if len(data) == 0:
@@ -183,11 +285,14 @@ class Filesystem:
       except FileNotFoundError:
         raise SA_FS_Exception_NotFound("File not found %s" % filename )
      
-   def meta_update( self, meta : Meta ):
+   def meta_update( self, meta : Meta, stat : os.stat_result = None ):
       path = self._make_absolute( meta.filename )
       
       cs_calc = self._checksum_init()
-      meta.modtime  = self.get_modtime( path )
+      if stat == None:
+         meta.modtime  = self.get_modtime( path )
+      else:
+         meta.modtime  = self.make_time( stat.st_mtime )
       data_n = 0
       try:
          with path.open('rb') as fid:
@@ -248,6 +353,14 @@ class Filesystem:
          
       return str( self._make_relative_single( target_full ) )
    
+   
+   def move_from( self, source_absolute : str, target_file : str ) -> None:
+      """ Rename file from outside of this filesystem into it, both must be on the same device """
+      target = self._make_absolute( target_file )
+      if target.exists():
+         raise SA_FS_Exception_Exists("Move target file '%s' exists" % target_file )
+      self.make_directories( target.parent )
+      os.rename( source_absolute, str(target) )
       
    def make_directories( self, path : Union[ Path, str ] ) -> None:
       source = self._make_absolute( path )
@@ -259,6 +372,45 @@ class Filesystem:
       self.make_directories( target_base )
       return target_full
    
+   def _partial_prepare( self, checksum : str ) -> Path:
+      path = self._make_absolute( CONFIG.PATH_PARTIAL )
+      self.make_directories( path )
+      return Path( path, checksum )
+   
+   def _partial_resume( self, partial_file : Path, offset : int, cs_calc : Any ) -> int:
+      """ Cut the partial file to offset, and feed the existing data to the checksum. Returns the offset """
+      with open( str(partial_file), 'ab' ) as fid:
+         if fid.tell() < offset:
+            raise SA_FS_Exception("Partial file '%s' has only %d bytes, cannot resume from %d" % ( partial_file.name, fid.tell(), offset ) )
+         fid.truncate( offset )
+      if offset > 0 and cs_calc != None:
+         with open( str(partial_file), 'rb' ) as fid:
+            while True:
+               data = fid.read( CONFIG.DATA_BLOCK_SIZE )
+               if len(data) == 0:
+                  break
+               cs_calc.update( data )
+      return offset
+   
+   def partial_size( self, checksum : str ) -> int:
+      """ Size of the partially transferred file with given checksum, 0 if there is none """
+      try:
+         return self._make_absolute( Path( CONFIG.PATH_PARTIAL, checksum ) ).stat().st_size
+      except FileNotFoundError:
+         return 0
+   
+   def partial_list( self ) -> Dict[ str, int ]:
+      """ All partially transferred files: checksum -> size """
+      path = self._make_absolute( CONFIG.PATH_PARTIAL )
+      if path.is_dir() == False:
+         return {}
+      return { entry.name : entry.stat().st_size for entry in path.iterdir() }
+   
+   def partial_clear( self ) -> None:
+      path = self._make_absolute( CONFIG.PATH_PARTIAL )
+      if path.is_dir():
+         shutil.rmtree( str( path ) )
+   
    def trash_add( self, path : str, missing_ok : bool = False ):
       """ Add given file to trash """
       source = self._make_absolute( path )
@@ -0,0 +1,103 @@
+import json
+import os
+import time
+from pathlib import Path
+
+from typing import Dict, List, Any
+
+from .common import CONFIG, print_debug
+
+
+class HashCache:
+   """ Checksums calculated for staged files, persisted periodically so that interrupted commit can be resumed.
+       Entries are valid only as long as the file size and modification time (ns) stay the same.
+       Checkpoints append only the new entries to a journal, which is replayed on open and merged on save. """
+
+   FILENAME = "hash_cache.json"
+   JOURNAL_FILENAME = "hash_cache.journal"
+
+   def __init__( self, path : str ) -> None:
+      self.cache_file   = os.path.join( path, self.FILENAME )
+      self.journal_file = os.path.join( path, self.JOURNAL_FILENAME )
+      self.entries = {} # type: Dict[ str, List[Any] ]
+      self.unsaved = [] # type: List[str]
+      self.time_saved = time.time()
+
+   def open( self ) -> int:
+      """ Load the cache left by earlier run, returns number of entries """
+      try:
+         with open( self.cache_file ) as fid:
+            self.entries = json.loads( fid.read() )
+      except FileNotFoundError:
+         self.entries = {}
+      except ValueError:
+         print_debug("Hash cache '%s' corrupted, ignoring it" % self.cache_file )
+         self.entries = {}
+      
+      try:
+         with open( self.journal_file ) as fid:
+            for line in fid:
+               try:
+                  ( filename, entry ) = json.loads( line )
+               except ValueError:
+                  # Write of the last line was interrupted
+                  print_debug("Hash cache journal '%s' truncated" % self.journal_file )
+                  break
+               self.entries[ filename ] = entry
+      except FileNotFoundError:
+         pass
+      return len( self.entries )
+
+   @staticmethod
+   def _stat_key( stat : os.stat_result ) -> List[int]:
+      return [ stat.st_size, stat.st_mtime_ns ]
+
+   def get( self, filename : str, stat : os.stat_result ) -> str:
+      """ Return the cached checksum, or None if its not known for this file version """
+      try:
+         entry = self.entries[ filename ]
+      except KeyError:
+         return None
+      if entry[0:2] != self._stat_key( stat ):
+         return None
+      return entry[2]
+
+   def set( self, filename : str, stat : os.stat_result, checksum : str ) -> None:
+      self.entries[ filename ] = self._stat_key( stat ) + [ checksum ]
+      self.unsaved.append( filename )
+
+   def checkpoint( self ) -> None:
+      """ Append the new entries to the journal if enough files or time has passed since the last checkpoint """
+      if len(self.unsaved) == 0:
+         return
+      if len(self.unsaved) < CONFIG.CHECKPOINT_FILES and time.time() - self.time_saved < CONFIG.CHECKPOINT_SECONDS:
+         return
+      with open( self.journal_file, 'ab' ) as fid:
+         for filename in self.unsaved:
+            fid.write( bytes( json.dumps( [ filename, self.entries[ filename ] ] ) + "\n", "utf8" ) )
+      self.unsaved = []
+      self.time_saved = time.time()
+
+   def save( self ) -> None:
+      """ Write all entries, replacing the journal """
+      real_target = Path( self.cache_file )
+      tmp_target  = Path( self.cache_file + ".tmp" )
+      with open( str(tmp_target), 'wb' ) as fid:
+         fid.write( bytes( json.dumps( self.entries ), "utf8" ) )
+      tmp_target.rename( real_target )
+      self._unlink( self.journal_file )
+      self.unsaved = []
+      self.time_saved = time.time()
+
+   def clear( self ) -> None:
+      self.entries = {}
+      self.unsaved = []
+      self._unlink( self.cache_file )
+      self._unlink( self.journal_file )
+
+   @staticmethod
+   def _unlink( filename : str ) -> None:
+      try:
+         os.unlink( filename )
+      except FileNotFoundError:
+         pass
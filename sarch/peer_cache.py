@@ -0,0 +1,42 @@
+import hashlib
+import os
+from pathlib import Path
+
+from .common import print_debug
+from .database_json import DatabaseJson
+
+
+class PeerCache:
+   """ Copy of a remote database as it was at the last exchange, so that later only the changes need to be transferred.
+       The generation of the cached copy is the watermark: everything the remote changed after it is unknown to us. """
+
+   def __init__( self, path : str, url : str ) -> None:
+      self.url = url
+      self.cache_file = os.path.join( path, hashlib.md5( bytes( url, "utf8" ) ).hexdigest() + ".json" )
+
+   def load( self ) -> DatabaseJson:
+      """ Return the cached database, or None if there is no usable cache """
+      db = DatabaseJson()
+      try:
+         with open( self.cache_file ) as fid:
+            db.json_loads( fid.read() )
+      except FileNotFoundError:
+         return None
+      except ( ValueError, KeyError ):
+         print_debug("Peer cache '%s' corrupted, ignoring it" % self.cache_file )
+         return None
+      return db
+
+   def save( self, db : DatabaseJson ) -> None:
+      os.makedirs( os.path.dirname( self.cache_file ), exist_ok = True )
+      real_target = Path( self.cache_file )
+      tmp_target  = Path( self.cache_file + ".tmp" )
+      with open( str(tmp_target), 'wb' ) as fid:
+         fid.write( bytes( db.json_dumps(), "utf8" ) )
+      tmp_target.rename( real_target )
+
+   def clear( self ) -> None:
+      try:
+         os.unlink( self.cache_file )
+      except FileNotFoundError:
+         pass
@@ -1,11 +1,15 @@
 
-from typing import Iterable, Tuple, Union, List, Dict, Set, Sequence, Callable
+from typing import Iterable, Tuple, Union, List, Dict, Set, Sequence, Callable, Any
 from abc import abstractmethod, ABCMeta
+import queue
+import threading
+import time
 
 from .exceptions import SA_Exception
-from .common import CONFIG, print_debug, print_info, read_input
-from .database import DatabaseBase, Meta, Commit, SA_DB_Exception_NotFound
+from .common import CONFIG, print_debug, print_info, print_error, read_input
+from .database import DatabaseBase, Meta, Commit, Operation, SA_DB_Exception_NotFound
 from .filesystem import Filesystem, SA_FS_Exception_NotFound
+from .sync_rules import SyncRules
 
 class SA_SYNC_Exception( SA_Exception ):
    pass
@@ -29,24 +33,115 @@ class SyncTable:
             return False
       return True
    
-   def detect_move_files( self, db : DatabaseBase ):
-      rmfrom_copy = []
-      rmfrom_delete = []
+   @staticmethod
+   def _meta_to( meta : Meta ) -> List[Any]:
+      return [ meta.filename ] + meta.json_to()
+   
+   @staticmethod
+   def _meta_from( values : List[Any] ) -> Meta:
+      meta = Meta( values[0] )
+      meta.json_from( values[1:] )
+      return meta
+   
+   def json_to( self ) -> Dict[ str, List[Any] ]:
+      return { "copy"       : [ self._meta_to( meta ) for meta in self.copy ],
+               "delete"     : [ self._meta_to( meta ) for meta in self.delete ],
+               "merged"     : [ self._meta_to( meta ) for meta in self.merged ],
+               "move"       : [ [ self._meta_to( source ), self._meta_to( target ) ] for ( source, target ) in self.move ],
+               "copy_local" : [ [ self._meta_to( source ), self._meta_to( target ) ] for ( source, target ) in self.copy_local ] }
+   
+   def json_from( self, obj : Dict[ str, List[Any] ] ) -> None:
+      self.copy       = [ self._meta_from( values ) for values in obj["copy"] ]
+      self.delete     = [ self._meta_from( values ) for values in obj["delete"] ]
+      self.merged     = [ self._meta_from( values ) for values in obj["merged"] ]
+      self.move       = [ ( self._meta_from( source ), self._meta_from( target ) ) for ( source, target ) in obj["move"] ]
+      self.copy_local = [ ( self._meta_from( source ), self._meta_from( target ) ) for ( source, target ) in obj["copy_local"] ]
+   
+   def remove_done( self, db : DatabaseBase, filesystem : Filesystem = None ) -> int:
+      """ Remove the operations, whose result is already in the database saved at a checkpoint. Returns number of them.
+          With the filesystem of the database, also the files written after the last checkpoint are found by their
+          modification time, and recorded to the database """
+      def in_db( meta : Meta ) -> bool:
+         try:
+            meta_db = db.meta_get( meta.filename )
+         except SA_DB_Exception_NotFound:
+            return False
+         return meta_db.checksum == meta.checksum and meta_db.modtime == meta.modtime
+      
+      def modtime_on_disk( filename : str ) -> int:
+         try:
+            return filesystem.get_modtime( filename )
+         except SA_FS_Exception_NotFound:
+            return None
+      
+      def written( meta : Meta ) -> bool:
+         """ The file has the planned modification time, and the database does not know it yet """
+         if filesystem == None or modtime_on_disk( meta.filename ) != meta.modtime:
+            return False
+         try:
+            return db.meta_get( meta.filename ).modtime != meta.modtime
+         except SA_DB_Exception_NotFound:
+            return True
+      
+      def done( meta : Meta ) -> bool:
+         if in_db( meta ):
+            return True
+         if written( meta ):
+            db.meta_set( meta )
+            return True
+         return False
+      
+      def done_move( source : Meta, target : Meta ) -> bool:
+         if in_db( source ) and in_db( target ):
+            return True
+         if written( target ) and modtime_on_disk( source.filename ) == None:
+            db.meta_set( source )
+            db.meta_set( target )
+            return True
+         return False
+      
+      n_before = len( self.copy ) + len( self.delete ) + len( self.merged ) + len( self.move ) + len( self.copy_local )
+      self.copy       = [ meta for meta in self.copy   if done( meta ) == False ]
+      self.delete     = [ meta for meta in self.delete if in_db( meta ) == False ]
+      self.merged     = [ meta for meta in self.merged if in_db( meta ) == False ]
+      self.move       = [ pair for pair in self.move   if done_move( pair[0], pair[1] ) == False ]
+      self.copy_local = [ pair for pair in self.copy_local if done( pair[1] ) == False ]
+      return n_before - ( len( self.copy ) + len( self.delete ) + len( self.merged ) + len( self.move ) + len( self.copy_local ) )
+   
+   def detect_move_files( self, db : DatabaseBase, db_from : DatabaseBase = None ):
+      rmfrom_copy   = set() # type: Set[int]
+      rmfrom_delete = set() # type: Set[int]
       
       to_delete_files =  { meta.filename : index for index, meta in enumerate(self.delete) }
       
       for (index, meta_copy) in enumerate(self.copy):
+         
+         # Moves recorded with the commit are replayed as such
+         if db_from != None:
+            moved_from = _find_move_source( meta_copy, db_from )
+            if moved_from in to_delete_files and to_delete_files[moved_from] not in rmfrom_delete:
+               try:
+                  if db.meta_get( moved_from ).checksum == meta_copy.checksum:
+                     index_in_delete = to_delete_files[moved_from]
+                     self.move.append( (self.delete[ index_in_delete ], meta_copy) )
+                     rmfrom_copy.add( index )
+                     rmfrom_delete.add( index_in_delete )
+                     print_debug("#SYNC:%s: move from %s in %s" % (meta_copy.filename, moved_from, self.name ) )
+                     continue
+               except SA_DB_Exception_NotFound:
+                  pass
+         
          try:
             meta_old = db.meta_find( checksum = meta_copy.checksum )
-            rmfrom_copy.append( index )
+            rmfrom_copy.add( index )
             assert( meta_old.checksum == meta_copy.checksum )
             
-            if meta_old.filename in to_delete_files:
+            if meta_old.filename in to_delete_files and to_delete_files[meta_old.filename] not in rmfrom_delete:
                index_in_delete = to_delete_files[meta_old.filename]
                meta_old = self.delete[ index_in_delete ]
                self.move.append( (meta_old, meta_copy) )
                op = "move"
-               rmfrom_delete.append( index_in_delete )
+               rmfrom_delete.add( index_in_delete )
             else:
                self.copy_local.append( (meta_old, meta_copy) )
                op = "copy_local"
@@ -62,6 +157,22 @@ class SyncTable:
       #print("DELETE LIST:" + str(rmfrom_delete))
       
          
+   def dedup_copies( self ) -> int:
+      """ Of the files to copy with the same content, only the first is transferred and the rest are copied locally from it.
+          The copies are done after the transfers. Returns number of the transfers saved """
+      first = {} # type: Dict[ str, Meta ]
+      to_copy = [] # type: List[Meta]
+      for meta_copy in sorted( self.copy, key=lambda meta: meta.filename ):
+         if meta_copy.checksum in first:
+            self.copy_local.append( ( first[ meta_copy.checksum ], meta_copy ) )
+            print_debug("#SYNC:%s: copy_local from %s in %s, same content" % (meta_copy.filename, first[ meta_copy.checksum ].filename, self.name ) )
+         else:
+            first[ meta_copy.checksum ] = meta_copy
+            to_copy.append( meta_copy )
+      n_saved = len( self.copy ) - len( to_copy )
+      self.copy = to_copy
+      return n_saved
+   
    def merge( self, meta : Meta ):
        self.merged.append( meta )
        
@@ -85,45 +196,163 @@ class SyncTable:
             print_debug("#SYNC:%s: copy new %s " % (meta.filename, self.name) )
 
 
+def _find_move_source( meta : Meta, db : DatabaseBase ) -> str:
+   """ Return the source filename, if the last commit on the file was move. Otherwise None """
+   if len( meta.last_commits ) == 0:
+      return None
+   try:
+      commit = db.commit_get( meta.last_commits[-1] )
+   except SA_DB_Exception_NotFound:
+      return None
+   for af in commit.affected_under( meta.filename ):
+      if af[0] == meta.filename and af[1] == Operation.OP_MOVE:
+         return af[2]
+   return None
+
+
 class Filestatus:
    FILE_OVERWRITE_OK = "partial"
    FILE_EQUAL = "ok"
    pass
    
 
-
-def check_file_equal( meta: Meta, database : DatabaseBase, filesystem : Filesystem ) -> str:
+class FileCheckStats:
+   """ How the existing targets were checked before writing them: from the modification time only, or by hashing """
+   
+   def __init__( self ) -> None:
+      self.lock = threading.Lock()
+      self.n_stat = 0
+      self.n_hashed = 0
+   
+   def add( self, hashed : bool ) -> None:
+      with self.lock:
+         if hashed:
+            self.n_hashed += 1
+         else:
+            self.n_stat += 1
    
+   def merge( self, other : 'FileCheckStats' ) -> None:
+      with self.lock:
+         self.n_stat   += other.n_stat
+         self.n_hashed += other.n_hashed
+   
+   def summary( self ) -> str:
+      return "Existing files checked: %d by modification time, %d hashed" % ( self.n_stat, self.n_hashed )
+
+
+def check_file_equal( meta: Meta, database : DatabaseBase, filesystem : Filesystem, stats : FileCheckStats = None ) -> str:
+   """ Can the file be written as given by meta. The existing file is hashed only when its modification time is the wanted one,
+       as the file might be there already, complete or partial from interrupted transfer. Otherwise the file differs 
+       from the wanted, and it is enough to check that the modification time matches the database, the same way as 
+       check_for_mods trusts it. The check is counted to stats, if given """
+   try:
+      fs_modtime = filesystem.get_modtime( meta.filename )
+   except SA_FS_Exception_NotFound:
+      return Filestatus.FILE_OVERWRITE_OK # File missing
+   
+   if fs_modtime == meta.modtime:
       try:
          meta_fs = meta.copy()
          filesystem.meta_update( meta_fs )
       except SA_FS_Exception_NotFound:
-         return Filestatus.FILE_OVERWRITE_OK # File missing
-         
+         return Filestatus.FILE_OVERWRITE_OK
+      if stats != None:
+         stats.add( hashed = True )
+      
       if meta_fs.check_fs_equal( meta, verbose=False ):
          return Filestatus.FILE_EQUAL # File already as wanted
+   else:
+      meta_fs = None
+      if stats != None:
+         stats.add( hashed = False )
+   
+   # Now this might be also partial file from the transfer. That we detect by checking the FS trashbin
+   if filesystem.trash_exists( meta.filename ):
+      return Filestatus.FILE_OVERWRITE_OK
+   
+   try:
+      meta_db = database.meta_get( meta.filename )
       
-      # Now this might be also partial file from the transfer. That we detect by checking the FS trashbin
-      if filesystem.trash_exists( meta.filename ):
-          return Filestatus.FILE_OVERWRITE_OK
+      if meta_db.checksum == Meta.CHECKSUM_REVERTED:
+         return Filestatus.FILE_OVERWRITE_OK
       
+      # When overwriting normal old file, we have file matching to DB.
+      if meta_fs == None:
+         if meta_db.modtime == fs_modtime and meta_db.checksum_normal():
+            return Filestatus.FILE_OVERWRITE_OK
+      elif meta_db.check_fs_equal( meta_fs , verbose=False):
+         return Filestatus.FILE_OVERWRITE_OK
+
+   # The file is not on database, its untracked, file -> troubles   
+   except SA_DB_Exception_NotFound:
+      pass
+   
+   return ("File '%s' exists as untracked file. It would be overwritten. Bailing out." % meta.filename )
+
+def delta_basis( filesystem : Filesystem, filename : str ) -> str:
+   """ Return absolute path of the existing file worth using as basis for delta transfer, or None """
+   try:
+      stat = filesystem.stat( filename )
+   except SA_FS_Exception_NotFound:
+      return None
+   if stat.st_size < CONFIG.DELTA_MIN_SIZE:
+      return None
+   return filesystem.make_absolute( filename )
+
+
+def check_for_mods_serving( database : DatabaseBase, filesystem : Filesystem ) -> int:
+   """ check_for_mods for serving the repository. After an interrupted sync, the files written after its last checkpoint
+       are newer than the database. The resumed sync finds them there, as each write is checked against the database """
+   if database.get_status() == DatabaseBase.STATUS_SYNC:
+      print_debug("Sync was interrupted, modifications are checked file by file")
+      return 0
+   return check_for_mods( database, filesystem )
+
+
+def check_for_mods( database: DatabaseBase, filesystem : Filesystem ) -> int:
+   """ Compare the modification times of the tracked files, returns number of modified files """
+   errors  = 0
+   for meta in database.meta_list():
+      if meta.checksum_normal() == False and meta.checksum != Meta.CHECKSUM_NONE: 
+         continue
       try:
-         meta_db = database.meta_get( meta.filename )
+         fs_modtime = filesystem.get_modtime( meta.filename )
+      except SA_FS_Exception_NotFound:
+         print_error("File '%s' is deleted " % meta.filename )
+         continue
          
-         if meta_db.checksum == Meta.CHECKSUM_REVERTED:
-            return Filestatus.FILE_OVERWRITE_OK
+      if fs_modtime != meta.modtime:
+         print_error("File '%s' has modifications" % meta.filename )
+         errors += 1
          
-         # When overwriting normal old file, we have file cs matching to DB cs.
-         if meta_db.check_fs_equal( meta_fs , verbose=False):
-            return Filestatus.FILE_OVERWRITE_OK
+   return errors
+
+
+class SyncCheckpoint:
+   """ Saves the database in the middle of sync, every CONFIG.CHECKPOINT_FILES files or CONFIG.CHECKPOINT_SECONDS. 
+       Sync interrupted after that can be resumed without checking again the files already done """
+   
+   def __init__( self, remote : 'Remote' ) -> None:
+      self.remote = remote
+      self.n_unsaved = 0
+      self.time_saved = time.time()
+   
+   def done( self ) -> None:
+      self.n_unsaved += 1
+   
+   def due( self ) -> bool:
+      if self.n_unsaved == 0:
+         return False
+      return self.n_unsaved >= CONFIG.CHECKPOINT_FILES or time.time() - self.time_saved >= CONFIG.CHECKPOINT_SECONDS
+   
+   def save( self, via : 'Remote' ) -> None:
+      """ Save over the given channel, that must not be used by others meanwhile """
+      via.flush() # The database tells only the operations that are done
+      self.remote.database_checkpoint( via )
+      print_debug("Repo %s: Checkpoint, %d operations saved" % ( self.remote.name, self.n_unsaved ) )
+      self.n_unsaved = 0
+      self.time_saved = time.time()
 
-      # The file is not on database, its untracked, file -> troubles   
-      except SA_DB_Exception_NotFound:
-         pass
-      
-         
-      
-      return ("File '%s' exists as untracked file. It would be overwritten. Bailing out." % meta.filename )
 
 def check_database( database : DatabaseBase ):
       for item in database.staging_list():
@@ -135,6 +364,11 @@ class Remote( metaclass=ABCMeta ):
        self.db = None # type: DatabaseBase
        self.xtable = None # type: SyncTable
        self.name = name 
+       self.channels = [] # type: List[Remote]
+       self.cache_path = None # type: str
+       self.rules = None # type: SyncRules
+       self.file_check_stats = FileCheckStats() # Existing targets checked during this sync
+       self.compression = None # type: str # Method asked for the data sent over the connection, None for the configured one
       
    @abstractmethod
    def database_get( self ) -> DatabaseBase:
@@ -144,6 +378,10 @@ class Remote( metaclass=ABCMeta ):
    def database_save( self ) -> None:
       pass
    
+   def database_checkpoint( self, via : 'Remote' ) -> None:
+      """ Save the database during sync, over the connection of the given channel """
+      self.database_save()
+   
    @abstractmethod
    def close( self ) -> None:
       pass
@@ -153,11 +391,14 @@ class Remote( metaclass=ABCMeta ):
      pass
   
    @abstractmethod
-   def file_get( self, source : Meta ) -> Iterable [bytes]:
+   def file_get( self, source : Meta, basis : str = None, offset : int = 0 ) -> Iterable [bytes]:
+      """ Read the file content starting from offset. If basis (absolute path to the old version of the file on the reading side)
+          is given, the remote may transfer only the differences to it """
       pass
    
    @abstractmethod
-   def file_set( self, target : Meta, content: Iterable [bytes] ) -> None:
+   def file_set( self, target : Meta, content: Iterable [bytes], offset : int = 0 ) -> None:
+      """ Write the file. Content continues the partial file from offset, see file_partial() """
       pass
    
    @abstractmethod
@@ -172,37 +413,200 @@ class Remote( metaclass=ABCMeta ):
    def file_copy( self, source : Meta, target : Meta ) -> None:
       pass
    
+   def flush( self ) -> None:
+      """ Wait until all file operations given so far are done. Errors of the operations may be raised here """
+      pass
+
+   def channels_open( self, count : int ) -> None:
+      """ Open count more connections for parallel transfers. By default the remote itself can be used from many threads """
+      pass
+
+   def channels_close( self ) -> None:
+      for channel in self.channels:
+         channel.close()
+      self.channels = []
+
+   def channel( self, index : int ) -> 'Remote':
+      """ Connection to be used by the parallel transfer number index """
+      if index == 0 or index > len( self.channels ):
+         return self
+      return self.channels[ index - 1 ]
+
+   def files_check( self, targets : List[Meta] ) -> Set[str]:
+      """ Check in one go which of the files need to be written. Returns the files that are already there,
+          and raises if some can not be written. By default the check is done by each file_set() instead """
+      return set()
+
+   def files_get_bulk( self, items : List[Meta] ) -> Iterable[ Tuple[Meta, bytes] ]:
+      """ Read many small files at once. Files not smaller than CONFIG.BULK_MAX_SIZE, or of unknown size, are left out """
+      for item in items:
+         if 0 < self.file_size_hint( item ) < CONFIG.BULK_MAX_SIZE:
+            yield ( item, b"".join( self.file_get( item ) ) )
+
+   def files_set_bulk( self, items : Iterable[ Tuple[Meta, bytes] ] ) -> List[Meta]:
+      """ Write many small files at once. Returns the files written """
+      written = [] # type: List[Meta]
+      for ( meta, data ) in items:
+         self.file_set( meta, [ data ] )
+         written.append( meta )
+      return written
+
+   def file_partial( self, target : Meta ) -> int:
+      """ How much of the target is already transferred by an earlier interrupted sync """
+      return 0
+
+   def supports_offset( self ) -> bool:
+      """ Can file_get() start from an offset """
+      return True
+
+   def _transfer( self, other : 'Remote', item : Meta ) -> None:
+      """ Copy the file from other. Continue partial file if there is one, or use the current version as basis for delta """
+      offset = self.file_partial( item ) if other.supports_offset() else 0
+      if offset > 0:
+         print_debug("Repo %s: Resume %s from %d bytes" % ( self.name, item.filename, offset ) )
+         self.file_set( item, other.file_get( item, None, offset ), offset )
+      else:
+         self.file_set( item, other.file_get( item, self.file_basis( item ) ) )
+
+   def file_size_hint( self, source : Meta ) -> int:
+      """ Size of the file for scheduling the transfers, 0 if not known """
+      return 0
+
+   def transfer_summary( self ) -> str:
+      """ Statistics of the data transferred to and from the remote, or None if not applicable """
+      return None
+
+   def file_basis( self, target : Meta ) -> str:
+      """ Local path of the current version of the target file, to be used as basis for delta transfer """
+      return None
+
    def _xtable_set( self, xtable : SyncTable ) -> None:
       self.xtable = xtable
       
-   def execute_sync( self,  other : 'Remote' ) -> None:
-      for item in sorted(self.xtable.copy, key=lambda meta: meta.filename ):
-         print_debug("Repo %s: Transfer %s"  %( self.name, item.filename ) )
-         fid = other.file_get( item  )
-         self.file_set( item, fid )
+   def _transfer_parallel( self, other : 'Remote', items : List[Meta], jobs : int, channel : int = 0, 
+                           checkpoint : SyncCheckpoint = None ) -> Iterable[Meta]:
+      """ Transfer the files over parallel channels, starting from given channel. Yields the items in the given order, as they are done. 
+          The checkpoint is saved over a channel that is free at the time """
+      free = queue.Queue() # type: queue.Queue
+      for index in range( channel, channel + jobs ):
+         free.put( ( self.channel( index ), other.channel( index ) ) )
+      
+      def transfer( group : List[Meta] ) -> None:
+         ( target, source ) = free.get()
+         try:
+            for item in group:
+               print_debug("Repo %s: Transfer %s"  %( target.name, item.filename ) )
+               target._transfer( source, item )
+               target.flush()
+         finally:
+            free.put( ( target, source ) )
+      
+      # Files with same content go one after another, as they share the partial file
+      groups = {} # type: Dict[ str, List[Meta] ]
+      for meta in items:
+         groups.setdefault( meta.checksum, [] ).append( meta )
+      # Largest files first, so that one channel is not left alone with a big file at the end
+      by_size = sorted( groups.values(), key=lambda group: other.file_size_hint( group[0] ), reverse=True )
+      from concurrent.futures import ThreadPoolExecutor # Not at top, the ssh server starts faster without it
+      with ThreadPoolExecutor( max_workers = jobs ) as executor:
+         futures = { group[0].checksum : executor.submit( transfer, group ) for group in by_size }
+         for meta in items:
+            futures[ meta.checksum ].result()
+            yield meta
+            if checkpoint != None and checkpoint.due():
+               ( target, source ) = free.get()
+               try:
+                  checkpoint.save( target )
+               finally:
+                  free.put( ( target, source ) )
+   
+   def execute_sync( self,  other : 'Remote', jobs : int = 1, channel : int = 0 ) -> None:
+      """ Make the planned changes to this end. The connections from the given channel on are used, so that the other
+          direction can run at the same time on its own connections. The database is updated in the plan order """
+      target = self.channel( channel )
+      source = other.channel( channel )
+      checkpoint = SyncCheckpoint( self )
+      
+      def item_done( item : Meta ) -> None:
          self.db.meta_set( item )
+         checkpoint.done()
+         if checkpoint.due():
+            checkpoint.save( target )
+      
+      to_copy = sorted(self.xtable.copy, key=lambda meta: meta.filename )
+      present = target.files_check( to_copy )
+      for item in to_copy:
+         if item.filename in present:
+            print_debug("Repo %s: Already present %s"  %( self.name, item.filename ) )
+            item_done( item )
+      to_copy = [ item for item in to_copy if item.filename not in present ]
+      
+      # Small files in one go, without per file round trips
+      if CONFIG.BULK_MAX_SIZE > 0:
+         candidates = [ item for item in to_copy if target.file_partial( item ) == 0 ]
+         written = { meta.filename for meta in target.files_set_bulk( source.files_get_bulk( candidates ) ) }
+         target.flush()
+         print_debug("Repo %s: %d files transferred in bulk" % ( self.name, len( written ) ) )
+         for item in to_copy:
+            if item.filename in written:
+               item_done( item )
+         to_copy = [ item for item in to_copy if item.filename not in written ]
+      
+      if jobs > 1:
+         for item in self._transfer_parallel( other, to_copy, jobs, channel, checkpoint ):
+            self.db.meta_set( item ) # Database is updated in the plan order
+            checkpoint.done()
+      else:
+         for item in to_copy:
+            print_debug("Repo %s: Transfer %s"  %( self.name, item.filename ) )
+            target._transfer( source, item )
+            item_done( item )
+      target.flush()
       
       for item_source, item_target in sorted(self.xtable.copy_local,  key=lambda tup: tup[0].filename ):
          print_debug("Repo %s: Copy local %s -> %s" %( self.name, item_source.filename, item_target.filename ) )
-         self.file_copy( item_source, item_target )
-         self.db.meta_set( item_target )
+         target.file_copy( item_source, item_target )
+         item_done( item_target )
+      target.flush()
                   
       for item_source, item_target in sorted(self.xtable.move, key=lambda tup: tup[0].filename ):
          print_debug("Repo %s: Move %s -> %s "  % ( self.name, item_source.filename, item_target.filename ) )
-         self.file_move( item_source, item_target )
+         target.file_move( item_source, item_target )
          self.db.meta_set( item_source )
-         self.db.meta_set( item_target )
+         item_done( item_target )
+      target.flush()
 
       for item in sorted(self.xtable.delete, key=lambda meta: meta.filename ):
          print_debug("Repo %s: Delete %s"  %( self.name, item.filename ))
-         self.file_del( item )
-         self.db.meta_set( item )
+         target.file_del( item )
+         item_done( item )
+      target.flush()
 
       for meta in self.xtable.merged:
          self.db.meta_set( meta )
 
 
-def remote_open( url : str, name : str ) -> Remote:
+def execute_sync_both( local : Remote, other : Remote, jobs : int, concurrent : bool = False ) -> None:
+   """ Make the planned changes to both ends. Concurrently, the upload runs on its own thread and connections, 
+       channels_open( 2*jobs - 1 ) must be done for that. Each database is written only by the direction writing 
+       to that end, in the plan order, so the database updates are the same as when run one after another """
+   if concurrent == False:
+      local.execute_sync( other, jobs )
+      other.execute_sync( local, jobs )
+      return
+   
+   from concurrent.futures import ThreadPoolExecutor
+   with ThreadPoolExecutor( max_workers = 1 ) as executor:
+      upload = executor.submit( other.execute_sync, local, jobs, jobs )
+      local.execute_sync( other, jobs )
+      upload.result()
+
+
+def remote_open( url : str, name : str, cache_path : str = None, rules : SyncRules = None, compression : str = None ) -> Remote:
+   """ Open remote by its url. If cache_path is given, the remote may keep there a copy of its database 
+       between the runs, to fetch only the changes the next time. With the rules, only the selected files
+       are synced, and the remote may fetch only them of its database. Compression is the method for the
+       data over network connections, in both directions """
    remote = None # type: Remote
    if url.startswith("file://"):
       from .remote_localfs import RemoteLocalFS
@@ -210,8 +614,14 @@ def remote_open( url : str, name : str ) -> Remote:
    elif url.startswith("ssh://"):
       from .remote_ssh import RemoteSSH
       remote = RemoteSSH( name )
+   elif url.startswith("unix://") or url.startswith("tcp://"):
+      from .remote_daemon import RemoteSocket
+      remote = RemoteSocket( name )
    else:
       raise SA_SYNC_Exception("Unknown protocol '%s'" % url )
+   remote.cache_path = cache_path
+   remote.rules = rules
+   remote.compression = compression
    remote.open( url )
    return remote
 
@@ -224,23 +634,29 @@ def remote_sync( local:Remote, other: Remote ) -> None :
    xtable_local = SyncTable("Local")
    xtable_other = SyncTable("Other")
    
-   # Check meta files
-   local_metas = set( db_local.meta_list_keys() )
-   other_metas = set( db_other.meta_list_keys() )
+   # Check meta files, only in the directories that differ and are synced with the other
+   rules = other.rules or SyncRules()
+   if rules.selects_all() == False:
+      print_info("Syncing only %s" % rules )
+   ( local_only, other_only, common ) = _tree_compare( db_local, db_other, rules )
    
    # First check files that are only in other db
-   xtable_other.append_missing_files( local_metas - other_metas, db_local )
+   xtable_other.append_missing_files( local_only, db_local )
    # another way around
-   xtable_local.append_missing_files( other_metas - local_metas, db_other )
+   xtable_local.append_missing_files( other_only, db_other )
 
    # Then check rest of the files.
-   conflicts = _build_process_common_files( xtable_local, xtable_other, db_local, db_other, other_metas & local_metas, )
+   conflicts = _build_process_common_files( xtable_local, xtable_other, db_local, db_other, common )
    
    _solve_conflicts( xtable_local, xtable_other, db_local, db_other, conflicts )
    
    # Then try to find moved files to avoid transfer between repositories
-   xtable_local.detect_move_files( db_local )
-   xtable_other.detect_move_files( db_other )
+   xtable_local.detect_move_files( db_local, db_other )
+   xtable_other.detect_move_files( db_other, db_local )
+   
+   # Same new content in many files is transferred only once
+   xtable_local.dedup_copies()
+   xtable_other.dedup_copies()
       
    # Sync all commit objects
    local_commits = set( db_local.commit_list_keys() )
@@ -256,6 +672,42 @@ def remote_sync( local:Remote, other: Remote ) -> None :
 
 
 
+def _tree_compare( db_local : DatabaseBase, db_other : DatabaseBase, rules : SyncRules ) -> Tuple[ Set[str], Set[str], Set[str] ]:
+   """ Walk the directory trees top-down, descending only into the directories whose hashes differ and that can have 
+       files selected by the rules. Returns the selected filenames only in local, only in other, and in both 
+       (in the differing directories) """
+   local_only = set() # type: Set[str]
+   other_only = set() # type: Set[str]
+   common     = set() # type: Set[str]
+   n_dirs = 0
+   
+   to_check = [ "" ]
+   while len( to_check ) > 0:
+      dirname = to_check.pop()
+      if db_local.tree_hash( dirname ) == db_other.tree_hash( dirname ):
+         continue
+      n_dirs += 1
+      ( dirs_local, files_local ) = db_local.tree_list( dirname )
+      ( dirs_other, files_other ) = db_other.tree_list( dirname )
+      files_local = [ fn for fn in files_local if rules.wanted( fn ) ]
+      files_other = [ fn for fn in files_other if rules.wanted( fn ) ]
+      dirs_local  = [ subdir for subdir in dirs_local if rules.dir_wanted( subdir ) ]
+      dirs_other  = [ subdir for subdir in dirs_other if rules.dir_wanted( subdir ) ]
+      
+      local_only.update( set( files_local ) - set( files_other ) )
+      other_only.update( set( files_other ) - set( files_local ) )
+      common.update( set( files_local ) & set( files_other ) )
+      
+      for subdir in set( dirs_local ) - set( dirs_other ):
+         local_only.update( fn for fn in db_local.tree_files( subdir ) if rules.wanted( fn ) )
+      for subdir in set( dirs_other ) - set( dirs_local ):
+         other_only.update( fn for fn in db_other.tree_files( subdir ) if rules.wanted( fn ) )
+      to_check.extend( set( dirs_local ) & set( dirs_other ) )
+   
+   print_debug("#SYNC: %d directories differ" % n_dirs )
+   return ( local_only, other_only, common )
+
+
 def _solve_conflicts( xtable_local : SyncTable, xtable_other : SyncTable, db_local : DatabaseBase, db_other : DatabaseBase,
                       conflicts : Sequence[ Tuple[ Meta, Meta ] ] ) -> None:
    
@@ -0,0 +1,201 @@
+import json
+import struct
+
+from typing import Iterable, Dict, Any, List, IO
+
+from .database import DatabaseBase, Meta
+from .database_json import DatabaseJson
+from .filesystem import Filesystem
+from .common import CONFIG, Progress, print_debug
+from .remote import Remote, SA_SYNC_Exception, check_file_equal, Filestatus
+from .remote_localfs import RemoteLocalFS
+
+
+class SA_Bundle_Exception( SA_SYNC_Exception ):
+   pass
+
+
+# The bundle file is:
+#   MAGIC
+#   records: <uint32 length> <json object>. Records with data are followed by chunks <uint32 length> <data>,
+#            and zero length chunk
+#   the last record is "end", with the index of the records: [op, filename, offset]
+#   <uint64 offset of the end record>
+# The records are in the order they are applied, so the bundle is applied with one sequential read.
+MAGIC = b"SARCH-BUNDLE-1\n"
+_LENGTH  = struct.Struct(">I")
+_TRAILER = struct.Struct(">Q")
+
+KEY_OP     = "op"
+KEY_META   = "meta"
+KEY_TARGET = "target"
+OP_HEAD = "head"
+OP_SET  = "set"
+OP_DEL  = "del"
+OP_MOVE = "mov"
+OP_COPY = "cpy"
+OP_DB   = "db"
+OP_END  = "end"
+
+
+def _meta_pack( meta : Meta ) -> List[Any]:
+   return [ meta.filename, meta.checksum, meta.modtime ]
+
+
+def _meta_unpack( values : List[Any] ) -> Meta:
+   meta = Meta( values[0] )
+   meta.checksum = values[1]
+   meta.modtime  = values[2]
+   return meta
+
+
+class RemoteBundle( Remote ):
+   """ Write only remote: the operations that sync would do on the peer are recorded to the bundle file.
+       The peer is known only by the copy of its database, the peer state """
+
+   def open( self, url : str ) -> None:
+      raise SA_Bundle_Exception("Bundle can not be opened by url")
+
+   def open_bundle( self, filename : str, peer_state : str ) -> None:
+      self.db = DatabaseJson()
+      try:
+         with open( peer_state ) as fid:
+            self.db.json_loads( fid.read() )
+      except ( OSError, ValueError, KeyError ) as err:
+         raise SA_Bundle_Exception("Cannot read peer state '%s': %s" % ( peer_state, err ) )
+      self.base_generation = self.db.generation()
+      self.index = [] # type: List[ List[Any] ]
+      self.n_files = 0
+      self.n_bytes = 0
+      self.fid = open( filename, 'wb' ) # type: IO[bytes]
+      self.fid.write( MAGIC )
+      self._record( { KEY_OP : OP_HEAD, "uid" : self.db.replica_uid(), "gen" : self.base_generation, "version" : CONFIG.VERSION } )
+
+   def _record( self, obj : Dict[ str, Any ] ) -> None:
+      filename = obj[ KEY_META ][0] if KEY_META in obj else None
+      self.index.append( [ obj[ KEY_OP ], filename, self.fid.tell() ] )
+      raw = bytes( json.dumps( obj ), "utf8" )
+      self.fid.write( _LENGTH.pack( len( raw ) ) )
+      self.fid.write( raw )
+
+   def _chunks( self, content : Iterable[bytes] ) -> None:
+      for data in content:
+         if len( data ) == 0:
+            continue
+         self.fid.write( _LENGTH.pack( len( data ) ) )
+         self.fid.write( data )
+         self.n_bytes += len( data )
+      self.fid.write( _LENGTH.pack( 0 ) )
+
+   def file_get( self, source : Meta, basis : str = None, offset : int = 0 ) -> Iterable [bytes]:
+      raise SA_Bundle_Exception("Bundle is write only")
+
+   def file_set( self, target : Meta, content: Iterable [bytes], offset : int = 0 ) -> None:
+      self._record( { KEY_OP : OP_SET, KEY_META : _meta_pack( target ) } )
+      self._chunks( content )
+      self.n_files += 1
+
+   def file_del( self, target : Meta ) -> None:
+      self._record( { KEY_OP : OP_DEL, KEY_META : _meta_pack( target ) } )
+
+   def file_move( self, source : Meta, target : Meta ) -> None:
+      self._record( { KEY_OP : OP_MOVE, KEY_META : _meta_pack( source ), KEY_TARGET : _meta_pack( target ) } )
+
+   def file_copy( self, source : Meta, target : Meta ) -> None:
+      self._record( { KEY_OP : OP_COPY, KEY_META : _meta_pack( source ), KEY_TARGET : _meta_pack( target ) } )
+
+   def database_get( self ) -> DatabaseBase:
+      return self.db
+
+   def database_save( self ) -> None:
+      pass # The changes are written by close()
+
+   def close( self ) -> None:
+      self._record( { KEY_OP : OP_DB } )
+      self._chunks( [ bytes( self.db.changes_dumps( self.base_generation ), "utf8" ) ] )
+      end_offset = self.fid.tell()
+      self._record( { KEY_OP : OP_END, "index" : self.index } )
+      self.fid.write( _TRAILER.pack( end_offset ) )
+      self.fid.close()
+
+   def transfer_summary( self ) -> str:
+      return "%d files, %s of data in bundle" % ( self.n_files, Progress.size_string( self.n_bytes ) )
+
+
+class BundleReader:
+   """ Reads the bundle records in order """
+
+   def __init__( self, fid : IO[bytes] ) -> None:
+      self.fid = fid
+      if self._read( len( MAGIC ) ) != MAGIC:
+         raise SA_Bundle_Exception("Not a bundle file")
+
+   def _read( self, count : int ) -> bytes:
+      data = self.fid.read( count )
+      if len( data ) != count:
+         raise SA_Bundle_Exception("Bundle file truncated")
+      return data
+
+   def record( self ) -> Dict[ str, Any ]:
+      ( length, ) = _LENGTH.unpack( self._read( _LENGTH.size ) )
+      return json.loads( self._read( length ).decode("utf8") )
+
+   def chunks( self ) -> Iterable[bytes]:
+      while True:
+         ( length, ) = _LENGTH.unpack( self._read( _LENGTH.size ) )
+         if length == 0:
+            return
+         while length > 0:
+            data = self._read( min( length, CONFIG.DATA_BLOCK_SIZE ) )
+            length -= len( data )
+            yield data
+
+
+def bundle_apply( database : DatabaseBase, filesystem : Filesystem, filename : str ) -> int:
+   """ Apply the bundle made against the current state of the database. Returns the number of files written.
+       The database is changed only at the end, so failed apply can be run again: the files already written are skipped """
+   local = RemoteLocalFS( "Local" )
+   local.open_local( database, filesystem )
+   n_files = 0
+   with open( filename, 'rb' ) as fid:
+      reader = BundleReader( fid )
+      head = reader.record()
+      if head[ KEY_OP ] != OP_HEAD or head["uid"] != database.replica_uid():
+         raise SA_Bundle_Exception("The bundle is not made for this repository")
+      if head["gen"] != database.generation():
+         raise SA_Bundle_Exception("Repository has changed since the state the bundle was made against")
+
+      database.set_status( DatabaseBase.STATUS_SYNC )
+      database.save()
+      while True:
+         record = reader.record()
+         op = record[ KEY_OP ]
+         if op == OP_END:
+            break
+         elif op == OP_DB:
+            database.changes_loads( b"".join( reader.chunks() ).decode("utf8"), mirror = False )
+            continue
+         meta = _meta_unpack( record[ KEY_META ] )
+         print_debug("Bundle: %s %s" % ( op, meta.filename ) )
+         if op == OP_SET:
+            content = reader.chunks()
+            if check_file_equal( meta, database, filesystem ) == Filestatus.FILE_EQUAL:
+               print_debug("Bundle: %s already written" % meta.filename )
+            else:
+               local.file_set( meta, content )
+               n_files += 1
+            for _ in content: # File was already there
+               pass
+         elif op == OP_DEL:
+            local.file_del( meta )
+         elif op == OP_MOVE:
+            local.file_move( meta, _meta_unpack( record[ KEY_TARGET ] ) )
+         elif op == OP_COPY:
+            local.file_copy( meta, _meta_unpack( record[ KEY_TARGET ] ) )
+         else:
+            raise SA_Bundle_Exception("Invalid bundle record '%s'" % op )
+
+   database.set_status( DatabaseBase.STATUS_CLEAR )
+   database.save()
+   local.close()
+   return n_files
@@ -0,0 +1,227 @@
+import os
+import socket
+import socketserver
+import stat
+import threading
+import time
+import types
+
+from typing import Any, Callable, Dict, IO, List, Tuple, cast
+
+from .database import DatabaseBase
+from .database_json import DatabaseJson
+from .filesystem import Filesystem
+from .exceptions import SA_Exception
+from .common import CONFIG, print_debug, print_error
+from .remote import SA_SYNC_Exception, FileCheckStats
+from .remote_ssh import RemoteSSH, RemoteSSHServer, RemoteConnection, SA_SYNC_Exception_SSH
+
+
+ADDRESS_UNIX = "unix"
+ADDRESS_TCP  = "tcp"
+
+
+def address_parse( spec : str ) -> Tuple[ str, Any ]:
+   """ Parse socket address 'unix:/path' or 'tcp:host:port'. The url forms 'unix:///path' and 'tcp://host:port' are accepted too """
+   ( scheme, _, rest ) = spec.partition(":")
+   if rest.startswith("//"):
+      rest = rest[2:]
+   if scheme == ADDRESS_UNIX and len( rest ) > 0:
+      return ( ADDRESS_UNIX, rest )
+   if scheme == ADDRESS_TCP:
+      ( host, _, port ) = rest.rpartition(":")
+      try:
+         return ( ADDRESS_TCP, ( host or "localhost", int( port ) ) )
+      except ValueError:
+         pass
+   raise SA_SYNC_Exception("Invalid address '%s'. It must be 'unix:<path>' or 'tcp:<host>:<port>'" % spec )
+
+
+class _LockedDatabase:
+   """ Database shared by the sessions of the daemon. Each call holds the daemon lock, so that no session sees the database
+       while other one changes it, nor builds its indexes at the same time. Generators are run to the end under the lock """
+
+   def __init__( self, database : DatabaseBase, lock : Any ) -> None:
+      self._database = database
+      self._lock = lock
+
+   def __getattr__( self, name : str ) -> Any:
+      attr = getattr( self._database, name )
+      if callable( attr ) == False:
+         return attr
+
+      def locked( *args : Any, **kwargs : Any ) -> Any:
+         with self._lock:
+            result = attr( *args, **kwargs )
+            if isinstance( result, types.GeneratorType ):
+               result = list( result )
+            return result
+      return locked
+
+
+class DaemonSession( RemoteSSHServer ):
+   """ One client connection of the daemon. The database and filesystem are shared with the other connections """
+
+   def __init__( self, daemon : 'RemoteDaemon', pipe_in : IO[bytes], pipe_out : IO[bytes] ) -> None:
+      super().__init__( cast( DatabaseBase, _LockedDatabase( daemon.db, daemon.lock ) ), daemon.fs, pipe_in, pipe_out )
+      self.daemon = daemon
+      self.opened = False
+
+   def session_open( self ) -> str:
+      if self.opened:
+         return None
+      error = self.daemon.session_begin()
+      self.opened = error == None
+      self.file_check_stats = FileCheckStats()
+      return error
+
+   def session_close( self ) -> None:
+      if self.opened:
+         self.opened = False
+         self.daemon.session_end( clean = True )
+         print_debug( self.file_check_stats.summary() )
+
+   # The database exchange is more than one call to the database, and done as whole
+   def serve_cmd_db_get( self, uid : str = None, since : int = None, select : Dict[ str, List[str] ] = None ) -> None:
+      with self.daemon.lock:
+         super().serve_cmd_db_get( uid, since, select )
+
+   def serve_cmd_db_set( self, db_json_str : str = None, options : Dict[ str, Any ] = None ) -> None:
+      with self.daemon.lock:
+         super().serve_cmd_db_set( db_json_str, options )
+         self.daemon.db_saved()
+
+
+class _Handler( socketserver.StreamRequestHandler ):
+   wbufsize = -1 # The connection flushes after each message
+
+   def handle( self ) -> None:
+      session = DaemonSession( self.server.repo_daemon, self.rfile, self.wfile ) # type: ignore
+      try:
+         session.run()
+      except SA_Exception as err:
+         print_error("Connection ended: %s" % err )
+      finally:
+         if session.opened: # Client went away without close, partial files are left to resume
+            session.opened = False
+            session.daemon.session_end( clean = False )
+
+
+class _UnixServer( socketserver.ThreadingMixIn, socketserver.UnixStreamServer ):
+   daemon_threads = True
+
+
+class _TCPServer( socketserver.ThreadingMixIn, socketserver.TCPServer ):
+   daemon_threads = True
+   allow_reuse_address = True
+
+
+class RemoteDaemon:
+   """ Serves the repository over a socket to many clients, one after another or at the same time. The database stays
+       in memory between the connections, and the files are checked for modifications only every CONFIG.SERVE_RECHECK_SECONDS
+       or when the database has been changed on disk by other sarch commands """
+
+   def __init__( self, database : DatabaseBase, filesystem : Filesystem, check_mods : Callable[ [], int ] ) -> None:
+      self.db = database
+      self.fs = filesystem
+      self.check_mods = check_mods
+      self.db_file = DatabaseJson.get_database_file( filesystem.make_absolute( CONFIG.PATH ) )
+      self.db_stat = self._db_file_stat()
+      self.time_checked = 0.0
+      self.n_sessions = 0
+      self.lock = threading.RLock()
+      self.server = None # type: socketserver.BaseServer
+      self.address = None # type: Tuple[ str, Any ]
+
+   def _db_file_stat( self ) -> List[int]:
+      st = os.stat( self.db_file )
+      return [ st.st_size, st.st_mtime_ns ]
+
+   def refresh( self ) -> str:
+      """ Reload the database if changed on disk, and check the files if the last check is too old. Returns the error or None """
+      with self.lock:
+         if self._db_file_stat() != self.db_stat:
+            print_debug("Database changed on disk, reloading it")
+            self.db.open_from_path( self.fs.make_absolute( CONFIG.PATH ) )
+            self.db_stat = self._db_file_stat()
+            self.time_checked = 0.0
+         if time.time() - self.time_checked < CONFIG.SERVE_RECHECK_SECONDS:
+            return None
+         if self.check_mods() > 0:
+            return "Remote has local modifications. Please commit changes there and try again."
+         self.time_checked = time.time()
+         return None
+
+   def db_saved( self ) -> None:
+      """ Database was saved by a client, the file on disk matches the memory again """
+      with self.lock:
+         self.db_stat = self._db_file_stat()
+
+   def session_begin( self ) -> str:
+      with self.lock:
+         if self.n_sessions == 0: # Parallel channels of a sync join the session already going
+            error = self.refresh()
+            if error != None:
+               return error
+            self.fs.trash_clear()
+         self.n_sessions += 1
+         print_debug("Client connected, %d connections open" % self.n_sessions )
+         return None
+
+   def session_end( self, clean : bool ) -> None:
+      with self.lock:
+         self.n_sessions -= 1
+         print_debug("Client disconnected, %d connections open" % self.n_sessions )
+         if self.n_sessions == 0:
+            self.fs.trash_clear()
+            if clean:
+               self.fs.partial_clear()
+
+   def listen( self, spec : str ) -> None:
+      ( family, address ) = address_parse( spec )
+      if family == ADDRESS_UNIX:
+         # Socket left by a daemon that was killed
+         if os.path.exists( address ) and stat.S_ISSOCK( os.stat( address ).st_mode ):
+            os.unlink( address )
+         self.server = _UnixServer( address, _Handler )
+      else:
+         self.server = _TCPServer( address, _Handler )
+      self.server.repo_daemon = self # type: ignore
+      self.address = ( family, self.server.server_address )
+
+   def serve_forever( self ) -> None:
+      self.server.serve_forever()
+
+   def shutdown( self ) -> None:
+      """ Stop serve_forever(), running in other thread """
+      self.server.shutdown()
+
+   def close( self ) -> None:
+      self.server.server_close()
+      if self.address[0] == ADDRESS_UNIX:
+         os.unlink( self.address[1] )
+
+
+class RemoteSocket( RemoteSSH ):
+   """ Repository served by 'sarch serve', url unix:///path/to/socket or tcp://host:port. Ssh is needed only to
+       forward the socket, for example 'ssh -L 7000:/run/sarch.sock host' and then tcp://localhost:7000 """
+
+   def _connect( self, url : str ) -> None:
+      ( family, address ) = address_parse( url )
+      print_debug( "Opening connection to %s .. " % url )
+      try:
+         if family == ADDRESS_UNIX:
+            self.sock = socket.socket( socket.AF_UNIX, socket.SOCK_STREAM )
+            self.sock.connect( address )
+         else:
+            self.sock = socket.create_connection( address )
+            self.sock.setsockopt( socket.IPPROTO_TCP, socket.TCP_NODELAY, 1 )
+      except OSError as err:
+         raise SA_SYNC_Exception_SSH("Could not connect to '%s': %s" % ( url, err ) )
+      self.conn = RemoteConnection( self.sock.makefile('rb'), self.sock.makefile('wb') )
+      self.url = url
+
+   def _close_raw( self ) -> None:
+      self.conn.pipe_in.close()
+      self.conn.pipe_out.close()
+      self.sock.close()
@@ -1,21 +1,51 @@
 
-from typing import Iterable
+from typing import Iterable, List, Tuple
 
 from .database import DatabaseBase, open_database, Meta
 from .filesystem import Filesystem, SA_FS_Exception_NotFound
-from .common import CONFIG
+from .common import CONFIG, map_parallel
 
-from .remote import Remote, SA_SYNC_Exception, SA_SYNC_Exception_Cancelled, check_file_equal, check_database, Filestatus
+from .remote import Remote, SA_SYNC_Exception, SA_SYNC_Exception_Cancelled, check_file_equal, check_database, delta_basis, Filestatus
 
 class RemoteLocalFS( Remote ):
 
-   def file_get( self, source : Meta ) -> Iterable [bytes]:
-      return self.fs.file_read( source.filename )
+   verify_writes = True # Check the checksum of the written files
+   write_jobs    = 1    # Threads writing the bulk transferred files
+
+   def file_get( self, source : Meta, basis : str = None, offset : int = 0 ) -> Iterable [bytes]:
+      return self.fs.file_read( source.filename, offset )
+
+   def file_basis( self, target : Meta ) -> str:
+      return delta_basis( self.fs, target.filename )
+
+   def file_partial( self, target : Meta ) -> int:
+      return self.fs.partial_size( target.checksum )
+
+   def files_get_bulk( self, items : List[Meta] ) -> Iterable[ Tuple[Meta, bytes] ]:
+      metas = { meta.filename : meta for meta in items }
+      for filename in self.fs.disk_order( metas.keys(), CONFIG.BULK_MAX_SIZE ):
+         yield ( metas[ filename ], b"".join( self.fs.file_read( filename ) ) )
+   
+   def files_set_bulk( self, items : Iterable[ Tuple[Meta, bytes] ] ) -> List[Meta]:
+      def write( item : Tuple[Meta, bytes] ) -> Meta:
+         self.file_set( item[0], [ item[1] ] )
+         return item[0]
+      return list( map_parallel( write, items, self.write_jobs ) )
+   
+   def channels_open( self, count : int ) -> None:
+      """ Local file system needs no more connections, but the bulk transferred files are written on as many threads """
+      self.write_jobs = count + 1
+   
+   def file_size_hint( self, source : Meta ) -> int:
+      try:
+         return self.fs.stat( source.filename ).st_size
+      except SA_FS_Exception_NotFound:
+         return 0
    
-   def file_set( self, target : Meta, content: Iterable [bytes] ) -> None:
-      status = check_file_equal( target, self.db, self.fs ) 
+   def file_set( self, target : Meta, content: Iterable [bytes], offset : int = 0 ) -> None:
+      status = check_file_equal( target, self.db, self.fs, self.file_check_stats ) 
       if status == Filestatus.FILE_OVERWRITE_OK:
-         self.fs.file_create( target, content )
+         self.fs.file_create( target, content, offset, self.verify_writes )
       elif status == Filestatus.FILE_EQUAL:
          return 
       else:
@@ -25,7 +55,7 @@ class RemoteLocalFS( Remote ):
       self.fs.file_del( target.filename, missing_ok = True )
 
    def file_move( self, source : Meta, target : Meta ) -> None:
-      status = check_file_equal( target, self.db, self.fs ) 
+      status = check_file_equal( target, self.db, self.fs, self.file_check_stats ) 
       if status == Filestatus.FILE_OVERWRITE_OK:
          # the whole file is missing
          self.fs.move( source.filename, target.filename, create_dirs=True, modtime = target.modtime )
@@ -36,10 +66,9 @@ class RemoteLocalFS( Remote ):
          raise SA_SYNC_Exception_Cancelled( status )
    
    def file_copy( self, source : Meta, target : Meta ) -> None:
-      status = check_file_equal( target, self.db, self.fs ) 
+      status = check_file_equal( target, self.db, self.fs, self.file_check_stats ) 
       if status == Filestatus.FILE_OVERWRITE_OK:
-         fid = self.fs.file_read( source.filename )
-         self.fs.file_create( target, fid )
+         self.fs.file_copy( source, target )
       elif status == Filestatus.FILE_EQUAL:
          return 
       else:
@@ -53,7 +82,7 @@ class RemoteLocalFS( Remote ):
 
    def close( self ) -> None:
       self.fs.trash_clear()
-      pass
+      self.fs.partial_clear()
    
    def _open_check( self ):       
       self.fs.trash_clear()
@@ -1,16 +1,24 @@
 
 import json
+import shlex
+import struct
 import sys
 
-from typing import Iterable, Union, Dict, cast, IO, Any, Tuple
+from typing import Iterable, Union, Dict, cast, IO, Any, Tuple, List, Set, Sequence
 from subprocess import Popen,PIPE
 
 from .database import DatabaseBase, Meta, SA_DB_Exception_NotFound
 from .database_json import DatabaseJson
-from .filesystem import Filesystem
+from .peer_cache import PeerCache
+from .sync_rules import SyncRules
+from .filesystem import Filesystem, SA_FS_Exception_NotFound
+from .exceptions import SA_Exception
+from . import delta
+from . import bulk
+from . import compression
 
 from .common import CONFIG, print_debug, print_info, print_error
-from .remote import Remote, check_database, check_file_equal , SA_SYNC_Exception, SA_SYNC_Exception_Cancelled, Filestatus
+from .remote import Remote, check_database, check_file_equal, FileCheckStats, delta_basis, SA_SYNC_Exception, SA_SYNC_Exception_Cancelled, Filestatus
 
 
 class SA_SYNC_Exception_SSH( SA_SYNC_Exception ):
@@ -35,6 +43,9 @@ class RemoteConnectionCMDS:
    CMD_COPY = "cpy"
    CMD_DB_GET = "dbg"
    CMD_DB_SET = "dbs"
+   CMD_HAVE = "hav"
+   CMD_GET_MANY = "getm"
+   CMD_SET_MANY = "setm"
 
 class RemoteConnection(RemoteConnectionCMDS):
    
@@ -43,11 +54,41 @@ class RemoteConnection(RemoteConnectionCMDS):
    RSP_STATUS_DONE = "done"
    
    RSP_DATABASE_KEY = "db"
+   RSP_FEATURES_KEY = "features"
+   RSP_SIGNATURE_KEY = "sig"
    DATA_LEN_KEY = "len"
+   DATA_COMPRESSION_KEY = "z"
+   SET_OPTION_PUSH = "push"
+   OPTION_OFFSET = "offset"
+   RSP_PARTIAL_KEY = "partial"
+   RSP_UID_KEY = "uid"
+   RSP_GENERATION_KEY = "gen"
+   RSP_BASE_KEY = "base"
+   OPTION_DELTA = "delta"
+   OPTION_CHECKED = "checked"
+   OPTION_MAX_SIZE = "max"
+   RSP_HAVE_KEY = "have"
+
+   FEATURE_DELTA = "delta"
+   FEATURE_DB_STREAM = "dbstream" # Database is sent over the data channel
+   FEATURE_PIPELINE = "pipeline"  # Commands carry request id, and many can be in flight
+   FEATURE_RESUME = "resume"      # Files are written through partial files, and set/get can start from an offset
+   FEATURE_DB_DELTA = "dbdelta"   # Only the database entries changed since the given generation are exchanged. Needs dbstream
+   FEATURE_BINARY = "binary"      # Data packages have fixed size binary header instead of json
+   FEATURE_HAVE = "have"          # Files to be written are checked in batches before the transfers
+   FEATURE_BULK = "bulk"          # Many small files in one stream. Needs pipeline
+   FEATURE_DB_SELECT = "dbselect" # Database exchange limited to the files selected by sync rules. Needs dbdelta
+   FEATURE_COMPRESS_PREFIX = "compress=" # Client asks for the compression of the data in both directions, as compress=method:level
+   FEATURES = [ FEATURE_DELTA, FEATURE_DB_STREAM, FEATURE_PIPELINE, FEATURE_RESUME, FEATURE_DB_DELTA, FEATURE_BINARY, FEATURE_HAVE, FEATURE_BULK, FEATURE_DB_SELECT ] + compression.methods_supported() # Optional protocol features this end supports
    
    PROTO_ENDMARKER  =  bytes.fromhex("00")
    PROTO_KEY_CMD    = "cmd"
    PROTO_KEY_PARAMS = "par"
+   PROTO_KEY_ID     = "id"
+   
+   # Binary data header: compression method index and the package length. Zero length ends the stream
+   DATA_HEADER  = struct.Struct(">BI")
+   DATA_METHODS = ( None, compression.METHOD_ZLIB, compression.METHOD_LZMA )
    
    KNOWN_COMMANDS  = [ x for x in dir( RemoteConnectionCMDS ) if x.startswith("CMD_") ]
    COMMANDS_LOOKUP = { getattr(RemoteConnectionCMDS, x) : x  for x in KNOWN_COMMANDS }
@@ -55,10 +96,48 @@ class RemoteConnection(RemoteConnectionCMDS):
    def __init__(self, pipe_in : IO[bytes] , pipe_out : IO[bytes]  ) -> None:
       self.pipe_in = pipe_in
       self.pipe_out = pipe_out
+      self.features = [] # type: List[str]
+      self.compression = None # type: str
+      self.compression_level = CONFIG.COMPRESSION_LEVEL
+      self.stats_sent     = compression.TransferStats()
+      self.stats_received = compression.TransferStats()
+      self.request_id = 0
+      self.pending = set() # type: Set[int]
+      self.binary = False
       self.clear_buffer()
       
    def clear_buffer( self ):
       self.data =  bytearray()
+
+   def has_feature( self, feature : str ) -> bool:
+      """ Is the feature agreed with the other end in handshake """
+      return feature in self.features
+
+   def features_set( self, features : List[str] ) -> None:
+      """ Set the features agreed in handshake """
+      self.features = list( features )
+      self.binary = self.FEATURE_BINARY in self.features
+
+   def compression_set( self, method : str, level : int ) -> None:
+      """ Data we send is compressed with the method, if the other end supports it """
+      self.compression = method if method in self.features else None
+      self.compression_level = level
+
+   @classmethod
+   def compression_feature( cls, method : str, level : int ) -> str:
+      return "%s%s:%d" % ( cls.FEATURE_COMPRESS_PREFIX, method, level )
+
+   @classmethod
+   def compression_parse( cls, features : List[str] ) -> Tuple[ str, int ]:
+      """ Compression asked for in the handshake features, or None if not there """
+      for feature in features:
+         if feature.startswith( cls.FEATURE_COMPRESS_PREFIX ):
+            ( method, _, level ) = feature[ len( cls.FEATURE_COMPRESS_PREFIX ) : ].partition( ":" )
+            try:
+               return ( method, int( level ) )
+            except ValueError:
+               return None
+      return None
    
    @staticmethod
    def meta_package( meta : Meta ) ->  MetaPacked:
@@ -85,7 +164,7 @@ class RemoteConnection(RemoteConnectionCMDS):
            if index >= 0:
               break
       obj_raw  = (self.data[0:index]).decode("utf8")
-      self.data = self.data[(index+1):]
+      del self.data[ 0 : index + 1 ]
 
       
       obj = json.loads( obj_raw )
@@ -105,51 +184,158 @@ class RemoteConnection(RemoteConnectionCMDS):
       while len( self.data ) < count:
          self._read_input(  count  - len(self.data) )
       to_ret    = self.data[0:count]
-      self.data = self.data[count:]
+      del self.data[ 0 : count ]
       return to_ret
    
-   def wait_for_ack( self ) -> Dict[str, ConnValue]:
-      resp_json = self.resp_wait_object()
-      resp_status = resp_json[ self.RSP_STATUS_KEY ]
-      if resp_status == self.RSP_STATUS_OK or resp_status == self.RSP_STATUS_DONE:
-         return resp_json
-      raise SA_SYNC_Exception_SSH_Server_Error("Error on remote '%s' " % ( resp_status ) )
-      
+   def _read_into( self, buf : bytearray ) -> None:
+      """ Fill the buffer with exactly its size of input, reading straight into it """
+      view = memoryview( buf )
+      pos = min( len( self.data ), len( buf ) )
+      if pos > 0: # Left over from reading the json objects
+         view[ 0 : pos ] = self.data[ 0 : pos ]
+         del self.data[ 0 : pos ]
+      while pos < len( buf ):
+         n_read = self.pipe_in.readinto( view[ pos : ] )
+         if not n_read:
+            raise SA_SYNC_Exception_SSH_Connection_Closed("Connection closed")
+         pos += n_read
+   
+   def wait_for_ack( self, request_id : int = None ) -> Dict[str, ConnValue]:
+      """ Wait for the response to given request. Responses to the earlier pipelined requests are checked on the way """
+      while True:
+         resp_json = self.resp_wait_object()
+         resp_id = resp_json.get( self.PROTO_KEY_ID )
+         self.pending.discard( resp_id )
+         resp_status = resp_json[ self.RSP_STATUS_KEY ]
+         if resp_status != self.RSP_STATUS_OK and resp_status != self.RSP_STATUS_DONE:
+            raise SA_SYNC_Exception_SSH_Server_Error("Error on remote '%s' " % ( resp_status ) )
+         if resp_id == request_id:
+            return resp_json
+      
+   def _request_send( self, parameters : Sequence[ Any ] ) -> int:
+      obj = { self.PROTO_KEY_CMD : parameters[0], self.PROTO_KEY_PARAMS : parameters[1:] }
+      request_id = None
+      if self.has_feature( self.FEATURE_PIPELINE ):
+         self.request_id += 1
+         request_id = self.request_id
+         obj[ self.PROTO_KEY_ID ] = request_id
+      self._send( self._construct_object( obj ) )
+      return request_id
+
    def send( self, *parameters : Union[ ConnValue, MetaPacked ] ) -> Dict[str, ConnValue]:
-      assert( len(self.data) == 0 )
-      json_bytes = self._construct_object( { self.PROTO_KEY_CMD : parameters[0], self.PROTO_KEY_PARAMS : parameters[1:] }  ) 
-      self._send( json_bytes )
-      return self.wait_for_ack()
+      assert( len(self.data) == 0 or len(self.pending) > 0 )
+      return self.wait_for_ack( self._request_send( parameters ) )
+   
+   def send_async( self, *parameters : Union[ ConnValue, MetaPacked ] ) -> None:
+      """ Send command without waiting for the response, if the other end supports it. 
+          Errors are raised at the latest from flush() """
+      if self.has_feature( self.FEATURE_PIPELINE ) == False:
+         self.send( *parameters )
+         return
+      # Keep the amount of unread responses small, so that neither end blocks on full pipe 
+      while len( self.pending ) >= CONFIG.SSH_WINDOW:
+         self.wait_for_ack( min( self.pending ) )
+      self.pending.add( self._request_send( parameters ) )
+   
+   def flush( self ) -> None:
+      """ Wait for responses to all commands in flight """
+      while len( self.pending ) > 0:
+         self.wait_for_ack( min( self.pending ) )
    
    def send_obj( self, obj : Dict[str, Any] ) -> None:
        header_bytes = self._construct_object( obj )
        self._send( header_bytes ) 
    
+   def _data_package_send( self, package : bytes, method : str ) -> None:
+      if len( package ) == 0:
+         return # Zero length is the end marker
+      if self.binary:
+         self.pipe_out.write( self.DATA_HEADER.pack( self.DATA_METHODS.index( method ), len( package ) ) )
+         self._send( package )
+         return
+      header = { self.DATA_LEN_KEY : len( package ) }
+      if method != None:
+         header[ self.DATA_COMPRESSION_KEY ] = method
+      self.send_obj( header )
+      self._send( package )
+
    def data_send( self, data_source : Iterable [bytes] ) -> None:
+      method = self.compression
+      compressor = None
       for package in data_source:
-         data_len = len( package )
-         self.send_obj( { self.DATA_LEN_KEY : data_len } )
-         self._send( package )
+         # The first package decides, if the stream is worth compressing at all
+         if method != None and compressor == None:
+            if compression.is_compressible( package ):
+               compressor = compression.compressor_create( method, self.compression_level )
+            else:
+               method = None
+         wire = compressor.compress( package ) if compressor != None else package
+         self.stats_sent.add( len( package ), len( wire ) )
+         self._data_package_send( wire, method )
+      if compressor != None:
+         wire = compressor.flush()
+         self.stats_sent.add( 0, len( wire ) )
+         self._data_package_send( wire, method )
       # And then say that we are done
-      self.send_obj( { self.DATA_LEN_KEY : 0 } )
-              
+      if self.binary:
+         self._send( self.DATA_HEADER.pack( 0, 0 ) )
+      else:
+         self.send_obj( { self.DATA_LEN_KEY : 0 } )
+   
+   def _data_header_receive( self ) -> Tuple[ int, str ]:
+      """ Return length and compression method of the next data package """
+      if self.binary == False:
+         header = self.resp_wait_object()
+         return ( int( header[ self.DATA_LEN_KEY ] ), header.get( self.DATA_COMPRESSION_KEY ) )
+      header_raw = bytearray( self.DATA_HEADER.size )
+      self._read_into( header_raw )
+      ( method_index, data_len ) = self.DATA_HEADER.unpack( header_raw )
+      if method_index >= len( self.DATA_METHODS ):
+         raise SA_SYNC_Exception_SSH("Invalid data header")
+      return ( data_len, self.DATA_METHODS[ method_index ] )
+   
+   def _data_package_receive( self, count : int ) -> bytes:
+      if self.binary == False:
+         return self.resp_wait_count( count )
+      package = bytearray( count )
+      self._read_into( package )
+      return package
       
    def data_receive( self ) -> Iterable [bytes]:
+      decompressor = None # type: compression.Decompressor
       while True:
-         header = self.resp_wait_object()
-         data_len = int( header[ self.DATA_LEN_KEY ] ) 
+         ( data_len, method ) = self._data_header_receive()
          
          if data_len == 0: # We are done!
             return 
          
+         if method != None and decompressor == None:
+            decompressor = compression.Decompressor( method )
+         
          # Ok, we received header that says that there is data_len amount of raw data coming in.
          # Yield it in buffer sized blocks
          data_count = 0
          while data_count < data_len:
             to_get = min( data_len - data_count, CONFIG.DATA_BLOCK_SIZE )
-            data_package = self.resp_wait_count( to_get )
+            data_package = self._data_package_receive( to_get )
             data_count += to_get
-            yield data_package 
+            if method == None:
+               self.stats_received.add( to_get, to_get )
+               yield data_package
+               continue
+            n_wire = to_get
+            for data_out in decompressor.feed( data_package ):
+               self.stats_received.add( len( data_out ), n_wire )
+               n_wire = 0
+               yield data_out
+            self.stats_received.add( 0, n_wire )
+
+   def data_send_str( self, data : str ) -> None:
+      raw = bytes( data, "utf8" )
+      self.data_send( raw[ i : i + CONFIG.DATA_BLOCK_SIZE ] for i in range( 0, len( raw ), CONFIG.DATA_BLOCK_SIZE ) )
+
+   def data_receive_str( self ) -> str:
+      return b"".join( self.data_receive() ).decode( "utf8" )
          
 
 class RemoteSSHServerConnClose( SA_SYNC_Exception ):
@@ -165,61 +351,165 @@ class RemoteSSHServer:
       self.conn = RemoteConnection( pipe_in, pipe_out )
       self.commands = { cmd.lower() : getattr(self, "serve_" + cmd.lower() ) for cmd in RemoteConnection.KNOWN_COMMANDS }
       self.last_sent_error = None # type: str
+      self.request_id = None # type: int
+      self.file_check_stats = FileCheckStats() # Existing targets checked during the session
 
    def send_response( self, values : Dict[ str, Any ] = None, error : str = None ):
       to_send = { }
       if error == None:
          status_value = RemoteConnection.RSP_STATUS_OK
-         self.last_sent_error = None
+         if self.request_id == None: # With pipelining, the client may react to the error only after later commands
+            self.last_sent_error = None
       else:
          status_value = error
          self.last_sent_error = error
          
       to_send[ RemoteConnection.RSP_STATUS_KEY ] = status_value
+      if self.request_id != None:
+         to_send[ RemoteConnection.PROTO_KEY_ID ] = self.request_id
       if values != None:
          to_send.update( values )
       self.conn.send_obj( to_send )
 
 
-   def serve_cmd_handshake( self, version : str ) -> None:
+   def serve_cmd_handshake( self, version : str, features : List[str] = None ) -> None:
       try:
          check_database( self.db )
       except SA_SYNC_Exception_Cancelled as err:
          self.send_response( error=str(err) )
          return
-      self.fs.trash_clear()
-      self.send_response( { "version" : CONFIG.VERSION } )
+      error = self.session_open()
+      if error != None:
+         self.send_response( error=error )
+         return
+      # Older clients do not send features at all
+      self.conn.features_set( [ x for x in ( features or [] ) if x in RemoteConnection.FEATURES ] )
+      # Data both ways is compressed as the client asks. Older clients do not ask, then our own configuration decides
+      asked = RemoteConnection.compression_parse( features or [] )
+      if asked == None:
+         asked = ( CONFIG.COMPRESSION, CONFIG.COMPRESSION_LEVEL )
+      self.conn.compression_set( *asked )
+      response = { "version" : CONFIG.VERSION, RemoteConnection.RSP_FEATURES_KEY : self.conn.features }
+      if self.conn.has_feature( RemoteConnection.FEATURE_RESUME ):
+         # Transfers interrupted earlier, these the client can continue 
+         response[ RemoteConnection.RSP_PARTIAL_KEY ] = self.fs.partial_list()
+      self.send_response( response )
       
    def serve_cmd_close( self ) -> None:
+      self.session_close()
       self.send_response()
-      self.fs.trash_clear()
       raise RemoteSSHServerConnClose()
    
-   def serve_cmd_get( self, source : MetaPacked ) -> None:
+   def session_open( self ) -> str:
+      """ Prepare the repository for the client. Returns the error to respond with, or None """
+      self.fs.trash_clear()
+      self.file_check_stats = FileCheckStats()
+      return None
+   
+   def session_close( self ) -> None:
+      """ The client is done with the repository """
+      self.fs.trash_clear()
+      self.fs.partial_clear()
+      print_debug( self.file_check_stats.summary() )
+   
+   def _offset_get( self, options : Dict[ str, Any ] ) -> int:
+      """ Offset for file_create: None for old clients, that do not know about partial files """
+      if self.conn.has_feature( RemoteConnection.FEATURE_RESUME ) == False:
+         return None
+      return int( ( options or {} ).get( RemoteConnection.OPTION_OFFSET, 0 ) )
+   
+   def serve_cmd_get( self, source : MetaPacked, sig : delta.Signature = None, options : Dict[ str, Any ] = None ) -> None:
       meta_source = RemoteConnection.meta_unpack( source )
-      fid = self.fs.file_read( meta_source.filename )
+      fid = self.fs.file_read( meta_source.filename, self._offset_get( options ) or 0 )
       self.send_response()
+      if sig != None:
+         fid = delta.delta( sig, fid )
       self.conn.data_send( fid )
    
-   def _check_file_done( self, meta : Meta ) -> bool:
-      status = check_file_equal( meta, self.db, self.fs ) 
+   def _check_file_status( self, meta : Meta ) -> str:
+      """ Return None if the file can be written, otherwise the error to respond with """
+      status = check_file_equal( meta, self.db, self.fs, self.file_check_stats ) 
       
       if status == Filestatus.FILE_OVERWRITE_OK:
-         return False
+         return None
       elif status == Filestatus.FILE_EQUAL:
-         self.send_response( error = RemoteConnection.RSP_STATUS_DONE )
-         return True
-      else:
-         self.send_response( error=str(status) )
-         return True
-      
-   def serve_cmd_set( self, target : MetaPacked ) -> None :
+         return RemoteConnection.RSP_STATUS_DONE
+      return str(status)
+   
+   def _check_file_done( self, meta : Meta ) -> bool:
+      status = self._check_file_status( meta )
+      if status == None:
+         return False
+      self.send_response( error = status )
+      return True
+      
+   def serve_cmd_have( self, targets : List[ MetaPacked ] ) -> None:
+      """ Tell which of the files are already here or can not be written. The rest the client will send """
+      statuses = {} # type: Dict[ str, str ]
+      partials = {} # type: Dict[ str, int ]
+      for packed in targets:
+         meta = RemoteConnection.meta_unpack( packed )
+         status = self._check_file_status( meta )
+         if status != None:
+            statuses[ meta.filename ] = status
+         elif self.conn.has_feature( RemoteConnection.FEATURE_RESUME ) and self.fs.partial_size( meta.checksum ) > 0:
+            partials[ meta.checksum ] = self.fs.partial_size( meta.checksum )
+      self.send_response( { RemoteConnection.RSP_HAVE_KEY : statuses, RemoteConnection.RSP_PARTIAL_KEY : partials } )
+      
+   def serve_cmd_set( self, target : MetaPacked, options : Dict[ str, Any ] = None ) -> None :
       meta_target = RemoteConnection.meta_unpack( target )
-      if self._check_file_done( meta_target ):
+      offset = self._offset_get( options )
+      # Checked already with CMD_HAVE
+      checked = options != None and options.get( RemoteConnection.OPTION_CHECKED, False )
+      if options != None and options.get( RemoteConnection.SET_OPTION_PUSH, False ):
+         # Data follows the command right away, and we respond after it
+         status = None if checked else self._check_file_status( meta_target )
+         if status == None:
+            self.fs.file_create( meta_target, self.conn.data_receive(), offset )
+         else:
+            for _ in self.conn.data_receive():
+               pass
+         self.send_response( error = status )
          return
-      self.send_response() # We must ack the command before data starts flowing
-      data_source = self.conn.data_receive()
-      self.fs.file_create( meta_target, data_source )
+      
+      if checked == False and self._check_file_done( meta_target ):
+         return
+      basis = None
+      if self.conn.has_feature( RemoteConnection.FEATURE_DELTA ) and not offset:
+         basis = delta_basis( self.fs, meta_target.filename )
+      if basis == None:
+         self.send_response() # We must ack the command before data starts flowing
+         self.fs.file_create( meta_target, self.conn.data_receive(), offset )
+         return
+      # Send signature of the old version, and the client responds with delta against it
+      sig = delta.signature_file( basis )
+      self.send_response( { RemoteConnection.RSP_SIGNATURE_KEY : sig } )
+      self.fs.file_create( meta_target, delta.patch( basis, sig["block"], self.conn.data_receive() ), offset )
+      
+   def serve_cmd_get_many( self, sources : List[ MetaPacked ], options : Dict[ str, Any ] ) -> None:
+      metas = { meta.filename : meta for meta in map( RemoteConnection.meta_unpack, sources ) }
+      
+      def read_small() -> Iterable[ Tuple[Meta, bytes] ]:
+         for filename in self.fs.disk_order( metas.keys(), int( options[ RemoteConnection.OPTION_MAX_SIZE ] ) ):
+            yield ( metas[ filename ], b"".join( self.fs.file_read( filename ) ) )
+      
+      self.send_response()
+      self.conn.data_send( bulk.pack( read_small() ) )
+   
+   def serve_cmd_set_many( self ) -> None:
+      """ Files come right after the command, and we respond after them. The first error is responded, but the
+          rest of the files are still written """
+      error = None # type: str
+      for ( meta, data ) in bulk.unpack( self.conn.data_receive() ):
+         status = self._check_file_status( meta ) # Cheap for the new files, that these mostly are
+         try:
+            if status == None:
+               self.fs.file_create( meta, [ data ] )
+            elif status != RemoteConnection.RSP_STATUS_DONE:
+               error = error or status
+         except SA_Exception as err:
+            error = error or str( err )
+      self.send_response( error = error )
       
    def serve_cmd_del( self, target : MetaPacked )  -> None:
       meta_target = RemoteConnection.meta_unpack( target )
@@ -248,15 +538,42 @@ class RemoteSSHServer:
       meta_source, meta_target = self._get_check_source_target( source, target )
       if meta_source == None:
          return 
-      fid = self.fs.file_read( meta_source.filename )
-      self.fs.file_create( meta_target, fid )
+      self.fs.file_copy( meta_source, meta_target )
       self.send_response()
       
-   def serve_cmd_db_get( self ) -> None:
+   def _db_delta_enabled( self ) -> bool:
+      return self.conn.has_feature( RemoteConnection.FEATURE_DB_DELTA ) and self.conn.has_feature( RemoteConnection.FEATURE_DB_STREAM )
+   
+   def serve_cmd_db_get( self, uid : str = None, since : int = None, select : Dict[ str, List[str] ] = None ) -> None:
+      if self._db_delta_enabled():
+         # The client has our database up to generation 'since' cached, if its from this replica
+         use_delta = uid == self.db.replica_uid() and since != None and since <= self.db.generation()
+         self.send_response( { RemoteConnection.RSP_UID_KEY : self.db.replica_uid(), 
+                               RemoteConnection.RSP_GENERATION_KEY : self.db.generation(),
+                               RemoteConnection.OPTION_DELTA : use_delta } )
+         if select != None and self.conn.has_feature( RemoteConnection.FEATURE_DB_SELECT ):
+            rules = SyncRules.json_from( select )
+            self.conn.data_send_str( self.db.select_dumps( rules, since if use_delta else None ) )
+            return
+         self.conn.data_send_str( self.db.changes_dumps( since ) if use_delta else self.db.json_dumps() )
+         return
       db_as_json = self.db.json_dumps()
+      if self.conn.has_feature( RemoteConnection.FEATURE_DB_STREAM ):
+         self.send_response()
+         self.conn.data_send_str( db_as_json )
+         return
       self.send_response( { RemoteConnection.RSP_DATABASE_KEY : db_as_json } )
    
-   def serve_cmd_db_set( self, db_json_str ) -> None: 
+   def serve_cmd_db_set( self, db_json_str : str = None, options : Dict[ str, Any ] = None ) -> None: 
+      if db_json_str == None: # Database comes over the data channel
+         self.send_response()
+         db_json_str = self.conn.data_receive_str()
+      if ( options or {} ).get( RemoteConnection.OPTION_DELTA ) and self._db_delta_enabled():
+         base = self.db.generation()
+         self.db.changes_loads( db_json_str, mirror = False )
+         self.db.save()
+         self.send_response( { RemoteConnection.RSP_BASE_KEY : base, RemoteConnection.RSP_GENERATION_KEY : self.db.generation() } )
+         return
       self.db.json_loads( db_json_str )
       self.db.save()
       self.send_response()
@@ -275,6 +592,7 @@ class RemoteSSHServer:
          
          command = RemoteConnection.COMMANDS_LOOKUP[ command_str ].lower()
          params  = cmd_obj[ self.conn.PROTO_KEY_PARAMS ] # type: List[Any]
+         self.request_id = cmd_obj.get( self.conn.PROTO_KEY_ID )
          
          fun_to_call = self.commands[ command ] 
          try:
@@ -297,38 +615,232 @@ class RemoteSSHServerFileNotEqual( SA_SYNC_Exception_SSH ):
 
 class RemoteSSH( Remote ):
    
-   def file_get( self, source : Meta ) -> Iterable [bytes]:
-      self.conn.send( self.conn.CMD_GET, self.conn.meta_package( source ) ) 
-      yield from self.conn.data_receive()
+   def file_get( self, source : Meta, basis : str = None, offset : int = 0 ) -> Iterable [bytes]:
+      if offset > 0:
+         if self.conn.has_feature( RemoteConnection.FEATURE_RESUME ) == False:
+            raise SA_SYNC_Exception_SSH("Remote does not support resuming transfers")
+         self.conn.send( self.conn.CMD_GET, self.conn.meta_package( source ), None, { RemoteConnection.OPTION_OFFSET : offset } ) 
+         yield from self.conn.data_receive()
+         return
+      if basis == None or self.conn.has_feature( RemoteConnection.FEATURE_DELTA ) == False:
+         self.conn.send( self.conn.CMD_GET, self.conn.meta_package( source ) ) 
+         yield from self.conn.data_receive()
+         return
+      sig = delta.signature_file( basis )
+      self.conn.send( self.conn.CMD_GET, self.conn.meta_package( source ), sig )
+      yield from delta.patch( basis, sig["block"], self.conn.data_receive() )
       
-   def file_set( self, target : Meta, content: Iterable [bytes] ) -> None:
-      ret = self.conn.send( self.conn.CMD_SET, self.conn.meta_package( target )  )
+   def _remote_has_basis( self, target : Meta ) -> bool:
+      """ Could the remote use its current version of the file for delta transfer """
+      if self.conn.has_feature( RemoteConnection.FEATURE_DELTA ) == False:
+         return False
+      try:
+         return self.db.meta_get( target.filename ).checksum_normal()
+      except SA_DB_Exception_NotFound:
+         return False
+   
+   def file_partial( self, target : Meta ) -> int:
+      return self.partials.get( target.checksum, 0 )
+   
+   def supports_offset( self ) -> bool:
+      return self.conn.has_feature( RemoteConnection.FEATURE_RESUME )
+   
+   def files_check( self, targets : List[Meta] ) -> Set[str]:
+      if self.conn.has_feature( RemoteConnection.FEATURE_HAVE ) == False:
+         return set()
+      present = set() # type: Set[str]
+      errors  = [] # type: List[str]
+      for start in range( 0, len( targets ), CONFIG.SSH_HAVE_BATCH ):
+         batch = targets[ start : start + CONFIG.SSH_HAVE_BATCH ]
+         resp = self.conn.send( self.conn.CMD_HAVE, [ self.conn.meta_package( meta ) for meta in batch ] )
+         statuses = cast( Dict[ str, str ], resp[ RemoteConnection.RSP_HAVE_KEY ] )
+         for ( filename, status ) in statuses.items():
+            if status == RemoteConnection.RSP_STATUS_DONE:
+               present.add( filename )
+            else:
+               errors.append( status )
+         self.checked.update( meta.filename for meta in batch if meta.filename not in statuses )
+         self.partials.update( cast( Dict[ str, int ], resp.get( RemoteConnection.RSP_PARTIAL_KEY, {} ) ) )
+      for error in errors:
+         print_error( error )
+      if len( errors ) > 0:
+         raise SA_SYNC_Exception_SSH_Server_Error("%d file(s) can not be written on remote" % len( errors ) )
+      return present
+   
+   def _bulk_enabled( self ) -> bool:
+      return self.conn.has_feature( RemoteConnection.FEATURE_BULK ) and self.conn.has_feature( RemoteConnection.FEATURE_PIPELINE )
+   
+   def files_get_bulk( self, items : List[Meta] ) -> Iterable[ Tuple[Meta, bytes] ]:
+      if self._bulk_enabled() == False or len( items ) == 0:
+         return
+      self.conn.send( self.conn.CMD_GET_MANY, [ self.conn.meta_package( meta ) for meta in items ], 
+                      { RemoteConnection.OPTION_MAX_SIZE : CONFIG.BULK_MAX_SIZE } )
+      yield from bulk.unpack( self.conn.data_receive() )
+      
+   def files_set_bulk( self, items : Iterable[ Tuple[Meta, bytes] ] ) -> List[Meta]:
+      if self._bulk_enabled() == False:
+         return super().files_set_bulk( items )
+      items = iter( items )
+      first = next( items, None )
+      if first == None:
+         return []
+      written = [ first[0] ]
+      
+      def collect() -> Iterable[ Tuple[Meta, bytes] ]:
+         yield first
+         for item in items:
+            written.append( item[0] )
+            yield item
+      
+      self.conn.send_async( self.conn.CMD_SET_MANY )
+      self.conn.data_send( bulk.pack( collect() ) )
+      return written
+   
+   def file_set( self, target : Meta, content: Iterable [bytes], offset : int = 0 ) -> None:
+      options = { RemoteConnection.OPTION_OFFSET : offset } # type: Dict[ str, Any ]
+      if target.filename in self.checked:
+         options[ RemoteConnection.OPTION_CHECKED ] = True
+      if self.conn.has_feature( RemoteConnection.FEATURE_PIPELINE ) and ( offset > 0 or self._remote_has_basis( target ) == False ):
+         # New file: no need to wait for the remote to check it, just push the data 
+         options[ RemoteConnection.SET_OPTION_PUSH ] = True
+         self.conn.send_async( self.conn.CMD_SET, self.conn.meta_package( target ), options )
+         self.conn.data_send( content )
+         return
+      ret = self.conn.send( self.conn.CMD_SET, self.conn.meta_package( target ), options )
       
       if ret[ RemoteConnection.RSP_STATUS_KEY ] == RemoteConnection.RSP_STATUS_DONE:
          return
+      if RemoteConnection.RSP_SIGNATURE_KEY in ret:
+         content = delta.delta( ret[ RemoteConnection.RSP_SIGNATURE_KEY ], content )
       self.conn.data_send( content )
    
    def file_del( self, target : Meta ) -> None:
-      self.conn.send( self.conn.CMD_DEL, self.conn.meta_package( target ) )
+      self.conn.send_async( self.conn.CMD_DEL, self.conn.meta_package( target ) )
       
    def file_move( self, source : Meta, target : Meta ) -> None:
-      self.conn.send( self.conn.CMD_MOVE, self.conn.meta_package( source ), self.conn.meta_package( target ) )
+      self.conn.send_async( self.conn.CMD_MOVE, self.conn.meta_package( source ), self.conn.meta_package( target ) )
 
    def file_copy( self, source : Meta, target : Meta ) -> None:
-      self.conn.send( self.conn.CMD_COPY, self.conn.meta_package( source ), self.conn.meta_package( target ) )
+      self.conn.send_async( self.conn.CMD_COPY, self.conn.meta_package( source ), self.conn.meta_package( target ) )
+   
+   def flush( self ) -> None:
+      self.conn.flush()
       
    def database_get( self ) -> DatabaseBase:
       return self.db
    
+   def _handshake( self ) -> None:
+      method = self.compression if self.compression != None else CONFIG.COMPRESSION
+      features = RemoteConnection.FEATURES + [ RemoteConnection.compression_feature( method, CONFIG.COMPRESSION_LEVEL ) ]
+      resp = self.conn.send( self.conn.CMD_HANDSHAKE, CONFIG.VERSION, features )
+      self.conn.features_set( resp.get( RemoteConnection.RSP_FEATURES_KEY, [] ) )
+      self.conn.compression_set( method, CONFIG.COMPRESSION_LEVEL )
+      self.partials = resp.get( RemoteConnection.RSP_PARTIAL_KEY, {} ) # type: Dict[ str, int ]
+      self.checked  = set() # type: Set[str] # Files known to be writable, see files_check()
+   
+   def _db_delta_enabled( self ) -> bool:
+      return ( self.cache_path != None and self.conn.has_feature( RemoteConnection.FEATURE_DB_DELTA ) 
+               and self.conn.has_feature( RemoteConnection.FEATURE_DB_STREAM ) )
+   
+   def _database_select( self ) -> Dict[ str, List[str] ]:
+      """ The sync rules to limit the database exchange with, or None to get the whole database """
+      if self.rules == None or self.rules.selects_all() or self.conn.has_feature( RemoteConnection.FEATURE_DB_SELECT ) == False:
+         return None
+      return self.rules.json_to()
+   
+   def _database_open_delta( self ) -> None:
+      select = self._database_select()
+      if select == None:
+         self.peer_cache = PeerCache( self.cache_path, self.url )
+      else: # The cached copy has only the selected files
+         self.peer_cache = PeerCache( self.cache_path, self.url + "#" + json.dumps( select, sort_keys = True ) )
+      self.db_selected = select != None
+      cached = self.peer_cache.load()
+      params = [ cached.replica_uid(), cached.generation() ] if cached != None else [ None, None ]
+      if self.conn.has_feature( RemoteConnection.FEATURE_DB_SELECT ): # Older servers do not take the rules
+         params.append( select )
+      resp = self.conn.send( self.conn.CMD_DB_GET, *params )
+      data = self.conn.data_receive_str()
+      if resp.get( RemoteConnection.OPTION_DELTA ):
+         print_debug( "Database changes since generation %d received" % cached.generation() )
+         self.db = cached
+         self.db.changes_loads( data, mirror = True )
+      else:
+         self.db.json_loads( data )
+      if self.db.replica_uid() != resp.get( RemoteConnection.RSP_UID_KEY ) or self.db.generation() != resp.get( RemoteConnection.RSP_GENERATION_KEY ):
+         raise SA_SYNC_Exception_SSH("Remote database generation mismatch")
+      # Everything up to this generation is now known to both ends
+      self.db_generation = self.db.generation()
+      self.peer_cache.save( self.db )
+      
    def _database_open( self ) -> None:
       self.db = DatabaseJson()
-      self.conn.send( self.conn.CMD_HANDSHAKE, CONFIG.VERSION )
+      self.db_selected = False
+      self._handshake()
       print_debug( "Connection ok. Fetching database .. "  )
+      if self._db_delta_enabled():
+         self._database_open_delta()
+         return
       resp = self.conn.send( self.conn.CMD_DB_GET )
-      self.db.json_loads( str( resp[ self.conn.RSP_DATABASE_KEY ] ) )
-      
-   def database_save( self ) -> None :
-      self.conn.send( self.conn.CMD_DB_SET, self.db.json_dumps() )
+      if self.conn.RSP_DATABASE_KEY in resp:
+         self.db.json_loads( str( resp[ self.conn.RSP_DATABASE_KEY ] ) )
+      else:
+         self.db.json_loads( self.conn.data_receive_str() )
+      
+   def _database_save_delta( self, conn : RemoteConnection ) -> None:
+      resp = conn.send( conn.CMD_DB_SET, None, { RemoteConnection.OPTION_DELTA : True } )
+      conn.data_send_str( self.db.changes_dumps( self.db_generation ) )
+      resp = conn.wait_for_ack( resp.get( conn.PROTO_KEY_ID ) )
+      if resp.get( RemoteConnection.RSP_BASE_KEY ) != self.db_generation:
+         # Someone else changed the remote meanwhile, our copy is not anymore in line with it
+         self.peer_cache.clear()
+         if self.db_selected == False: # The whole database can be sent from now on. Selected part only as changes
+            self.cache_path = None
+         return
+      self.db_generation = int( resp[ RemoteConnection.RSP_GENERATION_KEY ] )
+      self.db.generation_set( self.db_generation )
+      self.peer_cache.save( self.db )
+      
+   def database_save( self, conn : RemoteConnection = None ) -> None :
+      if conn == None:
+         conn = self.conn
+      if self._db_delta_enabled():
+         self._database_save_delta( conn )
+         return
+      if conn.has_feature( RemoteConnection.FEATURE_DB_STREAM ) == False:
+         conn.send( conn.CMD_DB_SET, self.db.json_dumps() )
+         return
+      resp = conn.send( conn.CMD_DB_SET )
+      conn.data_send_str( self.db.json_dumps() )
+      conn.wait_for_ack( resp.get( conn.PROTO_KEY_ID ) )
+   
+   def database_checkpoint( self, via : Remote ) -> None:
+      self.database_save( cast( RemoteSSH, via ).conn )
+
+   def transfer_summary( self ) -> str:
+      sent     = compression.TransferStats()
+      received = compression.TransferStats()
+      for remote in [ self ] + self.channels:
+         sent.add( remote.conn.stats_sent.bytes_raw, remote.conn.stats_sent.bytes_wire )
+         received.add( remote.conn.stats_received.bytes_raw, remote.conn.stats_received.bytes_wire )
+      return "Sent %s. Received %s" % ( sent.summary(), received.summary() )
+   
+   def channels_open( self, count : int ) -> None:
+      """ Open more ssh sessions to the same repository for parallel transfers. They share our database object """
+      for loop in range( count ):
+         channel = type( self )( "%s#%d" % ( self.name, loop + 1 ) )
+         channel.compression = self.compression
+         channel._connect( self.url )
+         try:
+            channel._handshake()
+         except SA_SYNC_Exception_SSH as err:
+            print_error("Opening channel failed: %s" % err )
+            channel._close_raw()
+            raise SA_SYNC_Exception_SSH("Could not open parallel connection")
+         channel.db = self.db
+         channel.checked = self.checked
+         self.channels.append( channel )
+      print_debug( "%d parallel connections opened" % len( self.channels ) )
    
    def _close_raw( self ) -> None:
       
@@ -346,6 +858,7 @@ class RemoteSSH( Remote ):
          print_remote_error("Remote stderr:", stderr.decode("utf-8") ) 
       
    def close( self, assume_ok = True ) -> None:
+      self.channels_close()
       self.conn.send( self.conn.CMD_CLOSE )
       self._close_raw()
       
@@ -354,10 +867,7 @@ class RemoteSSH( Remote ):
       
       
 
-   def open( self, url : str ):
-      """ Open ssh connection to remote, and execute there sarch sync command, 
-         :param url: is assumed to be like  ssh://username@host.foo.com:/my/path/to/target" """
-          
+   def _connect( self, url : str ) -> None:
       assert( url.startswith("ssh://") )
       # replace the ssh
       url_parts = url[6:].split(":", 1)
@@ -367,9 +877,31 @@ class RemoteSSH( Remote ):
       username_n_host = url_parts[0]
       target_path     = url_parts[1]
       print_debug( "Opening connection to %s .. " % username_n_host )
-      self.ssh = Popen( ( CONFIG.SSH_COMMAND, username_n_host, "sarch", "_server_mode", target_path ), 
-                         stdin=PIPE, stdout=PIPE,stderr=PIPE )
+      if CONFIG.SSH_BOOTSTRAP:
+         self._connect_bootstrap( username_n_host, target_path )
+      else:
+         self.ssh = Popen( ( CONFIG.SSH_COMMAND, username_n_host, "sarch", "_server_mode", target_path ), 
+                            stdin=PIPE, stdout=PIPE,stderr=PIPE )
       self.conn = RemoteConnection( self.ssh.stdout, self.ssh.stdin, )
+      self.url = url
+
+   def _connect_bootstrap( self, username_n_host : str, target_path : str ) -> None:
+      """ Run the server from zipapp sent over the connection, for hosts without sarch installed """
+      from .server import server_archive, BOOTSTRAP
+      archive = server_archive()
+      command = " ".join( shlex.quote( arg ) for arg in ( CONFIG.SSH_PYTHON, "-c", BOOTSTRAP, str( len( archive ) ), target_path ) )
+      self.ssh = Popen( ( CONFIG.SSH_COMMAND, username_n_host, command ), stdin=PIPE, stdout=PIPE,stderr=PIPE )
+      try:
+         self.ssh.stdin.write( archive )
+         self.ssh.stdin.flush()
+      except OSError as err:
+         self._close_raw()
+         raise SA_SYNC_Exception_SSH("Sending the server to remote failed: %s" % err )
+   
+   def open( self, url : str ):
+      """ Open ssh connection to remote, and execute there sarch sync command, 
+         :param url: is assumed to be like  ssh://username@host.foo.com:/my/path/to/target" """
+      self._connect( url )
       print_info("Connection opened, fetching database .. ")
       #self.ssh.stdin.raw.write( bytes('{"cmd": "hello", "par": ["1.0.0"]}\0{"cmd": "close", "par": []}\0',"utf8") )
       try:
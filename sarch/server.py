@@ -0,0 +1,101 @@
+""" Server end of the ssh sync. Imports only what serving needs, so that the connection is ready for the handshake soon,
+    and the modules can be packed into single file zipapp for hosts that do not have sarch installed """
+import os
+import sys
+from functools import lru_cache
+
+from typing import List
+
+from .exceptions import SA_Exception
+from .common import CONFIG, print_error, set_output_to
+from .database import open_database
+from .filesystem import Filesystem
+from .remote import check_for_mods_serving
+from .remote_ssh import remote_ssh_server
+
+
+# Modules the server imports, all of them go to the zipapp
+SERVER_MODULES = ( "__init__", "exceptions", "common", "database", "database_json", "filesystem", "remote", "remote_ssh",
+                   "peer_cache", "delta", "bulk", "compression", "sync_rules", "server" )
+
+# Run with 'python3 -c BOOTSTRAP <archive size> <path>': reads the zipapp from stdin and serves from it.
+# The stdin is read unbuffered, so that the protocol data after the archive is left for the server
+BOOTSTRAP = """import os,sys,tempfile
+size=int(sys.argv[1]);data=b''
+while len(data)<size:
+ part=os.read(0,size-len(data))
+ if len(part)==0:sys.exit('Archive truncated')
+ data+=part
+fid,name=tempfile.mkstemp(suffix='.pyz');os.write(fid,data);os.close(fid)
+sys.path.insert(0,name)
+try:
+ import sarch.server;ret=sarch.server.main(sys.argv[2:])
+finally:
+ os.unlink(name)
+sys.exit(ret)
+"""
+
+ARCHIVE_MAIN = "import sys\nfrom sarch.server import main\nsys.exit( main( sys.argv[1:] ) )\n"
+
+
+def server_mode( path : str ) -> int:
+   """ Serve the repository at path over stdin and stdout """
+   filesystem = Filesystem( path )
+   database = open_database( filesystem.make_absolute(CONFIG.PATH) )
+
+   set_output_to( sys.stderr )
+   sys.stdout.flush()
+   sys.stdin.flush()
+
+   if check_for_mods_serving( database, filesystem ) > 0 :
+      print_error("Remote has local modifications. Please commit changes there and try again.")
+      return -1
+
+   pipe_in  = open( sys.stdin.fileno(), 'rb', closefd=False )
+   pipe_out = open( sys.stdout.fileno(), 'wb', closefd=False )
+   return remote_ssh_server( database, filesystem, pipe_in, pipe_out )
+
+
+def main( arguments : List[str] ) -> int:
+   """ Entry point of the zipapp, without the argument parsing of the full command line """
+   if len( arguments ) != 1:
+      sys.stderr.write("Usage: sarch_server.pyz <path to repository>\n")
+      return -1
+   try:
+      return server_mode( arguments[0] )
+   except SA_Exception as error:
+      print_error( str(error) )
+      return -1
+
+
+@lru_cache( maxsize = 1 )
+def server_archive() -> bytes:
+   """ The server modules as zipapp, run with 'python3 sarch_server.pyz <path>' """
+   import io
+   import zipfile
+
+   package_dir = os.path.dirname( os.path.abspath( __file__ ) )
+   buf = io.BytesIO()
+   buf.write( b"#!/usr/bin/env python3\n" )
+   with zipfile.ZipFile( buf, "w", zipfile.ZIP_DEFLATED ) as archive:
+      for module in SERVER_MODULES:
+         with open( os.path.join( package_dir, module + ".py" ), "rb" ) as fid:
+            source = fid.read()
+         archive.writestr( "sarch/%s.py" % module, source )
+         compiled = _compile_pyc( source, "sarch/%s.py" % module )
+         if compiled != None:
+            archive.writestr( "sarch/%s.pyc" % module, compiled )
+      archive.writestr( "__main__.py", ARCHIVE_MAIN )
+   return buf.getvalue()
+
+
+def _compile_pyc( source : bytes, filename : str ) -> bytes:
+   """ Byte code for zipimport, that can not cache it. Other python versions reject it by the magic number and
+       compile the source instead """
+   import importlib.util
+   import marshal
+   if hasattr( importlib.util, "source_hash" ) == False: # Hash based pyc files are from python 3.7
+      return None
+   code = compile( source, filename, "exec", dont_inherit = True )
+   flags = 1 # Hash based, the hash is not checked against the source
+   return importlib.util.MAGIC_NUMBER + flags.to_bytes( 4, "little" ) + importlib.util.source_hash( source ) + marshal.dumps( code )
@@ -0,0 +1,86 @@
+import json
+import os
+from pathlib import Path
+
+from typing import Any, Dict, List
+
+from .common import CONFIG, print_debug
+
+
+class SyncRules:
+   """ Subtrees of the repository synced with a remote. A file is selected when it is under one of the include prefixes,
+       or there are none, and not under any of the exclude prefixes. Files outside the selection are not synced either way.
+       The rules of each remote url are kept in the repository, see load() and save() """
+
+   FILENAME = "sync_rules.json"
+
+   def __init__( self, include : List[str] = None, exclude : List[str] = None ) -> None:
+      self.include = sorted( set( self._normalize( prefix ) for prefix in include or [] ) )
+      self.exclude = sorted( set( self._normalize( prefix ) for prefix in exclude or [] ) )
+
+   @staticmethod
+   def _normalize( prefix : str ) -> str:
+      parts = [ part for part in prefix.split( CONFIG.PATH_SEPARATOR ) if part not in ( "", "." ) ]
+      return CONFIG.PATH_SEPARATOR.join( parts )
+
+   @staticmethod
+   def _under( filename : str, prefix : str ) -> bool:
+      return prefix == "" or filename == prefix or filename.startswith( prefix + CONFIG.PATH_SEPARATOR )
+
+   def selects_all( self ) -> bool:
+      return len( self.include ) == 0 and len( self.exclude ) == 0
+
+   def wanted( self, filename : str ) -> bool:
+      if any( self._under( filename, prefix ) for prefix in self.exclude ):
+         return False
+      return len( self.include ) == 0 or any( self._under( filename, prefix ) for prefix in self.include )
+
+   def dir_wanted( self, dirname : str ) -> bool:
+      """ Can there be selected files under the directory """
+      if dirname == "":
+         return True
+      if any( self._under( dirname, prefix ) for prefix in self.exclude ):
+         return False
+      return len( self.include ) == 0 or any( self._under( dirname, prefix ) or self._under( prefix, dirname ) for prefix in self.include )
+
+   def json_to( self ) -> Dict[ str, List[str] ]:
+      return { "include" : self.include, "exclude" : self.exclude }
+
+   @classmethod
+   def json_from( cls, obj : Dict[ str, List[str] ] ) -> 'SyncRules':
+      return cls( obj.get( "include" ), obj.get( "exclude" ) )
+
+   def __str__( self ) -> str:
+      return "include: %s, exclude: %s" % ( ", ".join( self.include ) or "everything", ", ".join( self.exclude ) or "nothing" )
+
+   @classmethod
+   def _rules_file( cls, path : str ) -> str:
+      return os.path.join( path, cls.FILENAME )
+
+   @classmethod
+   def _load_all( cls, path : str ) -> Dict[ str, Any ]:
+      try:
+         with open( cls._rules_file( path ) ) as fid:
+            return json.loads( fid.read() )
+      except FileNotFoundError:
+         return {}
+      except ValueError:
+         print_debug("Sync rules '%s' corrupted, ignoring them" % cls._rules_file( path ) )
+         return {}
+
+   @classmethod
+   def load( cls, path : str, url : str ) -> 'SyncRules':
+      """ Rules for the remote url, selecting everything if none are set """
+      return cls.json_from( cls._load_all( path ).get( url, {} ) )
+
+   def save( self, path : str, url : str ) -> None:
+      rules = self._load_all( path )
+      if self.selects_all():
+         rules.pop( url, None )
+      else:
+         rules[ url ] = self.json_to()
+      real_target = Path( self._rules_file( path ) )
+      tmp_target  = Path( self._rules_file( path ) + ".tmp" )
+      with open( str(tmp_target), 'wb' ) as fid:
+         fid.write( bytes( json.dumps( rules ), "utf8" ) )
+      tmp_target.rename( real_target )
@@ -0,0 +1,51 @@
+import json
+import os
+from pathlib import Path
+
+from typing import Tuple
+
+from .common import print_debug
+from .remote import SyncTable
+
+
+class SyncState:
+   """ Plan of the sync in progress, so that interrupted sync can be resumed with the same plan, without asking the
+       conflicts again. How far the sync got is in the databases, saved at the checkpoints, see SyncCheckpoint """
+
+   FILENAME = "sync_state.json"
+
+   def __init__( self, path : str ) -> None:
+      self.state_file = os.path.join( path, self.FILENAME )
+
+   def exists( self ) -> bool:
+      return os.path.exists( self.state_file )
+
+   def save( self, url : str, xtable_local : SyncTable, xtable_other : SyncTable ) -> None:
+      state = { "url" : url, "local" : xtable_local.json_to(), "other" : xtable_other.json_to() }
+      real_target = Path( self.state_file )
+      tmp_target  = Path( self.state_file + ".tmp" )
+      with open( str(tmp_target), 'wb' ) as fid:
+         fid.write( bytes( json.dumps( state ), "utf8" ) )
+      tmp_target.rename( real_target )
+
+   def load( self ) -> Tuple[ str, SyncTable, SyncTable ]:
+      """ Returns the url and the plan for both ends, or None if there is no valid state """
+      try:
+         with open( self.state_file ) as fid:
+            state = json.loads( fid.read() )
+         xtable_local = SyncTable("Local")
+         xtable_local.json_from( state["local"] )
+         xtable_other = SyncTable("Other")
+         xtable_other.json_from( state["other"] )
+      except FileNotFoundError:
+         return None
+      except ( ValueError, KeyError, TypeError ):
+         print_debug("Sync state '%s' corrupted, ignoring it" % self.state_file )
+         return None
+      return ( str( state["url"] ), xtable_local, xtable_other )
+
+   def clear( self ) -> None:
+      try:
+         os.unlink( self.state_file )
+      except FileNotFoundError:
+         pass
@@ -16,6 +16,9 @@ import json
 
 CONFIG.DATA_BLOCK_SIZE = 4
 
+# Benchmarks are slow and their results vary by machine, they run only when asked. See run_benchmark in Makefile
+BENCHMARK = os.environ.get( "SARCH_BENCHMARK" ) != None
+
 class LogOutput:
    
    def __init__(self, check):
@@ -115,12 +118,13 @@ class TempDir:
     
    
 class RepoInDir(TempDir):
-   def __init__( self, name : str, assertfun ) -> None:
+   def __init__( self, name : str, assertfun, init : bool = True ) -> None:
       super().__init__( assertfun )
       self.no_cd = None # type: bool
       self.name = name
       self.check = assertfun
-      self.main( "init", self.name )
+      if init:
+         self.main( "init", self.name )
       self.fs = Filesystem( self.test_dir )
       self.db = DatabaseJson( )
       self.db_sizes = (0,0,0)
@@ -1,15 +1,22 @@
-from unittest.mock import MagicMock
+import hashlib
+import os
+import time
+import unittest
+from unittest.mock import MagicMock, patch
 import shutil
 from os.path import join
 from functools import partial
 from threading import Thread
 from queue import Queue
+from typing import List
 
 
 from sarch.common import CONFIG
-from .common import TestBase
+from .common import TestBase, LogOutput, BENCHMARK
 from sarch.remote_ssh import RemoteConnection, RemoteSSHServer, RemoteSSH, SA_SYNC_Exception_SSH_Server_Error
 from sarch.database import Meta
+from sarch.sync_rules import SyncRules
+from sarch import delta
 
 
 class ThreadedRunner():
@@ -31,10 +38,22 @@ class FakePipe:
    
    def __init__( self ) -> None:
       self.queue = Queue() # type: Queue
+      self.left  = bytearray()
       
    def read1( self, size ) -> bytearray:
+      if len( self.left ) > 0:
+         ( to_ret, self.left ) = ( self.left, bytearray() )
+         return to_ret
       return self.queue.get(  timeout=1 ) 
    
+   def readinto( self, buf ) -> int:
+      if len( self.left ) == 0:
+         self.left = self.queue.get( timeout=1 )
+      count = min( len( buf ), len( self.left ) )
+      buf[ 0 : count ] = self.left[ 0 : count ]
+      del self.left[ 0 : count ]
+      return count
+   
    def flush(self):
       pass
    
@@ -48,23 +67,36 @@ def chunks(l):
         yield l[i:i + 2]
 
 
+
+class ServerNoSelect( RemoteSSHServer ):
+   """ Server from before the database selection: no feature for it, and db_get takes no rules """
+   
+   def serve_cmd_handshake( self, version : str, features : List[str] = None ) -> None:
+      super().serve_cmd_handshake( version, [ x for x in ( features or [] ) if x != RemoteConnection.FEATURE_DB_SELECT ] )
+   
+   def serve_cmd_db_get( self, uid : str = None, since : int = None ) -> None: # type: ignore
+      super().serve_cmd_db_get( uid, since )
       
       
 class TestRemoteConn( TestBase ):
    """ Test remote ssh connection with spoofed setup; use the current repository as the server and
    the client as fake """
    
-   def remote_open( self ) -> None:
+   def remote_open( self, cache_path : str = None, compression : str = None, rules : SyncRules = None, server_class : type = RemoteSSHServer ) -> None:
       
       self.pipe_server_in = FakePipe()
       self.pipe_client_in = FakePipe()
       
       self.client = RemoteConnection( self.pipe_client_in, self.pipe_server_in,  ) # type: ignore 
-      self.server_raw = RemoteSSHServer( self.repo.db, self.repo.fs,  self.pipe_server_in, self.pipe_client_in, ) # type: ignore
+      self.server_raw = server_class( self.repo.db, self.repo.fs,  self.pipe_server_in, self.pipe_client_in, ) # type: ignore
       
       # Function to be called when client runs out of data
       self.remote = RemoteSSH("other")
       self.remote.conn = self.client
+      self.remote.url = "ssh://fake:/repo"
+      self.remote.cache_path = cache_path
+      self.remote.compression = compression
+      self.remote.rules = rules
       self.remote.ssh  = MagicMock() # type: ignore
       self.remote.ssh.communicate =  MagicMock( return_value = (bytes("STDOUT", "utf8"),bytes("STDERR", "utf8") ) ) # type: ignore
       
@@ -78,6 +110,8 @@ class TestRemoteConn( TestBase ):
       
    def test_open( self ):
       self.remote_open()
+      self.assertTrue( self.remote.conn.binary )
+      self.assertTrue( self.server_raw.conn.binary )
       self.close()
       
       
@@ -130,9 +164,88 @@ class TestRemoteConn( TestBase ):
       self.repo.file_make("NEW_FILE", content="INVALIDFOO"*16 )
       with self.assertRaises(SA_SYNC_Exception_SSH_Server_Error):
          self.remote.file_set( meta, chunks( bytes("FOO"*16,"utf8") ))
+         self.remote.flush()
       self.close()
       
          
+   def test_overwrite_by_modtime( self ) -> None:
+      meta = self.open_and_get_foo()
+      meta.checksum = hashlib.md5( b"NEW CONTENT" ).hexdigest()
+      meta.modtime += 10
+      stats = self.server_raw.file_check_stats
+      self.remote.file_set( meta, chunks( bytes( "NEW CONTENT", "utf8" ) ) )
+      self.remote.flush()
+      self.assertEqual( ( 1, 0 ), ( stats.n_stat, stats.n_hashed ) )
+      
+      # Modification time of the wanted file: hashed, as it may be there already
+      self.assertEqual( { "FOO" }, self.remote.files_check( [ meta ] ) )
+      self.assertEqual( ( 1, 1 ), ( stats.n_stat, stats.n_hashed ) )
+      
+      # Modified file, decided from the time too
+      self.repo.file_make( "BAR", content = "MODIFIED", timestamp = 2**20 )
+      with self.assertRaises( SA_SYNC_Exception_SSH_Server_Error ):
+         self.remote.file_set( self.remote.db.meta_get( "BAR" ), [ b"BAR" ] )
+         self.remote.flush()
+      self.assertEqual( ( 2, 1 ), ( stats.n_stat, stats.n_hashed ) )
+      self.close()
+      
+      # Counted per session
+      self.assertIsNone( self.server_raw.session_open() )
+      self.assertEqual( ( 0, 0 ), ( self.server_raw.file_check_stats.n_stat, self.server_raw.file_check_stats.n_hashed ) )
+      
+   def test_files_check( self ) -> None:
+      data = bytes( "NEW CONTENT", "utf8" )
+      self.repo.file_make( "NEW_FILE", content = "NEW CONTENT" )
+      meta_new = Meta( "NEW_FILE" )
+      self.repo.fs.meta_update( meta_new )
+      self.repo.file_del( "NEW_FILE" )
+      self.remote_open()
+      meta_foo = self.remote.db.meta_get( "FOO" )
+      
+      with patch.object( RemoteSSHServer, "_check_file_status", autospec = True, side_effect = RemoteSSHServer._check_file_status ) as check:
+         self.assertEqual( { "FOO" }, self.remote.files_check( [ meta_foo, meta_new ] ) )
+         self.assertEqual( 2, check.call_count )
+         # Checked file is written without checking it again
+         self.remote.file_set( meta_new, [ data ] )
+         self.remote.flush()
+         self.assertEqual( 2, check.call_count )
+      
+      self.repo.file_make( "UNTRACKED", content = "UNTRACKED" )
+      meta_untracked = meta_new.copy()
+      meta_untracked.filename = "UNTRACKED"
+      with self.assertRaises( SA_SYNC_Exception_SSH_Server_Error ):
+         self.remote.files_check( [ meta_untracked ] )
+      self.assertEqual( 1, len( [ err for err in self.log.error if "'UNTRACKED' exists as untracked file" in err ] ) )
+      self.close()
+      self.repo.file_check( "NEW_FILE", exists = True, checksum = meta_new.checksum )
+      
+   def test_bulk( self ) -> None:
+      self.repo.file_make( "LARGE", content = "L" * 2**11 )
+      self.remote_open()
+      metas = [ self.remote.db.meta_get( fn ) for fn in ( "FOO", "BAR" ) ]
+      large = Meta( "LARGE" )
+      self.repo.fs.meta_update( large )
+      with patch.object( CONFIG, "BULK_MAX_SIZE", 2**11 ):
+         files = list( self.remote.files_get_bulk( metas + [ large ] ) )
+      self.assertEqual( [ "FOO", "BAR" ], [ meta.filename for ( meta, data ) in files ] )
+      
+      for ( meta, data ) in files:
+         meta.filename += "_BULK"
+      self.remote.files_set_bulk( files )
+      self.remote.flush()
+      for meta in metas:
+         self.repo.file_check( meta.filename + "_BULK", exists = True, checksum = meta.checksum )
+      
+      # Rest of the files are written even if one fails
+      self.repo.file_make( "UNTRACKED_BULK", content = "UNTRACKED" )
+      files[0][0].filename = "UNTRACKED_BULK"
+      files[1][0].filename = "AFTER_BULK"
+      with self.assertRaises( SA_SYNC_Exception_SSH_Server_Error ):
+         self.remote.files_set_bulk( files )
+         self.remote.flush()
+      self.close()
+      self.repo.file_check( "AFTER_BULK", exists = True, checksum = metas[1].checksum )
+      
    def test_file_move_untracked(self) -> None:
       meta = self.open_and_get_foo()
       self.repo.file_make("FOO_COPY")
@@ -140,6 +253,7 @@ class TestRemoteConn( TestBase ):
       meta_copy.filename = "FOO_COPY"
       with self.assertRaises(SA_SYNC_Exception_SSH_Server_Error):
          self.remote.file_move( meta, meta_copy )
+         self.remote.flush()
       self.close()
 
    def test_file_move(self) -> None:
@@ -172,7 +286,210 @@ class TestRemoteConn( TestBase ):
      self.repo.file_make("NEW_FILE", content=content)
      self.repo.fs.meta_update( meta )
      self.remote_open()
-     self.remote.file_set( meta, chunks(content) )
+     self.remote.file_set( meta, chunks( bytes( content, "utf8" ) ) )
      self.close()
+
+   def delta_setup( self ):
+      """ Make FOO large enough for delta transfer, and its modified version NEW_FOO """
+      content = "".join( "LINE %05d OF THE FILE\n" % loop for loop in range( 200 ) )
+      self.repo.file_make( "FOO", content = content, timestamp = 2**21 )
+      self.repo.main( "commit", "--auto" )
+      self.repo.open_db()
+      self.repo.file_make( "NEW_FOO", content = content.replace( "LINE 00100", "LINE CHANGED" ) )
+      meta = Meta( "NEW_FOO" )
+      self.repo.fs.meta_update( meta )
+      meta.filename = "FOO"
+      with open( self.repo.fs.make_absolute( "NEW_FOO" ), "rb" ) as fid:
+         data = fid.read()
+      return ( meta, data )
+
+   def delta_patches( self ):
+      sent = []
+      original = delta.delta
+      def counting_delta( *pargs ):
+         for data in original( *pargs ):
+            sent.append( len(data) )
+            yield data
+      return ( sent, patch.multiple( CONFIG, DELTA_MIN_SIZE = 256, DELTA_BLOCK_MIN = 64 ), patch.object( delta, "delta", new=counting_delta ) )
+
+   def test_file_set_delta( self ) -> None:
+     ( meta, data ) = self.delta_setup()
+     ( sent, patch_config, patch_delta ) = self.delta_patches()
+     with patch_config, patch_delta:
+        self.remote_open()
+        self.assertTrue( self.remote.conn.has_feature( RemoteConnection.FEATURE_DELTA ) )
+        self.remote.file_set( meta, chunks( data ) )
+        self.close()
+     self.repo.file_check( "FOO", exists = True, checksum=meta.checksum )
+     self.assertLess( sum( sent ), len( data ) / 4 )
+
+   def test_file_get_delta( self ) -> None:
+     ( meta, data ) = self.delta_setup()
+     basis = self.repo.fs.make_absolute( "FOO" )
+     ( sent, patch_config, patch_delta ) = self.delta_patches()
+     with patch_config, patch_delta:
+        self.remote_open()
+        meta.filename = "NEW_FOO"
+        received = bytearray()
+        for data_loop in self.remote.file_get( meta, basis ):
+           received += data_loop
+        self.close()
+     self.assertEqual( data, received )
+     self.assertLess( sum( sent ), len( data ) / 4 )
+
+   def compression_roundtrip( self, method, data ) -> None:
+     """ Send data as new file and read it back, returns the stats of sent and received data """
+     with open( self.repo.fs.make_absolute( "SOURCE" ), "wb" ) as fid:
+        fid.write( data )
+     meta = Meta( "SOURCE" )
+     self.repo.fs.meta_update( meta )
+     meta.filename = "TARGET_" + method
+     # Client asks for the method, the configuration of the server does not matter. Server reads the file in blocks
+     with patch.object( CONFIG, "COMPRESSION", "none" ), patch.object( CONFIG, "DATA_BLOCK_SIZE", 2**16 ):
+        self.remote_open( compression = method )
+        self.remote.file_set( meta, [ data ] )
+        received = b"".join( self.remote.file_get( meta ) )
+        stats = ( self.remote.conn.stats_sent, self.remote.conn.stats_received )
+        self.close()
+     self.repo.file_check( meta.filename, exists = True, checksum=meta.checksum )
+     self.assertEqual( data, received )
+     return stats
+
+   def test_compression( self ) -> None:
+     for method in ( "zlib", "lzma" ):
+        for stats in self.compression_roundtrip( method, bytes( "SOME TEXT THAT COMPRESSES WELL\n" * 1000, "utf8" ) ):
+           self.assertLess( stats.bytes_wire * 10, stats.bytes_raw )
+
+   def test_compression_skipped( self ) -> None:
+     ( sent, _ ) = self.compression_roundtrip( "zlib", os.urandom( 10000 ) )
+     self.assertEqual( sent.bytes_wire, sent.bytes_raw )
+
+   def test_compression_default( self ) -> None:
+     data = bytes( "SOME TEXT THAT COMPRESSES WELL\n" * 1000, "utf8" )
+     for stats in self.compression_roundtrip( "none", data ):
+        self.assertEqual( stats.bytes_wire, stats.bytes_raw )
+     # Older clients do not ask, then the server uses its own configuration
+     self.remote_open()
+     with patch.object( CONFIG, "COMPRESSION", "zlib" ):
+        self.client.send( self.client.CMD_HANDSHAKE, CONFIG.VERSION, RemoteConnection.FEATURES )
+        self.assertEqual( "zlib", self.server_raw.conn.compression )
+     self.close()
+
+   def test_pipelined( self ) -> None:
+     filenames = self.repo.file_make_many( [ "NEW%03d" % loop for loop in range(6) ] )
+     self.remote_open()
+     self.assertTrue( self.remote.conn.has_feature( RemoteConnection.FEATURE_PIPELINE ) )
+     with patch.object( CONFIG, "SSH_WINDOW", 2 ):
+        for fn in filenames:
+           self.remote.file_del( Meta( fn ) )
+           self.assertLessEqual( len( self.remote.conn.pending ), 2 )
+        # Untracked target in the middle of the batch
+        self.repo.file_make( "FOO_COPY" )
+        meta = self.remote.db.meta_get( "FOO" )
+        meta_copy = meta.copy()
+        meta_copy.filename = "FOO_COPY"
+        with self.assertRaises( SA_SYNC_Exception_SSH_Server_Error ):
+           self.remote.file_copy( meta, meta_copy )
+           self.remote.file_del( self.remote.db.meta_get( "dir1/dir2/FOO" ) )
+           self.remote.flush()
+     self.close()
+     for fn in filenames:
+        self.repo.file_check( fn, exists = False )
+
+   def test_resume_partial( self ) -> None:
+     data = bytes( "RESUMABLE CONTENT " * 20, "utf8" )
+     with open( self.repo.fs.make_absolute( "SOURCE" ), "wb" ) as fid:
+        fid.write( data )
+     meta = Meta( "SOURCE" )
+     self.repo.fs.meta_update( meta )
+     with open( str( self.repo.fs._partial_prepare( meta.checksum ) ), "wb" ) as fid:
+        fid.write( data[0:100] + b"GARBAGE AFTER THE RESUME POINT" )
      
+     self.remote_open()
+     self.assertEqual( 130, self.remote.file_partial( meta ) )
+     self.assertEqual( data[100:], b"".join( self.remote.file_get( meta, None, 100 ) ) )
+     meta.filename = "TARGET"
+     self.remote.file_set( meta, [ data[100:] ], 100 )
+     self.close()
+     self.repo.file_check( "TARGET", exists = True, checksum=meta.checksum )
+     self.assertEqual( 0, self.repo.fs.partial_size( meta.checksum ) )
+
+   def test_db_delta( self ) -> None:
+     cache_path = self.repo.fs.make_absolute( CONFIG.PATH_PEERS )
+     self.remote_open( cache_path )
+     self.assertTrue( self.remote.conn.has_feature( RemoteConnection.FEATURE_DB_DELTA ) )
+     self.assertEqual( 1, len( os.listdir( cache_path ) ) )
+     self.close()
      
+     # Change on the remote side after the exchange
+     meta = self.repo.db.meta_get( "FOO" )
+     meta.checksum = "#CHANGED"
+     self.repo.db.meta_set( meta )
+     generation = self.repo.db.generation()
+     with patch.object( self.repo.db, "changes_dumps", wraps = self.repo.db.changes_dumps ) as changes_dumps:
+        self.remote_open( cache_path )
+        changes_dumps.assert_called_once_with( generation - 1 )
+     self.assertEqual( "#CHANGED", self.remote.db.meta_get( "FOO" ).checksum )
+     self.assertEqual( self.repo.db.json_dumps(), self.remote.db.json_dumps() )
+     
+     # And our changes are pushed back as delta
+     meta = self.remote.db.meta_get( "BAR" )
+     meta.checksum = "#PUSHED"
+     self.remote.db.meta_set( meta )
+     self.remote.database_save()
+     self.close()
+     self.assertEqual( "#PUSHED", self.repo.db.meta_get( "BAR" ).checksum )
+     self.assertEqual( generation + 1, self.repo.db.generation() )
+     self.assertEqual( generation + 1, self.remote.peer_cache.load().generation() )
+
+   def test_db_select( self ) -> None:
+     cache_path = self.repo.fs.make_absolute( CONFIG.PATH_PEERS )
+     rules = SyncRules( include = [ "dir1" ] )
+     self.remote_open( cache_path, rules = rules )
+     self.assertTrue( self.remote.db_selected )
+     self.assertEqual( [ "dir1/dir2/BAR", "dir1/dir2/FOO" ], sorted( self.remote.db.meta_list_keys() ) )
+     self.close()
+     
+     # Older server gets the request without the rules, and sends the whole database
+     self.remote_open( cache_path, rules = rules, server_class = ServerNoSelect )
+     self.assertFalse( self.remote.conn.has_feature( RemoteConnection.FEATURE_DB_SELECT ) )
+     self.assertFalse( self.remote.db_selected )
+     self.assertIn( "FOO", self.remote.db.meta_list_keys() )
+     self.close()
+
+
+@unittest.skipUnless( BENCHMARK, "benchmark" )
+class TestFramingBenchmark( unittest.TestCase ):
+   """ Throughput of the data stream over in-process pipe pair, with json and binary package headers """
+   
+   SIZE = (2**25)
+   
+   def setUp( self ):
+      self.log = LogOutput( self.assertEqual )
+      self.log.set_verbose( True )
+   
+   def transfer( self, binary : bool ) -> float:
+      ( fd_read, fd_write ) = os.pipe()
+      with open( fd_read, "rb" ) as pipe_in, open( fd_write, "wb" ) as pipe_out:
+         sender   = RemoteConnection( None, pipe_out ) # type: ignore
+         receiver = RemoteConnection( pipe_in, None ) # type: ignore
+         for conn in ( sender, receiver ):
+            conn.features_set( [ RemoteConnection.FEATURE_BINARY ] if binary else [] )
+         block = bytes( CONFIG.DATA_BLOCK_SIZE )
+         
+         time_start = time.perf_counter()
+         worker = ThreadedRunner( lambda: sender.data_send( block for loop in range( self.SIZE // len(block) ) ) )
+         n_received = 0
+         for data in receiver.data_receive():
+            n_received += len( data )
+         worker.wait()
+         self.assertEqual( self.SIZE, n_received )
+         return time.perf_counter() - time_start
+   
+   def test_benchmark( self ) -> None:
+      with patch.object( CONFIG, "DATA_BLOCK_SIZE", 2**20 ), patch.object( CONFIG, "COMPRESSION", "none" ):
+         results = { binary : self.transfer( binary ) for binary in ( False, True ) }
+      self.log.fun_info( "Data stream of %d MiB: json headers %.1f MiB/s, binary headers %.1f MiB/s" % 
+                         ( self.SIZE >> 20, ( self.SIZE >> 20 ) / results[False], ( self.SIZE >> 20 ) / results[True] ) )
+      # Binary headers are there to save the json parsing of each package
+      self.assertLess( results[True], results[False] )
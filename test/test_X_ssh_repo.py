@@ -1,9 +1,20 @@
 import unittest
 from unittest.mock import patch, MagicMock
+import io
+import json
+import os
+import sys
 import time
 import subprocess
+import zipfile
 
-from .common import RepoInDir, LogOutput
+import sarch
+from sarch.common import CONFIG
+from sarch.remote_ssh import RemoteConnection
+from sarch.server import server_archive
+from sarch.peer_cache import PeerCache
+from sarch.sync_rules import SyncRules
+from .common import RepoInDir, LogOutput, TempDir, BENCHMARK
 from threading import Thread
 class TestSSHRepo(unittest.TestCase):
    
@@ -64,3 +75,204 @@ class TestSSHRepo(unittest.TestCase):
    
 
 
+
+class TestSSHLoopback(unittest.TestCase):
+   """ Sync over real server processes, started by fake ssh command that runs them locally """
+   
+   def setUp(self):
+      self.log = LogOutput( self.assertEqual )
+      self.log.start()
+      
+      self.repo_local  = RepoInDir("repo_local", self.assertEqual )
+      self.repo_remote = RepoInDir("repo_remote", self.assertEqual )
+      self.repo_local.fillup_std_layout()
+      
+      self.script_dir = TempDir( self.assertEqual )
+      script = os.path.join( self.script_dir.test_dir, "fake_ssh" )
+      package_root = os.path.dirname( os.path.dirname( os.path.abspath( sarch.__file__ ) ) )
+      with open( script, "w" ) as fid:
+         fid.write( "#!/bin/sh\n# Drop the host name, and run the command here\nshift\nshift\n" )
+         fid.write( "PYTHONPATH='%s' exec python3 -m sarch \"$@\"\n" % package_root )
+      os.chmod( script, 0o755 )
+      self.patched_ssh = patch.object( CONFIG, "SSH_COMMAND", script )
+      self.patched_ssh.start()
+   
+   def tearDown(self):
+      self.patched_ssh.stop()
+      for tdir in ( self.repo_local, self.repo_remote, self.script_dir ):
+         tdir.clean()
+   
+   def sync( self, *args ):
+      self.repo_local.main( "sync", "ssh://loopback:" + self.repo_remote.test_dir, *args )
+   
+   def test_sync_parallel(self):
+      with patch.object( CONFIG, "VERBOSE", 1 ):
+         self.sync( "--jobs", "3" )
+      self.log.info_contains( "2 parallel connections opened" )
+      self.repo_local.check_equal( self.repo_remote )
+      self.repo_remote.main( "verify" )
+      
+      self.repo_local.make_std_mods()
+      self.sync( "--jobs", "3" )
+      self.repo_remote.main( "verify" )
+      self.repo_remote.main( "status" )
+      
+      self.repo_remote.file_make_many( [ "NEW%03d" % loop for loop in range(10) ], basepath = [ "new" ] )
+      self.repo_remote.main( "add", "new" )
+      self.repo_remote.main( "commit" )
+      self.log.clear()
+      self.sync( "--jobs", "4", "--compress", "lzma" )
+      self.log.info_contains( "Sync completed! " )
+      self.repo_local.main( "verify" )
+      self.repo_local.file_check( "new/NEW009", exists = True )
+      self.repo_local.check_equal( self.repo_remote )
+   
+   def test_sync_concurrent(self):
+      self.sync( "--concurrent" )
+      self.repo_local.check_equal( self.repo_remote )
+      
+      self.repo_local.make_std_mods()
+      self.repo_remote.file_make_many( [ "NEW%03d" % loop for loop in range(10) ], basepath = [ "new" ] )
+      self.repo_remote.main( "add", "new" )
+      self.repo_remote.main( "commit" )
+      self.log.clear()
+      # Checkpoints are saved over the connections of each direction
+      with patch.object( CONFIG, "BULK_MAX_SIZE", 0 ), patch.object( CONFIG, "CHECKPOINT_FILES", 2 ), patch.object( CONFIG, "VERBOSE", 1 ):
+         self.sync( "--concurrent", "--jobs", "2" )
+      self.log.info_contains( "Repo Local: Checkpoint", 5 )
+      self.log.info_contains( "Repo Other: Checkpoint", 1 )
+      self.log.info_contains( "Sync completed! " )
+      self.repo_local.check_equal( self.repo_remote )
+      self.repo_local.file_check( "new/NEW009", exists = True )
+      self.repo_local.main( "verify" )
+      self.repo_remote.main( "verify" )
+   
+   def test_sync_subset(self):
+      url = "ssh://loopback:" + self.repo_remote.test_dir
+      self.repo_local.main( "subset", url, "--include", "dir1" )
+      self.sync()
+      self.repo_remote.file_check( "dir1/dir2/FOO", exists = True )
+      self.repo_remote.file_check( "FOO", exists = False )
+      
+      # Only the selected part of the remote database was fetched and cached
+      rules = SyncRules.load( self.repo_local.fs.make_absolute( CONFIG.PATH ), url )
+      cached = PeerCache( self.repo_local.fs.make_absolute( CONFIG.PATH_PEERS ), url + "#" + json.dumps( rules.json_to(), sort_keys = True ) ).load()
+      self.assertEqual( [ "dir1/dir2/BAR", "dir1/dir2/FOO" ], sorted( cached.meta_list_keys() ) )
+      
+      self.repo_remote.file_make_many( [ "NEW" ], basepath = [ "dir1" ] )
+      self.repo_remote.file_make_many( [ "NEW" ], basepath = [ "other" ] )
+      self.repo_remote.main( "add", "dir1/NEW", "other/NEW" )
+      self.repo_remote.main( "commit" )
+      self.repo_local.file_make_many( [ "LOCAL" ], basepath = [ "dir1" ] )
+      self.repo_local.main( "add", "dir1/LOCAL" )
+      self.repo_local.main( "commit" )
+      self.sync()
+      self.repo_local.file_check( "dir1/NEW", exists = True )
+      self.repo_local.file_check( "other/NEW", exists = False )
+      self.repo_remote.file_check( "dir1/LOCAL", exists = True )
+      self.repo_remote.main( "verify" )
+      # The files outside the selection are kept in the remote database
+      self.repo_remote.open_db()
+      self.assertEqual( [ "dir1/LOCAL", "dir1/NEW", "dir1/dir2/BAR", "dir1/dir2/FOO", "other/NEW" ], sorted( self.repo_remote.db.meta_list_keys() ) )
+
+
+class TestSSHBootstrap(unittest.TestCase):
+   """ Sync with remote that has no sarch installed: the server is sent over the fake ssh, that runs the command with shell like ssh does """
+   
+   def setUp(self):
+      self.log = LogOutput( self.assertEqual )
+      self.log.start()
+      
+      self.repo_local  = RepoInDir("repo_local", self.assertEqual )
+      self.repo_remote = RepoInDir("repo_remote", self.assertEqual )
+      self.repo_local.fillup_std_layout()
+      
+      self.script_dir = TempDir( self.assertEqual )
+      script = os.path.join( self.script_dir.test_dir, "fake_ssh" )
+      with open( script, "w" ) as fid:
+         fid.write( "#!/bin/sh\n# Drop the host name, and run the command here, away from the sarch sources\nshift\ncd /\nexec sh -c \"$*\"\n" )
+      os.chmod( script, 0o755 )
+      self.patches = [ patch.object( CONFIG, "SSH_COMMAND", script ), patch.object( CONFIG, "SSH_PYTHON", sys.executable ),
+                       patch.object( CONFIG, "SSH_BOOTSTRAP", False ) ]
+      for patcher in self.patches:
+         patcher.start()
+   
+   def tearDown(self):
+      for patcher in self.patches:
+         patcher.stop()
+      for tdir in ( self.repo_local, self.repo_remote, self.script_dir ):
+         tdir.clean()
+   
+   def sync( self, *args ):
+      self.repo_local.main( "sync", "ssh://loopback:" + self.repo_remote.test_dir, "--bootstrap", *args )
+   
+   def test_sync(self):
+      self.sync()
+      self.repo_local.check_equal( self.repo_remote )
+      self.repo_local.make_std_mods()
+      self.sync( "--jobs", "2" )
+      self.repo_local.check_equal( self.repo_remote )
+      self.repo_remote.main( "verify" )
+   
+   def test_archive(self):
+      archive = server_archive()
+      self.assertTrue( archive.startswith( b"#!/usr/bin/env python3\n" ) )
+      with zipfile.ZipFile( io.BytesIO( archive ) ) as fid:
+         names = set( fid.namelist() )
+      self.assertIn( "__main__.py", names )
+      self.assertIn( "sarch/server.py", names )
+      self.assertNotIn( "sarch/commands.py", names )
+   
+   def test_archive_clean_import(self):
+      # Interpreter that has the archive only, to catch modules missing from SERVER_MODULES
+      archive = os.path.join( self.script_dir.test_dir, "sarch_server.pyz" )
+      with open( archive, "wb" ) as fid:
+         fid.write( server_archive() )
+      code = ( "import sys; sys.path.insert( 0, sys.argv[1] ); import sarch.server; "
+               "print( sorted( name for name in sys.modules if name.startswith( 'sarch' ) and sys.modules[name].__file__.startswith( sys.argv[1] ) == False ) )" )
+      result = subprocess.run( [ sys.executable, "-I", "-c", code, archive ], cwd = self.script_dir.test_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE )
+      self.assertEqual( b"", result.stderr )
+      self.assertEqual( b"[]", result.stdout.strip() )
+
+
+@unittest.skipUnless( BENCHMARK, "benchmark" )
+class TestServerStartupBenchmark(unittest.TestCase):
+   """ Time from starting the server process until it responds to the handshake """
+   
+   ROUNDS = 3
+   
+   def setUp(self):
+      self.log = LogOutput( self.assertEqual )
+      self.log.set_verbose( True )
+      self.repo = RepoInDir("repo", self.assertEqual )
+      self.repo.fillup_std_layout()
+      self.script_dir = TempDir( self.assertEqual )
+      self.archive = os.path.join( self.script_dir.test_dir, "sarch_server.pyz" )
+      with open( self.archive, "wb" ) as fid:
+         fid.write( server_archive() )
+      
+   def tearDown(self):
+      self.repo.clean()
+      self.script_dir.clean()
+   
+   def startup( self, command ) -> float:
+      package_root = os.path.dirname( os.path.dirname( os.path.abspath( sarch.__file__ ) ) )
+      env = dict( os.environ, PYTHONPATH = package_root )
+      time_start = time.perf_counter()
+      server = subprocess.Popen( command + [ self.repo.test_dir ], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env = env )
+      conn = RemoteConnection( server.stdout, server.stdin )
+      conn.send( conn.CMD_HANDSHAKE, CONFIG.VERSION )
+      elapsed = time.perf_counter() - time_start
+      conn.send( conn.CMD_CLOSE )
+      server.communicate( timeout = 5 )
+      self.assertEqual( 0, server.returncode )
+      return elapsed
+   
+   def test_benchmark(self):
+      results = {}
+      for name, command in ( ( "python3 -m sarch _server_mode", [ sys.executable, "-m", "sarch", "_server_mode" ] ),
+                             ( "sarch_server.pyz", [ sys.executable, self.archive ] ) ):
+         results[ name ] = min( self.startup( command ) for loop in range( self.ROUNDS ) )
+      self.log.fun_info( "Server startup until handshake: " + ", ".join( "%s %.1f ms" % ( name, 1000 * value ) for name, value in sorted( results.items() ) ) )
+      # The archive has only the server modules, and their byte code
+      self.assertLess( results[ "sarch_server.pyz" ], results[ "python3 -m sarch _server_mode" ] )
@@ -33,3 +33,18 @@ class TestAdding( TestBase ):
        self.repo.main( "revert", "FOO")
        self.repo.main( "add", "FOO", assumed_ret = 1 )
 
+       
+    def test_add_many_conflicts(self):
+       filenames = self.repo.file_make_many( [ "NEW%03d" % loop for loop in range(64) ], basepath=("bulk","sub") )
+       self.repo.file_make( "FOO", timestamp=2**10 )
+       self.repo.main( "revert", "FOO" )
+       self.repo.main( "add", filenames[3] )
+       self.repo.db_update_size()
+       
+       self.log.clear()
+       self.repo.main( "add", "bulk", "FOO", assumed_ret = 1 )
+       self.assertEqual( 2, len(self.log.error) )
+       self.assertIn( filenames[3], self.log.error[1] )
+       self.repo.db_check_size( 0, 0, 63 )
+       self.repo.main( "commit" )
+       self.repo.db_check_size( 1, 64, -1 )
@@ -1,4 +1,5 @@
 import os
+import shutil
 
 from .common import TestBase,TempDir
 from sarch.database import Meta
@@ -44,15 +45,53 @@ class TestAddingFrom( TestBase ):
       
    def test_overwrite_identical( self ):
       meta = Meta( "FOO" )
-      self.repo.fs.meta_update(meta)
+      self.other.file_make( "FOO", content="NEW CONTENT NOT IN REPOSITORY" )
+      self.other.fs.meta_update(meta)
       for loop in range(4):
          meta_new = meta.copy()
-         data = self.repo.fs.file_read( meta.filename )
+         data = self.other.fs.file_read( meta.filename )
          meta_new.filename = "dir%d/FOO" % loop
          self.other.fs.file_create( meta_new, data )
+      self.other.file_del( "FOO" )
       self.basic_test("dir1")
       self.repo.file_check( "dir1/1970-01/FOO", exists=True )
       self.repo.file_check( "dir1/1970-01/FOO-000", exists=False )
       
-                   
-      
\ No newline at end of file
+   def test_dedup_database( self ):
+      self.other.file_make( "NEW_FILE", content="THIS IS NEW" )
+      shutil.copy2( self.repo.fs.make_absolute( "FOO" ), self.other.fs.make_absolute( "OLD_FILE" ) )
+      self.log.clear()
+      self.basic_test("")
+      self.log.info_contains( "already in repository as 'FOO'" )
+      self.log.info_contains( "Imported 1 files, 1 duplicates skipped" )
+      # The sources are removed only with --move
+      self.other.file_check( "OLD_FILE", exists=True )
+      self.other.file_check( "NEW_FILE", exists=True )
+      
+   def test_dedup_database_skips_removed( self ):
+      shutil.copy2( self.repo.fs.make_absolute( "FOO" ), self.other.fs.make_absolute( "FOO_COPY" ) )
+      shutil.copy2( self.repo.fs.make_absolute( "BAR" ), self.other.fs.make_absolute( "BAR_COPY" ) )
+      self.repo.main( "rm", "FOO" ) # Staged for delete
+      self.repo.file_del( "BAR" )   # Missing from disk
+      self.log.clear()
+      os.chdir( self.repo.test_dir )
+      self.repo.main( "add_from", self.other.test_dir, "--move", no_cd = True )
+      self.log.info_contains( "Imported 2 files, 0 duplicates skipped" )
+      self.other.file_check( "FOO_COPY", exists=False )
+      
+   def test_dedup_database_move( self ):
+      shutil.copy2( self.repo.fs.make_absolute( "FOO" ), self.other.fs.make_absolute( "OLD_FILE" ) )
+      os.chdir( self.repo.test_dir )
+      self.repo.main( "add_from", self.other.test_dir, "--move", no_cd = True )
+      self.log.info_contains( "already in repository as 'FOO'" )
+      self.other.file_check( "OLD_FILE", exists=False )
+      
+   def test_move( self ):
+      self.basic_init()
+      os.chdir( self.repo.test_dir )
+      self.repo.main("add_from", self.other.test_dir, "--move", "--jobs", "2", no_cd = True )
+      self.other.file_check( "FILE1", exists=False )
+      self.repo.db_check_size( 0, 0, 6 )
+      self.repo.main("commit")
+      self.basic_check("")
+      self.repo.main("verify")
@@ -0,0 +1,100 @@
+import os
+import tempfile
+
+from .common import CONFIG
+from .test_commands_sync import SyncBase
+from sarch.database import DatabaseBase
+from sarch.database_json import DatabaseJson
+
+
+class TestBundle( SyncBase ):
+
+   def setUp(self) -> None:
+      super().setUp()
+      ( fid, self.bundle ) = tempfile.mkstemp( suffix = ".sab" )
+      os.close( fid )
+
+   def tearDown(self) -> None:
+      os.unlink( self.bundle )
+      super().tearDown()
+
+   def peer_state( self ) -> str:
+      return DatabaseJson.get_database_file( self.other.fs.make_absolute( CONFIG.PATH ) )
+
+   def bundle_create( self, assumed_ret = 0 ) -> None:
+      self.repo.main( "bundle", "create", self.bundle, "--since", self.peer_state(), assumed_ret = assumed_ret )
+
+   def bundle_apply( self, assumed_ret = 0 ) -> None:
+      self.other.main( "bundle", "apply", self.bundle, assumed_ret = assumed_ret )
+
+   def test_bundle( self ) -> None:
+      self.repo.file_make( "NEW_FILE", content = "NEW CONTENT" )
+      self.repo.main( "add", "NEW_FILE" )
+      self.repo.main( "mv", "dir1", "moved" )
+      self.repo.main( "rm", "FOO" )
+      self.repo.main( "commit" )
+
+      self.log.clear()
+      self.bundle_create()
+      self.log.info_contains( "Bundle created: 1 files" )
+      self.other.file_check( "NEW_FILE", exists = False )
+
+      self.bundle_apply()
+      self.log.info_contains( "Bundle applied, 1 files written" )
+      self.repo.check_equal( self.other )
+      self.other.file_check( "moved/dir2/FOO", exists = True )
+      self.other.file_check( "FOO", exists = False )
+      self.other.main( "verify" )
+      self.other.main( "status" )
+      self.other.open_db()
+      self.assertEqual( DatabaseBase.STATUS_CLEAR, self.other.db.get_status() )
+      self.assertEqual( self.repo.db_get( "NEW_FILE" ).checksum, self.other.db_get( "NEW_FILE" ).checksum )
+
+      self.log.clear()
+      self.do_sync()
+      self.log.info_contains( "Everything up to date", 2 )
+
+   def test_bundle_stale( self ) -> None:
+      self.repo.file_make( "NEW_FILE", content = "NEW CONTENT" )
+      self.repo.main( "add", "NEW_FILE" )
+      self.repo.main( "commit" )
+      self.bundle_create()
+
+      # The peer has changed after its state was taken
+      self.other.file_make( "OTHER_FILE", content = "OTHER CONTENT" )
+      self.other.main( "add", "OTHER_FILE" )
+      self.other.main( "commit" )
+      self.bundle_apply( assumed_ret = -1 )
+      self.other.file_check( "NEW_FILE", exists = False )
+
+      # Bundle for other repository
+      self.repo.main( "bundle", "apply", self.bundle, assumed_ret = -1 )
+
+   def test_bundle_apply_again( self ) -> None:
+      self.repo.file_make_many( [ "A_FILE", "Z_FILE" ] )
+      self.repo.main( "add", "A_FILE", "Z_FILE" )
+      self.repo.main( "commit" )
+      self.bundle_create()
+
+      # Untracked file in the way, after the first file was written
+      self.other.file_make( "Z_FILE", content = "UNTRACKED" )
+      self.bundle_apply( assumed_ret = -1 )
+      self.other.file_check( "A_FILE", exists = True )
+      self.other.open_db()
+      self.assertEqual( DatabaseBase.STATUS_SYNC, self.other.db.get_status() )
+      # Not a base for bundles meanwhile
+      self.log.clear()
+      self.other.main( "bundle", "create", self.bundle + ".other", "--since", self.peer_state(), assumed_ret = -1 )
+      self.assertIn( "sync mode", " ".join( self.log.error ) )
+
+      self.other.file_del( "Z_FILE" )
+      self.log.clear()
+      self.bundle_apply()
+      self.log.info_contains( "Bundle applied, 1 files written" )
+      self.repo.check_equal( self.other )
+      self.other.main( "verify" )
+      self.other.open_db()
+      self.assertEqual( DatabaseBase.STATUS_CLEAR, self.other.db.get_status() )
+
+   def test_bundle_needs_state( self ) -> None:
+      self.repo.main( "bundle", "create", self.bundle, assumed_ret = -1 )
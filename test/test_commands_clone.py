@@ -0,0 +1,49 @@
+import os
+
+from .common import TestBase, RepoInDir
+from sarch.database import DatabaseBase
+
+
+class TestClone( TestBase ):
+   
+   def setUp(self) -> None:
+      super().setUp()
+      self.clone = RepoInDir( "clone", self.assertEqual, init = False )
+      
+   def tearDown(self) -> None:
+      self.clone.clean()
+      super().tearDown()
+   
+   def do_clone( self, *args, assumed_ret = 0 ) -> None:
+      self.repo.main( "clone", "file://" + self.repo.test_dir, self.clone.test_dir, "--verbose", *args, assumed_ret = assumed_ret )
+   
+   def check_clone( self ) -> None:
+      self.repo.check_equal( self.clone )
+      self.clone.main( "verify" )
+      self.clone.main( "status" )
+      self.clone.open_db()
+      self.repo.open_db()
+      self.assertEqual( self.repo.db.get_table_sizes(), self.clone.db.get_table_sizes() )
+      self.assertEqual( DatabaseBase.STATUS_CLEAR, self.clone.db.get_status() )
+      self.assertNotEqual( self.repo.db.replica_uid(), self.clone.db.replica_uid() )
+   
+   def test_clone( self ) -> None:
+      self.do_clone()
+      self.log.info_contains( "Clone completed" )
+      self.check_clone()
+      self.log.clear()
+      self.clone.sync( self.repo )
+      self.log.info_contains( "Everything up to date" )
+      
+   def test_clone_removed_files( self ) -> None:
+      self.repo.main( "rm", "FOO" )
+      self.repo.main( "commit" )
+      self.do_clone( "--jobs", "2", "--no_verify" )
+      self.log.info_contains( "Run 'sarch verify'" )
+      self.check_clone()
+      self.clone.file_check( "FOO", exists = False )
+      
+   def test_clone_target_not_empty( self ) -> None:
+      self.clone.file_make( "SOMETHING" )
+      self.do_clone( assumed_ret = -1 )
+      self.assertFalse( os.path.exists( os.path.join( self.clone.test_dir, ".sarch" ) ) )
@@ -1,7 +1,11 @@
 import unittest
 import os
+from unittest.mock import patch
 
 from .common import TestBase
+from sarch.common import CONFIG
+from sarch.filesystem import Filesystem, SA_FS_Exception
+from sarch.hash_cache import HashCache
 
 
 class TestCommit( TestBase ):
@@ -17,6 +21,23 @@ class TestCommit( TestBase ):
        self.log.clear()
        self.repo.main( "commit", "-a","-m","My first autocommit!" )
        self.repo.main( "status" )
+    
+    def test_commit_auto_untracked( self ):
+       new_files = self.repo.file_make_many( ("NEW1", "NEW2"), basepath=("newdir",) )
+       self.repo.file_make( "REMOVED" )
+       self.repo.main( "rm", "BAR" )
+       self.repo.main( "status", assumed_ret = 1 )
+       self.log.clear()
+       self.repo.main( "commit", "--auto", "--jobs", "3" )
+       self.log.info_contains( "Hashing: 3/3 files" )
+       self.log.info_contains( "4 changes commited ok" )
+       self.repo.main( "status" )
+       self.repo.db_check_size( 1, 2, 0 )
+       
+    def test_commit_auto_nothing( self ):
+       self.log.clear()
+       self.repo.main( "commit", "--auto" )
+       self.log.info_contains( "No operations to be done" )
        
     def test_commit_sub( self ):
        self.repo.db_check_size( 0,0,0)
@@ -40,3 +61,58 @@ class TestCommit( TestBase ):
        self.repo.main( "commit",  )
        self.repo.db_check_size( 2,2,0)
        
+       
+    def test_commit_resume_checkpoint( self ):
+       filenames = self.repo.file_make_many( [ "NEW%03d" % loop for loop in range(8) ] )
+       self.repo.main( "add", *filenames )
+       
+       original_meta_update = Filesystem.meta_update
+       hashed = []
+       def failing_meta_update( fs, meta, *pargs, **kwargs ):
+          if len(hashed) >= 5:
+             raise SA_FS_Exception("THIS IS TEST EXCEPTION")
+          hashed.append( meta.filename )
+          return original_meta_update( fs, meta, *pargs, **kwargs )
+       
+       with patch.object( Filesystem, 'meta_update', new=failing_meta_update ):
+          self.repo.main( "commit", "--jobs", "1", assumed_ret = -1 )
+       self.repo.db_check_size( 0, 0, 8 )
+       self.assertTrue( os.path.exists( self.repo.fs.make_absolute( os.path.join( CONFIG.PATH, HashCache.FILENAME ) ) ) )
+       
+       self.log.clear()
+       with patch.object( Filesystem, 'meta_update', new=failing_meta_update ):
+          hashed.clear()
+          self.repo.main( "commit" )
+       self.log.info_contains( "Resuming: 5 checksums" )
+       self.assertEqual( 3, len(hashed) )
+       self.repo.db_check_size( 1, 8, 0 )
+       self.repo.main( "verify" )
+       self.assertFalse( os.path.exists( self.repo.fs.make_absolute( os.path.join( CONFIG.PATH, HashCache.FILENAME ) ) ) )
+       self.assertFalse( os.path.exists( self.repo.fs.make_absolute( os.path.join( CONFIG.PATH, HashCache.JOURNAL_FILENAME ) ) ) )
+    
+    def test_hash_cache_journal( self ):
+       path = self.repo.fs.make_absolute( CONFIG.PATH )
+       stat = os.stat( self.repo.fs.make_absolute( "FOO" ) )
+       cache = HashCache( path )
+       with patch.object( CONFIG, 'CHECKPOINT_FILES', 2 ):
+          for loop in range(5):
+             cache.set( "FILE%d" % loop, stat, "CHECKSUM%d" % loop )
+             cache.checkpoint()
+       
+       # Checkpoints only append the new entries
+       self.assertFalse( os.path.exists( cache.cache_file ) )
+       with open( cache.journal_file ) as fid:
+          self.assertEqual( 4, len( fid.readlines() ) )
+       with open( cache.journal_file, "a" ) as fid:
+          fid.write( '["FILE4", [1' )
+       
+       reopened = HashCache( path )
+       self.assertEqual( 4, reopened.open() )
+       self.assertEqual( "CHECKSUM3", reopened.get( "FILE3", stat ) )
+       self.assertEqual( None, reopened.get( "FILE4", stat ) )
+       
+       cache.save()
+       self.assertFalse( os.path.exists( cache.journal_file ) )
+       self.assertEqual( 5, reopened.open() )
+       cache.clear()
+       self.assertEqual( 0, reopened.open() )
@@ -1,6 +1,9 @@
 
 
+from unittest.mock import patch
+
 from .common import TestBase
+from sarch.database import Commit
 
 class TestLog( TestBase  ):
     
@@ -29,6 +32,53 @@ class TestLog( TestBase  ):
        
        self.log.clear()
        self.repo.main( "log", "FOO", "--count", "3"  )
-       self.assertTrue( len(self.log.info) < 6 )
+       self.log.info_contains( " Commit ", 3 )
+       self.log.info_contains( "mod - FOO", 3 )
+    
+    def test_log_newest_first(self):
+       self.repo.file_make("FOO", content="MODIFIED", timestamp=100000 )
+       self.repo.main( "add", "FOO"  )
+       self.repo.main( "commit", "--msg", "Latest change" )
+       self.log.clear()
+       self.repo.main( "log", "--count", "1" )
+       self.log.info_contains( "Latest change", 1 )
+       self.log.info_contains( " Commit ", 1 )
+    
+    def test_log_dir_filtered(self):
+       self.log.clear()
+       self.repo.main( "log", "dir1" )
+       self.log.info_contains( " Commit ", 1 )
+       self.log.info_contains( "add - dir1/dir2/FOO", 1 )
+       self.log.info_contains( "sdir1/sdir2/FOO", 0 )
+       
+       # Trailing separator on the directory
+       self.log.clear()
+       self.repo.main( "log", "dir1/" )
+       self.log.info_contains( " Commit ", 1 )
+       self.log.info_contains( "add - dir1/dir2/FOO", 1 )
+       self.log.info_contains( "sdir1/sdir2/FOO", 0 )
+       
+    def test_log_dir_history(self):
+       for loop in range(4):
+          self.repo.file_make("FOO", content="MODIFIED %d" % loop, timestamp=100000 + loop )
+          self.repo.main( "add", "FOO" )
+          self.repo.main( "commit" )
+       self.repo.main( "rm", "dir1/dir2/BAR" )
+       self.repo.main( "commit", "--msg", "Removed from dir1" )
+       self.repo.open_db()
+       
+       # The commits are found from the files under the directory, without going through the others
+       with patch.object( Commit, "affected_under", side_effect = AssertionError ):
+          history = list( self.repo.db.commit_history( [ "dir1" ] ) )
+       self.assertEqual( [ "Removed from dir1", "Initial commit" ], [ commit.message for commit in history ] )
+       self.assertEqual( [], list( self.repo.db.commit_history( [ "dir" ] ) ) )
+       
+    def test_log_since(self):
+       self.log.clear()
+       self.repo.main( "log", "--since", "2100-01-01" )
+       self.log.info_contains( " Commit ", 0 )
+       self.repo.main( "log", "--since", "2000-01-01 12:00:00" )
+       self.log.info_contains( " Commit ", 3 )
+       self.repo.main( "log", "--since", "yesterday", assumed_ret = -1 )
 
 
@@ -0,0 +1,88 @@
+import os
+
+from .common import TestBase
+from .test_commands_sync import SyncBase
+from sarch.database import Meta
+
+
+class TestMove( TestBase ):
+
+    def test_mv_dir(self):
+       checksum = self.repo.db_get( "dir1/dir2/FOO" ).checksum
+       self.repo.main( "mv", "dir1", "moved" )
+       self.repo.file_check( "dir1", exists = False )
+       self.repo.file_check( "moved/dir2/FOO", exists = True, checksum = checksum )
+       self.repo.db_check_size( 0, 0, 4 )
+       self.repo.main( "status" )
+
+       self.log.clear()
+       self.repo.commit_check_log()
+       self.log.info_contains( "Moved dir1/dir2/FOO to moved/dir2/FOO" )
+       self.log.info_contains( "with checksum", 0 )
+       self.repo.db_check_size( 1, 2, 0 )
+       self.assertEqual( Meta.CHECKSUM_REMOVED, self.repo.db_get( "dir1/dir2/FOO" ).checksum )
+       self.assertEqual( checksum, self.repo.db_get( "moved/dir2/FOO" ).checksum )
+
+       self.log.clear()
+       self.repo.main( "log", "moved/dir2/FOO" )
+       self.log.info_contains( "mov - moved/dir2/FOO (dir1/dir2/FOO)" )
+       self.log.info_contains( " Commit ", 2 )
+
+    def test_mv_into_dir(self):
+       self.repo.main( "mv", "FOO", "sdir1" )
+       self.repo.file_check( "sdir1/FOO", exists = True )
+       self.repo.main( "commit" )
+       self.repo.main( "status" )
+
+    def test_mv_modified_after(self):
+       self.repo.main( "mv", "FOO", "FOO_NEW" )
+       self.repo.file_make( "FOO_NEW", content = "CHANGED AFTER MOVE", timestamp = 2**21 )
+       self.log.clear()
+       self.repo.main( "commit" )
+       self.log.info_contains( "Moved FOO to FOO_NEW" )
+       self.repo.main( "verify" )
+
+    def test_mv_conflicts(self):
+       self.repo.main( "mv", "FOO", "BAR", assumed_ret = -1 )
+       self.repo.main( "mv", "NONEXT", "BAR2", assumed_ret = -1 )
+       self.repo.main( "mv", "dir1", "dir1/dir2", assumed_ret = -1 )
+       self.repo.file_make( "FOO", content = "MODIFIED" )
+       self.repo.main( "add", "FOO" )
+       self.repo.main( "mv", "FOO", "FOO_NEW", assumed_ret = -1 )
+       self.repo.db_check_size( 0, 0, 1 )
+       self.repo.file_check( "FOO", exists = True )
+
+    def test_mv_revert(self):
+       self.repo.main( "mv", "dir1", "moved" )
+       self.repo.main( "revert" )
+       self.repo.file_check( "moved", exists = False )
+       self.repo.file_check( "dir1/dir2/FOO", exists = True )
+       self.repo.db_check_size( 0, 0, 0 )
+       self.repo.main( "status" )
+
+
+class TestMoveSync( SyncBase ):
+
+    def test_sync_replays_move(self):
+       self.repo.main( "mv", "dir1", "moved" )
+       self.repo.main( "commit" )
+       self.log.clear()
+       self.do_sync()
+       self.log.info_contains( "#SYNC:moved/dir2/FOO: move from dir1/dir2/FOO", 1 )
+       self.log.info_contains( "#SYNC:moved/dir2/BAR: move from dir1/dir2/BAR", 1 )
+       self.other.file_check( "moved/dir2/BAR", exists = True )
+       self.other.file_check( "dir1/dir2/BAR", exists = False )
+
+    def test_sync_move_of_duplicate(self):
+       # Identical content on two paths: the checksum index would pick just one of them
+       self.repo.file_copy( "FOO", "FOO_COPY" )
+       self.repo.main( "add", "FOO_COPY" )
+       self.repo.main( "commit" )
+       self.do_sync()
+       for fn in ( "FOO", "FOO_COPY" ):
+          self.repo.main( "mv", fn, fn + "_MOVED" )
+       self.repo.main( "commit" )
+       self.log.clear()
+       self.do_sync()
+       self.log.info_contains( ": move from", 2 )
+       self.log.info_contains( "copy_local", 0 )
@@ -0,0 +1,154 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+from threading import Thread
+from unittest.mock import patch
+from typing import Any, List
+
+from sarch.common import CONFIG
+from sarch.database import open_database, Meta
+from sarch.filesystem import Filesystem
+from sarch.remote import SA_SYNC_Exception, check_for_mods, remote_open
+from sarch.remote_daemon import RemoteDaemon, address_parse
+from .common import RepoInDir, LogOutput
+
+
+class TestServe( unittest.TestCase ):
+
+   def setUp(self):
+      self.log = LogOutput( self.assertEqual )
+      self.log.start()
+      self.repo_local  = RepoInDir("repo_local", self.assertEqual )
+      self.repo_remote = RepoInDir("repo_remote", self.assertEqual )
+      self.repo_local.fillup_std_layout()
+      self.sock_dir = tempfile.mkdtemp()
+      self.daemon = None # type: RemoteDaemon
+
+   def tearDown(self):
+      if self.daemon != None:
+         self.daemon.shutdown()
+         self.thread.join()
+         self.daemon.close()
+      shutil.rmtree( self.sock_dir )
+      self.repo_local.clean()
+      self.repo_remote.clean()
+      self.log.stop()
+
+   def start( self, listen : str ) -> str:
+      """ Serve the remote repository in a thread, returns the url for the clients """
+      fs = Filesystem( self.repo_remote.test_dir )
+      db = open_database( fs.make_absolute( CONFIG.PATH ) )
+      self.daemon = RemoteDaemon( db, fs, lambda: check_for_mods( db, fs ) )
+      self.assertEqual( None, self.daemon.refresh() )
+      self.daemon.listen( listen )
+      self.thread = Thread( target = self.daemon.serve_forever )
+      self.thread.start()
+      ( family, address ) = self.daemon.address
+      if family == "unix":
+         return "unix://" + address
+      return "tcp://%s:%d" % address
+
+   def sync( self, url, *args, assumed_ret = 0 ):
+      self.repo_local.main( "sync", url, *args, assumed_ret = assumed_ret )
+      if assumed_ret == 0:
+         self.repo_local.check_equal( self.repo_remote )
+
+   def test_address_parse( self ):
+      self.assertEqual( ( "unix", "/run/s.sock" ), address_parse( "unix:/run/s.sock" ) )
+      self.assertEqual( ( "unix", "/run/s.sock" ), address_parse( "unix:///run/s.sock" ) )
+      self.assertEqual( ( "tcp", ( "host", 7000 ) ), address_parse( "tcp:host:7000" ) )
+      self.assertEqual( ( "tcp", ( "host", 7000 ) ), address_parse( "tcp://host:7000" ) )
+      for invalid in ( "unix:", "tcp:host", "tcp:host:port", "ssh://host:/path" ):
+         with self.assertRaises( SA_SYNC_Exception ):
+            address_parse( invalid )
+
+   def test_sync_unix( self ):
+      url = self.start( "unix:" + os.path.join( self.sock_dir, "sarch.sock" ) )
+      self.sync( url )
+      self.repo_local.make_std_mods()
+      self.sync( url )
+      self.log.clear()
+      self.sync( url )
+      self.log.info_contains( "Everything up to date" )
+
+   def test_sync_tcp_parallel( self ):
+      url = self.start( "tcp:127.0.0.1:0" )
+      self.sync( url, "--jobs", "3" )
+      self.repo_local.make_std_mods()
+      self.sync( url, "--jobs", "3" )
+      self.assertEqual( 0, self.daemon.n_sessions )
+
+   def test_concurrent_clients( self ):
+      url = self.start( "unix:" + os.path.join( self.sock_dir, "sarch.sock" ) )
+      self.sync( url )
+      db = self.daemon.db
+      unlocked = [] # type: List[str]
+      errors   = [] # type: List[Exception]
+      
+      def check_locked( name : str ) -> Any:
+         method = getattr( db, name )
+         def locked_only( *args, **kwargs ):
+            if self.daemon.lock._is_owned() == False: # type: ignore
+               unlocked.append( name )
+            return method( *args, **kwargs )
+         return patch.object( db, name, locked_only )
+      
+      def client( index : int ) -> None:
+         try:
+            remote = remote_open( url, "Client%d" % index, os.path.join( self.sock_dir, "peers%d" % index ) )
+            meta = remote.db.meta_get( "FOO" )
+            meta.modtime += 1 # Checked against the database
+            for loop in range( 20 ):
+               remote.files_check( [ meta ] )
+            data = bytes( "CONTENT %d" % index, "utf8" )
+            meta = Meta( "NEW%d" % index )
+            meta.checksum = hashlib.md5( data ).hexdigest()
+            meta.modtime = 2**20
+            remote.file_set( meta, [ data ] )
+            remote.flush()
+            remote.db.meta_set( meta )
+            remote.database_save()
+            remote.close()
+         except Exception as err:
+            errors.append( err )
+      
+      patches = [ check_locked( name ) for name in ( "meta_get", "staging_list", "generation", "replica_uid", "json_dumps",
+                                                      "changes_dumps", "changes_loads", "save" ) ]
+      for patcher in patches:
+         patcher.start()
+      try:
+         threads = [ Thread( target = client, args = ( index, ) ) for index in range( 2 ) ]
+         for thread in threads:
+            thread.start()
+         for thread in threads:
+            thread.join()
+      finally:
+         for patcher in patches:
+            patcher.stop()
+      self.assertEqual( [], errors )
+      self.assertEqual( [], unlocked )
+      # Both clients' changes are in the database
+      self.repo_remote.open_db()
+      for index in range( 2 ):
+         self.assertEqual( "NEW%d" % index, self.repo_remote.db_get( "NEW%d" % index ).filename )
+      self.assertEqual( 0, self.daemon.n_sessions )
+
+   def test_local_commit_reloads( self ):
+      url = self.start( "unix:" + os.path.join( self.sock_dir, "sarch.sock" ) )
+      self.sync( url )
+      self.repo_remote.file_make( "REMOTE_NEW", content = "FROM REMOTE" )
+      self.repo_remote.main( "add", "REMOTE_NEW" )
+      self.repo_remote.main( "commit" )
+      self.sync( url )
+      self.repo_local.file_check( "REMOTE_NEW", exists = True )
+
+   def test_remote_modified( self ):
+      url = self.start( "unix:" + os.path.join( self.sock_dir, "sarch.sock" ) )
+      self.sync( url )
+      self.repo_remote.file_make( "FOO", content = "NOT COMMITTED", timestamp = 2**10 )
+      # Check of the files is still fresh
+      self.repo_local.main( "sync", url )
+      with patch.object( CONFIG, "SERVE_RECHECK_SECONDS", 0.0 ):
+         self.repo_local.main( "sync", url, assumed_ret = -1 )
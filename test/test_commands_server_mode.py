@@ -4,6 +4,8 @@ from pathlib import Path
 from unittest.mock import patch, MagicMock
 from io import StringIO
 
+from sarch.database import DatabaseBase
+
 class TestServerMode( TestBase  ):
     
     def test_server_start(self):
@@ -18,7 +20,8 @@ class TestServerMode( TestBase  ):
       fid_in = open( str(comm_in_file ), 'r' )
       fid_out = open( str(comm_out_file ), 'w' )
          
-      with patch("sys.stdin", fid_in), patch("sys.stdout", fid_out ):
+      # Server writes its messages to stderr
+      with patch("sys.stdin", fid_in), patch("sys.stdout", fid_out ), patch("sys.stderr", StringIO()):
          self.repo.main( "_server_mode", self.repo.test_dir )
       
       fid_in.close()
@@ -28,4 +31,15 @@ class TestServerMode( TestBase  ):
       self.repo.file_make("FOO", timestamp=2**10)
       with patch("sys.stderr", MagicMock()):
          self.repo.main( "_server_mode", self.repo.test_dir, assumed_ret = -1 )
-
+   
+    def test_server_with_mod_interrupted_sync( self ):
+      # Files written by the interrupted sync are newer than the database, the resumed sync checks them one by one
+      self.repo.db.set_status( DatabaseBase.STATUS_SYNC )
+      self.repo.db.save()
+      self.repo.file_make("FOO", timestamp=2**10)
+      comm_in_file = Path(self.repo.test_dir, "COMM_IN" )
+      with open( str(comm_in_file), 'wb' ) as fid:
+         fid.write(bytes('{"cmd": "close", "par": []}\0',"utf8"))
+      with open( str(comm_in_file), 'r' ) as fid_in, open( str( Path(self.repo.test_dir, "COMM_OUT" ) ), 'w' ) as fid_out:
+         with patch("sys.stdin", fid_in), patch("sys.stdout", fid_out ), patch("sys.stderr", StringIO()):
+            self.repo.main( "_server_mode", self.repo.test_dir )
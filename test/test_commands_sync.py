@@ -1,13 +1,19 @@
 
 import os
+import json
 import shutil
+import threading
 from unittest.mock import patch
 
 from .common import TestBase, RepoInDir
 from sarch.remote_localfs import RemoteLocalFS
 from sarch.database import Meta, DatabaseBase
-from sarch.remote import SA_SYNC_Exception
+from sarch.database_json import DatabaseJson
+from sarch.common import CONFIG
+from sarch.remote import SA_SYNC_Exception, _tree_compare
 from sarch.filesystem import Filesystem
+from sarch.sync_state import SyncState
+from sarch.sync_rules import SyncRules
 
 
 class SyncBase( TestBase ):
@@ -78,6 +84,147 @@ class TestSyncCancelled( SyncBase ):
         with patch.object(Filesystem, 'trash_clear'): # type: ignore
            self.repo.sync( self.other, assumed_ret = 0 )   
         
+
+
+@patch.object( CONFIG, "BULK_MAX_SIZE", 0 )
+@patch.object( CONFIG, "CHECKPOINT_FILES", 4 )
+class TestSyncResume( SyncBase ):
+   def setUp(self) -> None:
+      super().setUp()
+      self.filenames = [ "FILE%03d" % loop for loop in range(16)]
+      self.repo.file_make_many( self.filenames  )
+      self.repo.main("add", *self.filenames)
+      self.repo.main("commit")
+      self.state_file = os.path.join( self.repo.test_dir, CONFIG.PATH, SyncState.FILENAME )
+      
+   def interrupted_file_set( self ):
+      original_file_set = RemoteLocalFS.file_set
+      def interrupted_file_set( remote, target : Meta, *pargs, **kwargs ):
+         if target.filename == "FILE010":
+            raise SA_SYNC_Exception("THIS IS TEST EXCEPTION")
+         return original_file_set( remote, target, *pargs, **kwargs )
+      return interrupted_file_set
+      
+   def sync_interrupted( self ) -> None:
+      with patch.object( RemoteLocalFS, "file_set", self.interrupted_file_set() ):
+         self.repo.sync( self.other, assumed_ret = -1 )
+      self.assertTrue( os.path.exists( self.state_file ) )
+      
+   def test_resume( self ) -> None:
+      self.sync_interrupted()
+      # Two checkpoints were saved before the interruption
+      self.other.open_db()
+      self.assertEqual( DatabaseBase.STATUS_SYNC, self.other.db.get_status() )
+      self.assertNotIn( "FILE009", set( self.other.db.meta_list_keys() ) )
+      self.assertEqual( self.repo.db_get( "FILE007" ).checksum, self.other.db_get( "FILE007" ).checksum )
+      
+      original_file_set = RemoteLocalFS.file_set
+      written = []
+      def spied_file_set( remote, target : Meta, *pargs, **kwargs ):
+         written.append( target.filename )
+         return original_file_set( remote, target, *pargs, **kwargs )
+      
+      self.log.clear()
+      with patch.object( RemoteLocalFS, "file_set", spied_file_set ):
+         self.repo.main( "sync", "--resume" )
+      self.log.info_contains( "8 operations were done already" )
+      self.assertEqual( self.filenames[8:], sorted( written ) )
+      self.assertFalse( os.path.exists( self.state_file ) )
+      self.repo.check_equal( self.other )
+      self.other.open_db()
+      self.assertEqual( DatabaseBase.STATUS_CLEAR, self.other.db.get_status() )
+      self.other.main( "verify" )
+      self.log.clear()
+      self.do_sync()
+      self.log.info_contains( "Everything up to date", 2 )
+   
+   def test_resume_overwritten( self ) -> None:
+      # Tracked files updated on the other end, and written here when interrupted
+      self.do_sync()
+      for filename in self.filenames:
+         self.other.file_make( filename, timestamp = 2**21, content = "UPDATED " + filename )
+      self.other.main( "commit", "-a" )
+      with patch.object( RemoteLocalFS, "file_set", self.interrupted_file_set() ):
+         self.repo.sync( self.other, assumed_ret = -1 )
+      # The files written after the last checkpoint are newer than the database
+      self.repo.open_db()
+      self.assertNotEqual( self.repo.db_get( "FILE009" ).modtime, self.repo.fs.get_modtime( "FILE009" ) )
+      
+      self.log.clear()
+      self.repo.main( "sync", "--resume" )
+      self.log.info_contains( "10 operations were done already" )
+      self.repo.check_equal( self.other )
+      self.repo.main( "verify" )
+      self.repo.file_check( "FILE015", exists = True, checksum = self.other.db_get( "FILE015" ).checksum )
+      self.log.clear()
+      self.do_sync()
+      self.log.info_contains( "Everything up to date", 2 )
+   
+   def test_resume_other_url( self ) -> None:
+      self.sync_interrupted()
+      self.repo.main( "sync", "file:///nonexistent", "--resume", assumed_ret = -1 )
+      self.repo.main( "sync", "file:///%s" % self.other.test_dir, "--resume" )
+      self.repo.check_equal( self.other )
+   
+   def test_resume_nothing( self ) -> None:
+      self.repo.main( "sync", "--resume", assumed_ret = -1 )
+      self.repo.main( "sync", assumed_ret = -1 )
+
+   
+class TestSyncSubset( SyncBase ):
+   def setUp(self) -> None:
+      super().setUp()
+      self.url = "file:///%s" % self.other.test_dir
+      files = self.other.file_make_many( [ "ARCHIVED" ], basepath = ( "archive", "2010" ) )
+      files += self.other.file_make_many( [ "P1", "P2" ], basepath = ( "photos", "2026" ) )
+      files += self.other.file_make_many( [ "P0" ], basepath = ( "photos", "2025" ) )
+      files += self.other.file_make_many( [ "DOC" ], basepath = ( "docs", ) )
+      files += self.other.file_make_many( [ "OLD_DOC" ], basepath = ( "docs", "old" ) )
+      self.other.main( "add", *files )
+      self.other.main( "commit" )
+   
+   def test_rules( self ) -> None:
+      rules = SyncRules( [ "photos/2026/", "./docs" ], [ "docs/old" ] )
+      self.assertEqual( [ "docs", "photos/2026" ], rules.include )
+      for filename in ( "photos/2026/P1", "docs/DOC", "docs/older/DOC" ):
+         self.assertTrue( rules.wanted( filename ), filename )
+      for filename in ( "photos/2025/P0", "photos/20260", "docs/old/OLD_DOC", "archive/2010/ARCHIVED", "FOO" ):
+         self.assertFalse( rules.wanted( filename ), filename )
+      for dirname in ( "", "photos", "photos/2026/raw", "docs" ):
+         self.assertTrue( rules.dir_wanted( dirname ), dirname )
+      for dirname in ( "photos/2025", "archive", "docs/old" ):
+         self.assertFalse( rules.dir_wanted( dirname ), dirname )
+      self.assertTrue( SyncRules( [], [] ).selects_all() )
+   
+   def test_subset( self ) -> None:
+      self.repo.main( "subset", self.url, "--include", "photos/2026", "--include", "docs", "--exclude", "docs/old" )
+      self.log.clear()
+      self.repo.sync( self.other )
+      self.log.info_contains( "Syncing only include: docs, photos/2026, exclude: docs/old" )
+      for filename in ( "photos/2026/P1", "photos/2026/P2", "docs/DOC" ):
+         self.repo.file_check( filename, exists = True )
+      for filename in ( "photos/2025/P0", "docs/old/OLD_DOC", "archive/2010/ARCHIVED" ):
+         self.repo.file_check( filename, exists = False )
+      
+      # Local changes outside the selection stay here
+      files = self.repo.file_make_many( [ "P3" ], basepath = ( "photos", "2026" ) )
+      files += self.repo.file_make_many( [ "NOTES" ], basepath = ( "notes", ) )
+      self.repo.main( "add", *files )
+      self.repo.main( "commit" )
+      self.repo.sync( self.other )
+      self.other.file_check( "photos/2026/P3", exists = True )
+      self.other.file_check( "notes/NOTES", exists = False )
+      self.other.file_check( "archive/2010/ARCHIVED", exists = True )
+      self.log.clear()
+      self.repo.sync( self.other )
+      self.log.info_contains( "Everything up to date" )
+      
+      self.repo.main( "subset", self.url, "--clear" )
+      self.log.info_contains( "include: everything, exclude: nothing" )
+      self.do_sync()
+      self.other.file_check( "notes/NOTES", exists = True )
+      self.repo.file_check( "archive/2010/ARCHIVED", exists = True )
+   
    
 class TestSync( SyncBase ):
    
@@ -190,6 +337,59 @@ class TestSync( SyncBase ):
       self.do_sync( )
       self.do_sync( )
       
+   def test_sync_compares_changed_dirs_only( self ) -> None:
+      self.repo.file_make( "dir1/dir2/FOO", timestamp = 2**21, content = "MODIFIED" )
+      self.repo.main( "commit", "--auto" )
+      self.log.clear()
+      self.do_sync()
+      self.log.info_contains( "#SYNC:dir1/dir2/FOO: copy mod", 1 )
+      self.log.info_contains( "#SYNC: 3 directories differ", 1 ) # root, dir1 and dir1/dir2
+      self.log.info_contains( "#SYNC: 0 directories differ", 1 )
+      self.assertEqual( self.repo.db.tree_hash( "" ), self.other.db.tree_hash( "" ) )
+      self.assertEqual( ( [ "dir1/dir2" ], [] ), self.repo.db.tree_list( "dir1" ) )
+      
+   def test_sync_sibling_prefix( self ) -> None:
+      self.repo.file_make( "photos/y", content = "old" )
+      self.repo.main( "add", "photos" )
+      self.repo.main( "commit" )
+      self.do_sync()
+      self.repo.file_make( "photo/x" )
+      self.repo.main( "add", "photo" )
+      self.repo.main( "commit" )
+      self.other.file_make( "photos/y", timestamp = 2**21, content = "new" )
+      self.other.main( "commit", "-a" )
+      # The local only directory photo does not take photos/y with it
+      self.repo.open_db()
+      self.other.open_db()
+      ( local_only, other_only, common ) = _tree_compare( self.repo.db, self.other.db, SyncRules() )
+      self.assertEqual( ( { "photo/x" }, set() ), ( local_only, other_only ) )
+      self.assertIn( "photos/y", common )
+      self.do_sync()
+      self.other.file_check( "photo/x", exists = True )
+      self.assertEqual( self.other.db_get( "photos/y" ).checksum, self.repo.db_get( "photos/y" ).checksum )
+      
+   def test_sync_dot_directory( self ) -> None:
+      self.repo.file_make( ".config/a" )
+      self.repo.file_make( "config/b" )
+      self.repo.main( "add", ".config", "config" )
+      self.repo.main( "commit" )
+      self.log.clear()
+      self.do_sync()
+      self.log.info_contains( "#SYNC:.config/a: copy new", 1 )
+      self.other.file_check( ".config/a", exists = True )
+      
+   def test_tree_hash_incremental( self ) -> None:
+      self.repo.main( "mv", "dir1", "moved" )
+      self.repo.main( "commit" )
+      self.repo.open_db()
+      # Hashes built from scratch on the upgrade match the incrementally updated ones
+      rebuilt = DatabaseJson()
+      db = json.loads( self.repo.db.json_dumps() )
+      db["version_minor"] = 3
+      rebuilt.json_loads( json.dumps( db ) )
+      self.assertEqual( self.repo.db.db["tree"], rebuilt.db["tree"] )
+      self.assertIsNone( rebuilt.tree_hash( "nonexisting" ) )
+      
    def test_sync_when_dirty_modified( self ) -> None:
       # Make a update that needs to be uploaded
       self.repo.file_make( "FOO", timestamp = 2**20, content="INVALID")
@@ -273,3 +473,99 @@ class TestSync( SyncBase ):
       
 
 
+
+   @patch.object( CONFIG, "BULK_MAX_SIZE", 2**11 )
+   def test_sync_bulk( self ) -> None:
+      new_files = self.repo.file_make_many( [ "SMALL%d" % loop for loop in range(3) ], basepath = ( "thumbs", ) )
+      self.repo.file_make( "LARGE", content = "L" * 2**11 )
+      self.repo.main( "add", "LARGE", *new_files )
+      self.repo.main( "commit" )
+      self.log.clear()
+      self.do_sync()
+      self.log.info_contains( "Repo Other: 3 files transferred in bulk", 1 )
+      self.log.info_contains( "Repo Other: Transfer LARGE", 1 )
+      self.other.main( "verify" )
+      
+   @patch.object( CONFIG, "BULK_MAX_SIZE", 0 )
+   def test_sync_dedup( self ) -> None:
+      copies = self.repo.file_make_many( [ "COPY%d" % loop for loop in range(4) ], basepath = ( "project", ) )
+      for filename in copies:
+         self.repo.file_make( filename, content = "SAME CONTENT" )
+      self.repo.main( "add", *copies )
+      self.repo.main( "commit" )
+      self.log.clear()
+      self.do_sync()
+      self.log.info_contains( "Repo Other: Transfer project/COPY0", 1 )
+      self.log.info_contains( "Repo Other: Transfer", 1 )
+      self.log.info_contains( "Repo Other: Copy local project/COPY0", 3 )
+      self.other.main( "verify" )
+      
+   def test_sync_dedup_reflink( self ) -> None:
+      def fake_reflink( source, target ):
+         shutil.copyfile( source, target )
+         return True
+      
+      for filename in ( "COPY1", "COPY2" ):
+         self.repo.file_copy( "FOO", filename )
+      self.repo.main( "add", "COPY1", "COPY2" )
+      self.repo.main( "commit" )
+      self.log.clear()
+      with patch( "sarch.filesystem._reflink", fake_reflink ):
+         self.do_sync()
+      self.log.info_contains( "as reflink of", 2 )
+      self.other.main( "verify" )
+      
+   @patch.object( CONFIG, "BULK_MAX_SIZE", 0 ) # Small files are sent in bulk, without partial files
+   def test_sync_resume_partial( self ) -> None:
+      self.repo.file_make( "NEW_FILE", content = "0123456789" * 40 )
+      self._add_n_commit_new_file()
+      checksum = self.repo.db_get( "NEW_FILE" ).checksum
+      
+      original_file_get = RemoteLocalFS.file_get
+      offsets = []
+      def interrupted_file_get( remote, source, basis = None, offset = 0 ):
+         offsets.append( offset )
+         for ( loop, data ) in enumerate( original_file_get( remote, source, basis, offset ) ):
+            if loop == 25:
+               raise SA_SYNC_Exception("THIS IS TEST EXCEPTION")
+            yield data
+      
+      with patch.object( RemoteLocalFS, 'file_get', new=interrupted_file_get ):
+         self.repo.sync( self.other, assumed_ret = -1 )
+      self.assertEqual( 100, self.other.fs.partial_size( checksum ) )
+      
+      offsets.clear()
+      with patch.object( RemoteLocalFS, 'file_get', new=interrupted_file_get ):
+         self.repo.sync( self.other, assumed_ret = -1 ) # Interrupted again, but made progress
+      self.assertEqual( [ 100 ], offsets )
+      self.assertEqual( 200, self.other.fs.partial_size( checksum ) )
+      
+      self.do_sync()
+      self.other.main( "verify" )
+      self.assertEqual( 0, self.other.fs.partial_size( checksum ) )
+
+   def test_sync_concurrent( self ) -> None:
+      self.repo.file_make( "FROM_LOCAL", content = "LOCAL CONTENT" )
+      self.repo.main( "add", "FROM_LOCAL" )
+      self.repo.main( "commit" )
+      self.other.file_make( "FROM_OTHER", content = "OTHER CONTENT" )
+      self.other.main( "add", "FROM_OTHER" )
+      self.other.main( "commit" )
+      
+      # Both directions must be writing at the same time to pass the barrier
+      barrier = threading.Barrier( 2, timeout = 5 )
+      original_file_set = RemoteLocalFS.file_set
+      def meeting_file_set( remote, *pargs, **kwargs ):
+         barrier.wait()
+         return original_file_set( remote, *pargs, **kwargs )
+      
+      with patch.object( RemoteLocalFS, "file_set", meeting_file_set ):
+         self.repo.main( "sync", "file://" + self.other.test_dir, "--concurrent" )
+      self.repo.check_equal( self.other )
+      self.other.file_check( "FROM_LOCAL", exists = True )
+      self.repo.file_check( "FROM_OTHER", exists = True )
+      self.repo.main( "verify" )
+      self.other.main( "verify" )
+      self.log.clear()
+      self.do_sync()
+      self.log.info_contains( "Everything up to date", 2 )
@@ -0,0 +1,77 @@
+import random
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from sarch.common import CONFIG
+from sarch import delta
+
+
+def chunks( data, size ):
+   for i in range( 0, len(data), size ):
+      yield data[ i : i + size ]
+
+
+class TestDelta( unittest.TestCase ):
+
+   def setUp( self ):
+      rnd = random.Random( 1 )
+      self.old = bytes( rnd.getrandbits(8) for _ in range( 20000 ) )
+      fd, self.basis = tempfile.mkstemp()
+      os.write( fd, self.old )
+      os.close( fd )
+
+   def tearDown( self ):
+      os.unlink( self.basis )
+
+   def roundtrip( self, new ):
+      with patch.object( CONFIG, 'DELTA_BLOCK_MIN', 64 ):
+         sig = delta.signature_file( self.basis )
+      encoded = b"".join( delta.delta( sig, chunks( new, 7 ) ) )
+      self.assertEqual( new, b"".join( delta.patch( self.basis, sig["block"], chunks( encoded, 5 ) ) ) )
+      return encoded
+
+   def test_unchanged( self ):
+      encoded = self.roundtrip( self.old )
+      self.assertLess( len(encoded), 100 )
+
+   def test_modified( self ):
+      new = self.old[0:3000] + b"X"*10 + self.old[3010:9000] + b"INSERTED"*20 + self.old[9000:15000] + self.old[16000:] + b"TAIL"
+      encoded = self.roundtrip( new )
+      self.assertLess( len(encoded), 1000 )
+
+   def test_unrelated( self ):
+      self.roundtrip( b"NOTHING IN COMMON" * 100 )
+      self.roundtrip( b"" )
+
+   def test_miss_limit( self ):
+      rnd = random.Random( 2 )
+      new = bytes( rnd.getrandbits(8) for _ in range( 3000 ) ) + self.old
+      self.assertLess( len( self.roundtrip( new ) ), len(new) // 2 )
+      with patch.object( CONFIG, 'DELTA_MISS_MAX', 1000 ):
+         encoded = self.roundtrip( new )
+      self.assertGreater( len(encoded), len(new) )
+      # Matching is tried again after each matched block
+      with patch.object( CONFIG, 'DELTA_MISS_MAX', 1000 ):
+         encoded = self.roundtrip( self.old[0:5000] + b"X"*500 + self.old[5500:] )
+      self.assertLess( len(encoded), len(self.old) // 2 )
+
+   def test_miss_limit_middle_edit( self ):
+      rnd = random.Random( 3 )
+      new = self.old[0:5000] + bytes( rnd.getrandbits(8) for _ in range( 6000 ) ) + self.old[11000:]
+      with patch.object( CONFIG, 'DELTA_MISS_MAX', 500 ):
+         encoded = self.roundtrip( new )
+      # Unchanged tail after the edit is still matched
+      self.assertLess( len(encoded), len(new) // 2 )
+      # Also when the edit does not end at a block boundary
+      new = self.old[0:5000] + bytes( rnd.getrandbits(8) for _ in range( 5990 ) ) + self.old[10990:]
+      with patch.object( CONFIG, 'DELTA_MISS_MAX', 500 ):
+         encoded = self.roundtrip( new )
+      self.assertLess( len(encoded), len(new) // 2 )
+
+   def test_corrupted_stream( self ):
+      with self.assertRaises( delta.SA_Delta_Exception ):
+         list( delta.patch( self.basis, 64, [ b"Q" ] ) )
+      with self.assertRaises( delta.SA_Delta_Exception ):
+         list( delta.patch( self.basis, 64, [ b"L\x00\x00\x00\x10ABC" ] ) )